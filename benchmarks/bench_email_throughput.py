@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Benchmark del envío masivo de facturas por email: la ruta enviar_facturas_masivo y la bandeja de salida
+(myapp/email_outbox.py) contra un servidor SMTP local que acepta y descarta los mensajes.
+
+Siembra en un directorio temporal (no toca instance/rentalsys.db, la caché de PDFs ni la red) un mes
+de facturas con su inquilino y, en una de cada 5, un gasto adjunto. Llama a la vista real del envío
+masivo (sin login ni filtro de propietario), espera a que la bandeja de salida termine el lote y mide:
+- total: tiempo de pared desde la petición hasta el último email enviado, y emails/s.
+- fases: segundos acumulados de reclamar el mensaje de la cola, cargar la factura, render del PDF,
+  plantilla del email, lectura de adjuntos de gastos, serialización MIME, conexión SMTP
+  (STARTTLS/login) y envío SMTP. Se suman los de todos los hilos de envío, así que con varios
+  hilos pueden superar al total.
+- sink: mensajes, conexiones y MiB recibidos por el servidor SMTP.
+
+Uso (desde el directorio raíz del proyecto):
+    python benchmarks/bench_email_throughput.py [-o resultados.json] [--facturas 1000] [--hilos 2]
+                                                [--por-minuto 0] [--pdf-en-cache] [--comparar base.json]
+"""
+import argparse
+import functools
+import inspect
+import json
+import logging
+import os
+import platform
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import smtplib
+
+import flask_mail
+from flask import Flask, g
+from flask_login import login_user
+
+from myapp import format_currency_safe, format_date_filter, login_manager, mail
+from myapp import email_outbox
+from myapp.models import db, Contrato, Factura, Gasto, Inquilino, Propiedad, Propietario, SystemSettings, User
+from myapp.routes import facturas as facturas_routes
+from myapp.routes.facturas import facturas_bp
+from myapp.utils.pdf_cache import get_invoice_pdf
+
+ANO, MES = 2025, 3
+GASTO_CADA = 5
+GASTO_KIB = 100
+TIMEOUT_SEGUNDOS = 1800
+
+
+class _SmtpSink(socketserver.ThreadingTCPServer):
+    """Servidor SMTP mínimo en 127.0.0.1: acepta todo y solo cuenta mensajes, conexiones y bytes."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SmtpSinkHandler)
+        self.lock = threading.Lock()
+        self.mensajes = self.conexiones = self.bytes = 0
+        threading.Thread(target=self.serve_forever, name='smtp-sink', daemon=True).start()
+
+
+class _SmtpSinkHandler(socketserver.StreamRequestHandler):
+    def _responder(self, linea):
+        self.wfile.write(linea.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        sink = self.server
+        with sink.lock:
+            sink.conexiones += 1
+        self._responder('220 sink ESMTP')
+        en_datos, tamano = False, 0
+        for linea in self.rfile:
+            if en_datos:
+                if linea.rstrip(b'\r\n') == b'.':
+                    en_datos = False
+                    with sink.lock:
+                        sink.mensajes += 1
+                        sink.bytes += tamano
+                    self._responder('250 OK')
+                else:
+                    tamano += len(linea)
+                continue
+            comando = linea[:4].upper()
+            if comando in (b'EHLO', b'HELO'):
+                self._responder('250 sink')
+            elif comando == b'DATA':
+                en_datos, tamano = True, 0
+                self._responder('354 Fin con <CRLF>.<CRLF>')
+            elif comando == b'QUIT':
+                self._responder('221 Adios')
+                return
+            else:
+                self._responder('250 OK')
+
+
+class _Fases:
+    """Segundos y llamadas acumulados por fase (desde cualquier hilo)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.segundos = defaultdict(float)
+        self.llamadas = defaultdict(int)
+
+    def medir(self, fase, funcion):
+        @functools.wraps(funcion)
+        def medida(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return funcion(*args, **kwargs)
+            finally:
+                transcurrido = time.perf_counter() - inicio
+                with self._lock:
+                    self.segundos[fase] += transcurrido
+                    self.llamadas[fase] += 1
+        return medida
+
+    def resumen(self):
+        return {fase: {'segundos': round(self.segundos[fase], 3), 'llamadas': self.llamadas[fase],
+                       'ms_por_llamada': round(self.segundos[fase] / self.llamadas[fase] * 1000, 2)}
+                for fase in sorted(self.segundos)}
+
+
+@contextmanager
+def _instrumentar(fases):
+    """Envuelve con cronómetros las funciones de cada fase del envío y las restaura al salir."""
+    objetivos = [
+        (email_outbox, '_claim_next', 'cola_reclamar'),
+        (facturas_routes, 'load_invoices_for_pdf', 'carga_factura'),
+        (facturas_routes, 'get_invoice_pdf', 'pdf_render'),
+        (facturas_routes, 'render_template', 'plantilla_email'),
+        (facturas_routes, 'read_expense_file', 'adjuntos_gastos'),
+        (flask_mail.Message, 'as_bytes', 'mime'),
+        (email_outbox.SmtpSession, '_open', 'smtp_conexion'),
+        (smtplib.SMTP, 'sendmail', 'smtp_envio'),
+    ]
+    originales = [(objeto, nombre, getattr(objeto, nombre)) for objeto, nombre, _ in objetivos]
+    for objeto, nombre, fase in objetivos:
+        setattr(objeto, nombre, fases.medir(fase, getattr(objeto, nombre)))
+    try:
+        yield
+    finally:
+        for objeto, nombre, original in originales:
+            setattr(objeto, nombre, original)
+
+
+def _crear_app(ruta_db, puerto_smtp, args):
+    """App mínima: BD, login, Flask-Mail apuntando al sink y el blueprint de facturas (sin scheduler)."""
+    app = Flask(__name__, template_folder=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'myapp', 'templates'))
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=f'sqlite:///{ruta_db}', SECRET_KEY='bench', WTF_CSRF_ENABLED=False,
+        MAIL_SERVER='127.0.0.1', MAIL_PORT=puerto_smtp, MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+        MAIL_DEFAULT_SENDER='facturas@bench.invalid', MAIL_SENDER_DISPLAY_NAME='RentalSys Benchmark',
+        INVOICE_PDF_CACHE_DIR=os.path.join(os.path.dirname(ruta_db), 'pdf_cache'),
+        INVOICE_PDF_CACHE_MAX_MB=256 if args.pdf_en_cache else 0,
+        EMAIL_OUTBOX_WORKERS=args.hilos, EMAIL_OUTBOX_RATE_PER_MINUTE=args.por_minuto,
+        EMAIL_OUTBOX_POLL_SECONDS=1,
+    )
+    app.logger.setLevel(logging.WARNING)
+    app.template_filter('currency')(format_currency_safe)
+    app.template_filter('date')(format_date_filter)
+    db.init_app(app)
+    mail.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(facturas_bp)
+    return app
+
+
+def _poblar(num_facturas, dir_gastos):
+    """Un propietario, num_facturas contratos con inquilino con email y una factura de ANO/MES cada uno."""
+    db.create_all()
+    db.session.add(SystemSettings(id=1))
+    usuario = User(username='bench', email='bench@bench.invalid', role='admin')
+    usuario.set_password('bench')
+    propietario = Propietario(nombre='Inversiones Benchmark, S.L.', nif='B00000000', direccion='Calle Mayor, 1',
+                              codigo_postal='36400', ciudad='O Porriño', email='propietario@bench.invalid')
+    db.session.add_all([usuario, propietario])
+    db.session.flush()
+    contenido_gasto = os.urandom(GASTO_KIB * 1024)
+    for i in range(1, num_facturas + 1):
+        inquilino = Inquilino(nombre=f'Inquilino {i}', nif=f'{i:08d}A', email=f'inquilino{i}@bench.invalid',
+                              direccion=f'Calle {i}', codigo_postal='36400', ciudad='O Porriño')
+        propiedad = Propiedad(direccion=f'Calle {i}, 2B', referencia_catastral=f'RC{i:010d}', propietario_id=propietario.id)
+        db.session.add_all([inquilino, propiedad])
+        db.session.flush()
+        contrato = Contrato(numero_contrato=f'CT-{i}', fecha_inicio=date(ANO - 1, 1, 1), precio_mensual=Decimal('500') + i,
+                            estado='activo', propiedad_id=propiedad.id, inquilino_id=inquilino.id)
+        db.session.add(contrato)
+        db.session.flush()
+        subtotal = Decimal('500') + i
+        iva, irpf = (subtotal * Decimal('0.21')).quantize(Decimal('0.01')), (subtotal * Decimal('0.19')).quantize(Decimal('0.01'))
+        items = [{'description': f'Alquiler {MES:02d}/{ANO}', 'quantity': 1, 'unitPrice': float(subtotal), 'total': float(subtotal)}]
+        factura = Factura(numero_factura=f'CT{i}-{ANO}{MES:02d}', fecha_emision=date(ANO, MES, 1), subtotal=subtotal, iva=iva,
+                          irpf=irpf, total=subtotal + iva - irpf, estado='pendiente', items_json=json.dumps(items),
+                          contrato_id=contrato.id, inquilino_id=inquilino.id, propiedad_id=propiedad.id)
+        db.session.add(factura)
+        if i % GASTO_CADA == 0:
+            db.session.flush()
+            ruta = os.path.join(dir_gastos, f'gasto_{i}.pdf')
+            with open(ruta, 'wb') as f_gasto:
+                f_gasto.write(contenido_gasto)
+            db.session.add(Gasto(contrato_id=contrato.id, concepto=f'Suministro {i}', importe=Decimal('30'), month=MES, year=ANO,
+                                 filename=f'gasto_{i}.pdf', original_filename=f'suministro_{i}.pdf', file_path=ruta,
+                                 mime_type='application/pdf', estado='Facturado', factura_id=factura.id))
+        if i % 500 == 0:
+            db.session.flush()
+    db.session.commit()
+    return usuario.id
+
+
+def _precalentar_pdfs():
+    """Renderiza todos los PDF a la caché, como quedan tras la generación mensual."""
+    settings = db.session.get(SystemSettings, 1)
+    for factura in facturas_routes.load_invoices_for_pdf([fid for (fid,) in db.session.query(Factura.id)]):
+        get_invoice_pdf(factura, settings)
+    db.session.remove()
+
+
+def _enviar(app, usuario_id):
+    """Lanza el envío masivo por la vista real y espera a que la bandeja de salida vacíe el lote."""
+    vista = inspect.unwrap(app.view_functions['facturas_bp.enviar_facturas_masivo'])
+    inicio = time.perf_counter()
+    with app.test_request_context('/facturas/enviar_masivo', method='POST', data={'year': ANO, 'month': MES},
+                                  headers={'Accept': 'application/json'}):
+        g.settings = db.session.get(SystemSettings, 1)
+        login_user(db.session.get(User, usuario_id))
+        respuesta, status = vista()
+        datos = respuesta.get_json()
+    encolado = time.perf_counter() - inicio
+    if status != 202:
+        raise RuntimeError(f"El envío masivo no se encoló ({status}): {datos.get('messages')}")
+
+    while True:
+        with app.app_context():
+            progreso = email_outbox.get_batch_progress(datos['lote'])
+        if progreso['finished']:
+            return progreso, encolado, time.perf_counter() - inicio
+        if time.perf_counter() - inicio > TIMEOUT_SEGUNDOS:
+            raise RuntimeError(f"El lote no terminó en {TIMEOUT_SEGUNDOS} s: {progreso}")
+        time.sleep(0.05)
+
+
+def _entorno():
+    def _version(modulo):
+        try:
+            return __import__(modulo).__version__
+        except (ImportError, AttributeError):
+            return None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=10,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'commit': commit, 'fecha': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'plataforma': platform.platform(), 'reportlab': _version('reportlab'), 'sqlalchemy': _version('sqlalchemy')}
+
+
+def _comparar(resultados, base):
+    """Imprime el valor base, el actual y la variación del total y de cada fase."""
+    print(f"\nComparación con {base['entorno'].get('commit') or 'base'}:")
+    pares = [('total', 'segundos', resultados['total'].get('segundos'), base.get('total', {}).get('segundos')),
+             ('total', 'emails_por_segundo', resultados['total'].get('emails_por_segundo'), base.get('total', {}).get('emails_por_segundo'))]
+    for fase, medidas in resultados['fases'].items():
+        pares.append((fase, 'ms_por_llamada', medidas['ms_por_llamada'], base.get('fases', {}).get(fase, {}).get('ms_por_llamada')))
+    for caso, clave, actual, anterior in pares:
+        if anterior and actual is not None:
+            print(f"  {caso:18} {clave:19} {anterior:10.2f} -> {actual:10.2f}  ({(actual - anterior) / anterior * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-o', '--salida', help="Fichero JSON de resultados (por defecto bench_email_<commit>.json)")
+    parser.add_argument('--facturas', type=int, default=1000, help="Facturas (e inquilinos) del mes a enviar")
+    parser.add_argument('--hilos', type=int, default=2, help="Hilos de la bandeja de salida (EMAIL_OUTBOX_WORKERS)")
+    parser.add_argument('--por-minuto', type=int, default=0, help="Límite EMAIL_OUTBOX_RATE_PER_MINUTE (0 = sin límite)")
+    parser.add_argument('--pdf-en-cache', action='store_true', help="PDFs ya en la caché en disco, como tras generar el mes")
+    parser.add_argument('--comparar', help="JSON de una ejecución anterior con el que comparar")
+    args = parser.parse_args()
+
+    logging.getLogger('myapp').setLevel(logging.WARNING)
+    directorio = tempfile.mkdtemp()
+    dir_gastos = os.path.join(directorio, 'gastos')
+    os.makedirs(dir_gastos)
+    sink = _SmtpSink()
+    app = _crear_app(os.path.join(directorio, 'bench.db'), sink.server_address[1], args)
+    with app.app_context():
+        usuario_id = _poblar(args.facturas, dir_gastos)
+        if args.pdf_en_cache:
+            _precalentar_pdfs()
+    print(f"{args.facturas} facturas ({args.facturas // GASTO_CADA} con gasto adjunto de {GASTO_KIB} KiB), "
+          f"{args.hilos} hilo(s), SMTP en 127.0.0.1:{sink.server_address[1]}")
+
+    fases = _Fases()
+    with _instrumentar(fases):
+        progreso, encolado, total = _enviar(app, usuario_id)
+
+    resultados = {
+        'entorno': _entorno(),
+        'parametros': {'facturas': args.facturas, 'hilos': args.hilos, 'por_minuto': args.por_minuto,
+                       'pdf_en_cache': args.pdf_en_cache, 'gastos_adjuntos': args.facturas // GASTO_CADA},
+        'total': {'segundos': round(total, 3), 'segundos_encolar': round(encolado, 3),
+                  'enviados': progreso['sent'], 'fallidos': progreso['failed'], 'omitidos': progreso['skipped'],
+                  'emails_por_segundo': round(progreso['sent'] / total, 1) if total else None},
+        'fases': fases.resumen(),
+        'sink': {'mensajes': sink.mensajes, 'conexiones': sink.conexiones, 'mib': round(sink.bytes / 1024 / 1024, 2)},
+    }
+    sink.shutdown()
+    print(f"  total  {resultados['total']}")
+    for fase, medidas in resultados['fases'].items():
+        print(f"  {fase:18} {medidas}")
+    print(f"  sink   {resultados['sink']}")
+
+    salida = args.salida or f"bench_email_{resultados['entorno']['commit'] or datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(salida, 'w', encoding='utf-8') as f_json:
+        json.dump(resultados, f_json, indent=2, ensure_ascii=False)
+    print(f"Resultados en {salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f_base:
+            _comparar(resultados, json.load(f_base))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la comprobación "¿ya existe factura de este contrato en este mes?".
+
+Compara el filtro antiguo (extract(year/month) sobre fecha_emision) con el rango semiabierto
+[inicio de mes, inicio del mes siguiente), con y sin el índice (contrato_id, fecha_emision).
+Trabaja sobre una base de datos SQLite temporal; no toca instance/rentalsys.db.
+
+Uso (desde el directorio raíz del proyecto):
+    python benchmarks/bench_factura_existente.py [num_contratos] [meses]
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, extract, select, text
+
+from myapp.models import db, Factura
+
+INDICE = 'ix_factura_contrato_id_fecha_emision'
+
+
+def _poblar(engine, num_contratos, meses):
+    """Crea las tablas y una factura por contrato y mes, desde enero de 2020."""
+    db.metadata.create_all(engine)
+    filas = []
+    for contrato_id in range(1, num_contratos + 1):
+        for i in range(meses):
+            year, month = 2020 + i // 12, 1 + i % 12
+            filas.append({'numero_factura': f'C{contrato_id}-{year}{month:02d}', 'fecha_emision': date(year, month, 1 + contrato_id % 28),
+                          'total': 0, 'subtotal': 0, 'iva': 0, 'irpf': 0, 'estado': 'pendiente', 'items_json': '[]',
+                          'contrato_id': contrato_id, 'inquilino_id': contrato_id, 'propiedad_id': contrato_id})
+    with engine.begin() as conn:
+        conn.execute(Factura.__table__.insert(), filas)
+        conn.execute(text('ANALYZE'))
+
+
+def _consultas(contrato_id, year, month):
+    inicio = date(year, month, 1)
+    inicio_siguiente = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return {
+        'extract': select(Factura.id).where(Factura.contrato_id == contrato_id,
+                                            extract('year', Factura.fecha_emision) == year,
+                                            extract('month', Factura.fecha_emision) == month).limit(1),
+        'rango': select(Factura.id).where(Factura.contrato_id == contrato_id,
+                                          Factura.fecha_emision >= inicio,
+                                          Factura.fecha_emision < inicio_siguiente).limit(1),
+    }
+
+
+def _plan(conn, consulta):
+    compilada = consulta.compile(conn, compile_kwargs={'literal_binds': True})
+    return '; '.join(fila[-1] for fila in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {compilada}'))
+
+
+def _medir(conn, num_contratos, meses, nombre):
+    """Una comprobación por contrato para el último mes (lo que hacen generación y tarea programada)."""
+    year, month = 2020 + (meses - 1) // 12, 1 + (meses - 1) % 12
+    inicio = time.perf_counter()
+    encontradas = 0
+    for contrato_id in range(1, num_contratos + 1):
+        encontradas += conn.execute(_consultas(contrato_id, year, month)[nombre]).first() is not None
+    return time.perf_counter() - inicio, encontradas
+
+
+def main():
+    num_contratos = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    meses = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    ruta = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    engine = create_engine(f'sqlite:///{ruta}')
+    _poblar(engine, num_contratos, meses)
+    print(f"{num_contratos} contratos x {meses} meses = {num_contratos * meses} facturas ({ruta})")
+
+    with engine.connect() as conn:
+        for con_indice in (False, True):
+            conn.exec_driver_sql(f'DROP INDEX IF EXISTS {INDICE}')
+            if con_indice:
+                conn.exec_driver_sql(f'CREATE INDEX {INDICE} ON factura (contrato_id, fecha_emision)')
+            conn.exec_driver_sql('ANALYZE')
+            print(f"\n== {'Con' if con_indice else 'Sin'} índice (contrato_id, fecha_emision) ==")
+            for nombre, consulta in _consultas(1, 2020, 1).items():
+                segundos, encontradas = _medir(conn, num_contratos, meses, nombre)
+                print(f"  {nombre:8} {segundos * 1000:9.1f} ms  ({encontradas} encontradas)  plan: {_plan(conn, consulta)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmark del render de facturas PDF (myapp/utils/pdf_generator.py).
+
+Compara un InvoicePdfRenderer nuevo por factura (sin cachés entre facturas: así se renderizaba
+antes) con el renderer compartido del proceso (estilos de tabla, párrafos analizados y logo en caché),
+sin y con los párrafos fijos ya maquetados de rótulos, datos del emisor y pie (InvoicePdfRenderer.chrome).
+No usa base de datos: renderiza instantáneas como las del pool de render de la generación.
+
+Uso (desde el directorio raíz del proyecto):
+    python benchmarks/bench_invoice_pdf.py [num_facturas] [ruta_logo]
+"""
+import logging
+import os
+import sys
+import time
+from datetime import date
+from decimal import Decimal
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from myapp.utils.pdf_generator import InvoicePdfRenderer, _build_invoice_pdf, get_invoice_renderer
+
+LOGGER = logging.getLogger('bench_invoice_pdf')
+LOGGER.disabled = True
+
+
+def _factura(i, logo_path=None):
+    """(invoice, inquilino, propiedad, emisor, settings) de una factura de ejemplo; 20 emisores distintos."""
+    emisor = SimpleNamespace(id=i % 20, nombre=f'Inversiones {i % 20}, S.L.', nif=f'B{i % 20:08d}', direccion='Calle Mayor, 1',
+                             codigo_postal='36400', ciudad='O Porriño', telefono='600000000', banco='Banco Ejemplo',
+                             cuenta_bancaria='ES00 0000 0000 0000 0000 0000', iban=None, swift=None)
+    inquilino = SimpleNamespace(id=i, nombre=f'Inquilino {i}', nif=f'{i:08d}A', direccion=f'Calle {i}', codigo_postal='36400',
+                                ciudad='O Porriño', telefono=None, banco=None, cuenta_bancaria=None, iban=None, swift=None)
+    propiedad = SimpleNamespace(id=i, direccion=f'Calle {i}, 2B', referencia_catastral=f'RC{i:010d}', descripcion=None)
+    items = [{'description': 'Alquiler Mayo 2025', 'quantity': 1, 'unitPrice': 640.73, 'total': 640.73}]
+    if i % 3 == 0:
+        items.append({'description': f'Gasto: Suministro luz {i}', 'quantity': 1, 'unitPrice': 39.0, 'total': 39.0})
+    subtotal = Decimal(str(sum(item['total'] for item in items))).quantize(Decimal('0.01'))
+    iva, irpf = (subtotal * Decimal('0.21')).quantize(Decimal('0.01')), (subtotal * Decimal('0.19')).quantize(Decimal('0.01'))
+    invoice = SimpleNamespace(id=i, numero_factura=f'C{i}-2025-{i:04d}', numero_factura_mostrado_al_cliente=f'2025-{i:04d}',
+                              fecha_emision=date(2025, 5, 1), items=items, subtotal=subtotal, iva=iva, irpf=irpf,
+                              total=subtotal + iva - irpf, notas='Factura correspondiente al periodo de Mayo/2025.',
+                              contrato_ref=SimpleNamespace(numero_contrato=f'CT-{i}'))
+    settings = SimpleNamespace(notas_factura=None, pie_factura=None, company_logo_filename=None, logo_path=logo_path)
+    return invoice, inquilino, propiedad, emisor, settings
+
+
+def _medir(facturas, nuevo_renderer):
+    """Segundos y bytes totales; nuevo_renderer() da el renderer de cada factura."""
+    inicio, total_bytes = time.perf_counter(), 0
+    for datos in facturas:
+        pdf = _build_invoice_pdf(*datos, logger_func=LOGGER, renderer=nuevo_renderer())
+        if pdf is None:
+            raise RuntimeError(f"No se pudo renderizar la factura {datos[0].id}")
+        total_bytes += len(pdf.getbuffer())
+    return time.perf_counter() - inicio, total_bytes
+
+
+def main():
+    num_facturas = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    logo_path = sys.argv[2] if len(sys.argv) > 2 else None
+    facturas = [_factura(i, logo_path) for i in range(num_facturas)]
+    _build_invoice_pdf(*facturas[0], logger_func=LOGGER) # Calentamiento: imports perezosos de ReportLab
+
+    print(f"{num_facturas} facturas{' con logo ' + logo_path if logo_path else ''}")
+    sin_chrome = InvoicePdfRenderer(prerender_chrome=False)
+    modos = (
+        ('renderer nuevo por factura', lambda: InvoicePdfRenderer(prerender_chrome=False)),
+        ('renderer sin chrome', lambda: sin_chrome),
+        ('renderer del proceso', get_invoice_renderer),
+    )
+    for nombre, nuevo_renderer in modos:
+        segundos, total_bytes = _medir(facturas, nuevo_renderer)
+        print(f"  {nombre:28} {segundos:7.2f} s  ({segundos / num_facturas * 1000:.1f} ms/factura, "
+              f"{total_bytes / num_facturas / 1024:.1f} KiB/factura)")
+    print(f"  cachés: {get_invoice_renderer().cache_info()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Suite de benchmarks de los PDF: facturas (myapp/utils/pdf_generator.py) y listado de facturación
+(myapp/routes/reports.py). Escribe los resultados en JSON para compararlos entre commits.
+
+Mide, sobre una base de datos SQLite sintética en un directorio temporal (no toca instance/rentalsys.db
+ni la caché de PDFs, y no necesita red):
+- factura_individual: latencia de generate_invoice_pdfs([id]) (carga de BD + render), en ms.
+- lote_<n>: tiempo y facturas/s de generate_invoice_pdfs con n facturas (100 y 1000 por defecto).
+- listado_<n>_anos: tiempo, tamaño y pico de memoria (tracemalloc) del PDF del listado de facturación
+  de un propietario para 1, 5 y 10 años de facturas. El pico se mide en una pasada aparte, sin cronometrar.
+
+Uso (desde el directorio raíz del proyecto):
+    python benchmarks/bench_pdf_suite.py [-o resultados.json] [--contratos 40] [--comparar base.json]
+"""
+import argparse
+import inspect
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import select
+
+from myapp.models import db, Contrato, Factura, Inquilino, Propiedad, Propietario, SystemSettings
+from myapp.routes.reports import reports_bp
+from myapp.utils.pdf_generator import generate_invoice_pdfs, get_invoice_pdf_settings
+
+ANO_FINAL = 2024
+ANOS_SEMBRADOS = 10
+LOTES = (100, 1000)
+ANOS_LISTADO = (1, 5, 10)
+REPETICIONES_INDIVIDUAL = 50
+
+
+def _crear_app(ruta_db):
+    """App mínima: solo la BD y el blueprint de informes (sin scheduler, correo ni caché de PDFs)."""
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=f'sqlite:///{ruta_db}', SECRET_KEY='bench', INVOICE_PDF_CACHE_MAX_MB=0)
+    app.logger.setLevel(logging.WARNING)
+    db.init_app(app)
+    app.register_blueprint(reports_bp)
+    return app
+
+
+def _poblar(num_contratos):
+    """Un propietario con num_contratos contratos y una factura mensual por contrato durante ANOS_SEMBRADOS años."""
+    db.create_all()
+    db.session.add(SystemSettings(id=1))
+    propietario = Propietario(nombre='Inversiones Benchmark, S.L.', nif='B00000000', direccion='Calle Mayor, 1',
+                              codigo_postal='36400', ciudad='O Porriño', cuenta_bancaria='ES00 0000 0000 0000 0000 0000')
+    db.session.add(propietario)
+    db.session.flush()
+    filas = []
+    for i in range(1, num_contratos + 1):
+        inquilino = Inquilino(nombre=f'Inquilino {i}', nif=f'{i:08d}A', direccion=f'Calle {i}', codigo_postal='36400', ciudad='O Porriño')
+        propiedad = Propiedad(direccion=f'Calle {i}, 2B', referencia_catastral=f'RC{i:010d}', propietario_id=propietario.id)
+        db.session.add_all([inquilino, propiedad])
+        db.session.flush()
+        contrato = Contrato(numero_contrato=f'CT-{i}', fecha_inicio=date(ANO_FINAL - ANOS_SEMBRADOS + 1, 1, 1),
+                            precio_mensual=Decimal('500') + i, estado='activo', propiedad_id=propiedad.id, inquilino_id=inquilino.id)
+        db.session.add(contrato)
+        db.session.flush()
+        for year in range(ANO_FINAL - ANOS_SEMBRADOS + 1, ANO_FINAL + 1):
+            for month in range(1, 13):
+                subtotal = Decimal('500') + i
+                iva, irpf = (subtotal * Decimal('0.21')).quantize(Decimal('0.01')), (subtotal * Decimal('0.19')).quantize(Decimal('0.01'))
+                items = [{'description': f'Alquiler {month:02d}/{year}', 'quantity': 1, 'unitPrice': float(subtotal), 'total': float(subtotal)}]
+                filas.append({'numero_factura': f'CT{i}-{year}{month:02d}', 'fecha_emision': date(year, month, 1),
+                              'subtotal': subtotal, 'iva': iva, 'irpf': irpf, 'total': subtotal + iva - irpf,
+                              'estado': 'pendiente', 'items_json': json.dumps(items), 'notas': f'Periodo {month:02d}/{year}.',
+                              'contrato_id': contrato.id, 'inquilino_id': inquilino.id, 'propiedad_id': propiedad.id})
+    db.session.execute(Factura.__table__.insert(), filas)
+    db.session.commit()
+    return propietario.id, len(filas)
+
+
+def _factura_individual(ids, settings):
+    generate_invoice_pdfs(ids[:1], settings) # Calentamiento: imports perezosos de ReportLab y cachés del renderer
+    tiempos = []
+    for invoice_id in ids[:REPETICIONES_INDIVIDUAL]:
+        inicio = time.perf_counter()
+        pdf = generate_invoice_pdfs([invoice_id], settings)[invoice_id]
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+        db.session.expunge_all() # Cada repetición vuelve a cargar la factura de la BD
+        if pdf is None:
+            raise RuntimeError(f"No se pudo renderizar la factura {invoice_id}")
+    tiempos.sort()
+    return {'repeticiones': len(tiempos), 'media_ms': round(statistics.mean(tiempos), 2),
+            'mediana_ms': round(statistics.median(tiempos), 2), 'p95_ms': round(tiempos[int(len(tiempos) * 0.95) - 1], 2)}
+
+
+def _lote(ids, settings):
+    db.session.expunge_all()
+    inicio = time.perf_counter()
+    pdfs = generate_invoice_pdfs(ids, settings)
+    segundos = time.perf_counter() - inicio
+    fallidas = sum(pdf is None for pdf in pdfs.values())
+    if fallidas:
+        raise RuntimeError(f"{fallidas} facturas sin PDF en el lote de {len(ids)}")
+    return {'facturas': len(ids), 'segundos': round(segundos, 3), 'facturas_por_segundo': round(len(ids) / segundos, 1),
+            'kib_por_factura': round(sum(len(pdf.getbuffer()) for pdf in pdfs.values()) / len(ids) / 1024, 1)}
+
+
+def _generar_listado(app, vista, propietario_id, anos):
+    """Llama a la vista del listado (sin login ni filtro de propietario) y lee la respuesta entera; devuelve los bytes."""
+    datos = {'propietario_id': propietario_id, 'fecha_desde': f'{ANO_FINAL - anos + 1}-01-01',
+             'fecha_hasta': f'{ANO_FINAL}-12-31', 'contrato_ids': 'all_contracts_of_owner'}
+    with app.test_request_context('/reports/listado-facturacion-pdf', method='POST', data=datos):
+        respuesta = vista()
+        try:
+            if respuesta.mimetype != 'application/pdf':
+                raise RuntimeError(f"El listado de {anos} años no devolvió un PDF ({respuesta.status})")
+            return sum(len(trozo) for trozo in respuesta.response)
+        finally:
+            respuesta.close()
+
+
+def _listado(app, propietario_id, anos):
+    vista = inspect.unwrap(app.view_functions['reports_bp.listado_facturacion_pdf'])
+    with app.app_context():
+        facturas = db.session.scalar(select(db.func.count(Factura.id)).where(Factura.fecha_emision >= date(ANO_FINAL - anos + 1, 1, 1)))
+    inicio = time.perf_counter()
+    tamano = _generar_listado(app, vista, propietario_id, anos)
+    segundos = time.perf_counter() - inicio
+
+    tracemalloc.start()
+    try:
+        _generar_listado(app, vista, propietario_id, anos)
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'facturas': facturas, 'segundos': round(segundos, 3), 'kib_pdf': round(tamano / 1024, 1),
+            'pico_memoria_mib': round(pico / 1024 / 1024, 2)}
+
+
+def _entorno():
+    def _version(modulo):
+        try:
+            return __import__(modulo).__version__
+        except (ImportError, AttributeError):
+            return None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=10,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'commit': commit, 'fecha': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'plataforma': platform.platform(), 'reportlab': _version('reportlab'), 'sqlalchemy': _version('sqlalchemy')}
+
+
+def _comparar(resultados, base):
+    """Imprime, para cada medida de tiempo y memoria, el valor base, el actual y la variación."""
+    print(f"\nComparación con {base['entorno'].get('commit') or 'base'}:")
+    for caso, medidas in resultados['casos'].items():
+        for clave in ('mediana_ms', 'segundos', 'pico_memoria_mib'):
+            anterior, actual = base['casos'].get(caso, {}).get(clave), medidas.get(clave)
+            if anterior and actual is not None:
+                print(f"  {caso:22} {clave:17} {anterior:10.2f} -> {actual:10.2f}  ({(actual - anterior) / anterior * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-o', '--salida', help="Fichero JSON de resultados (por defecto bench_pdf_<commit>.json)")
+    parser.add_argument('--contratos', type=int, default=40, help="Contratos sintéticos (x 12 facturas por año sembrado)")
+    parser.add_argument('--comparar', help="JSON de una ejecución anterior con el que comparar")
+    args = parser.parse_args()
+
+    logging.getLogger('myapp').setLevel(logging.WARNING)
+    app = _crear_app(os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    with app.app_context():
+        propietario_id, total_facturas = _poblar(args.contratos)
+        ids = list(db.session.scalars(select(Factura.id).order_by(Factura.id)))
+        settings = get_invoice_pdf_settings()
+    print(f"{args.contratos} contratos x {ANOS_SEMBRADOS} años = {total_facturas} facturas")
+
+    casos = {}
+    with app.app_context():
+        casos['factura_individual'] = _factura_individual(ids, settings)
+        print(f"  {'factura_individual':22} {casos['factura_individual']}")
+        for n in LOTES:
+            if n > len(ids):
+                print(f"  lote_{n}: omitido (solo hay {len(ids)} facturas; sube --contratos)")
+                continue
+            casos[f'lote_{n}'] = _lote(ids[:n], settings)
+            print(f"  {f'lote_{n}':22} {casos[f'lote_{n}']}")
+    for anos in ANOS_LISTADO:
+        casos[f'listado_{anos}_anos'] = _listado(app, propietario_id, anos)
+        print(f"  {f'listado_{anos}_anos':22} {casos[f'listado_{anos}_anos']}")
+
+    resultados = {'entorno': _entorno(), 'parametros': {'contratos': args.contratos, 'facturas': total_facturas}, 'casos': casos}
+    salida = args.salida or f"bench_pdf_{resultados['entorno']['commit'] or datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(salida, 'w', encoding='utf-8') as f_json:
+        json.dump(resultados, f_json, indent=2, ensure_ascii=False)
+    print(f"Resultados en {salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f_base:
+            _comparar(resultados, json.load(f_base))
+
+
+if __name__ == '__main__':
+    main()
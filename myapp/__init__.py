@@ -121,6 +121,27 @@ def create_app():
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # Límite subida archivos a 5MB
     app.config['MESES_STR'] = MESES_STR  # Añadir constante de meses para las tareas
+    # Procesos para renderizar PDFs tras generar facturas (None = uno por CPU)
+    app.config['INVOICE_PDF_WORKERS'] = int(os.environ.get('INVOICE_PDF_WORKERS', 0)) or None
+    # Contratos por commit durante la generación mensual (cada contrato va además en su propio SAVEPOINT)
+    app.config['INVOICE_GENERATION_BATCH_SIZE'] = int(os.environ.get('INVOICE_GENERATION_BATCH_SIZE', 200))
+    # Trazas del cálculo de facturas: off | summary (una línea por ejecución) | full (traza por contrato en BD)
+    app.config['INVOICE_TRACE_LEVEL'] = os.environ.get('INVOICE_TRACE_LEVEL', 'summary')
+    # Caché en disco de PDFs de factura (0 = desactivada); ver utils/pdf_cache.py
+    app.config['INVOICE_PDF_CACHE_DIR'] = os.environ.get('INVOICE_PDF_CACHE_DIR') or os.path.join(app.instance_path, 'pdf_cache')
+    app.config['INVOICE_PDF_CACHE_MAX_MB'] = int(os.environ.get('INVOICE_PDF_CACHE_MAX_MB', 256))
+    # Pintar el logo de la empresa (SystemSettings.company_logo_filename) en las facturas PDF; por defecto no
+    app.config['INVOICE_PDF_SHOW_LOGO'] = os.environ.get('INVOICE_PDF_SHOW_LOGO', 'false').lower() == 'true'
+    # Caché en memoria de los ficheros de gasto que se adjuntan a los emails (0 = desactivada)
+    app.config['EXPENSE_ATTACHMENT_CACHE_MAX_MB'] = int(os.environ.get('EXPENSE_ATTACHMENT_CACHE_MAX_MB', 64))
+    # Bandeja de salida de emails de factura: hilos de envío y reintentos; ver email_outbox.py
+    app.config['EMAIL_OUTBOX_WORKERS'] = int(os.environ.get('EMAIL_OUTBOX_WORKERS', 2))
+    app.config['EMAIL_OUTBOX_MAX_ATTEMPTS'] = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', 5))
+    app.config['EMAIL_OUTBOX_RETRY_BASE_SECONDS'] = int(os.environ.get('EMAIL_OUTBOX_RETRY_BASE_SECONDS', 60))
+    # Emails por conexión SMTP antes de abrir otra (0 = sin límite)
+    app.config['EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION'] = int(os.environ.get('EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION', 100))
+    # Límite de emails por minuto de todos los hilos de envío (0 = sin límite; el proveedor SMTP frena si se supera)
+    app.config['EMAIL_OUTBOX_RATE_PER_MINUTE'] = int(os.environ.get('EMAIL_OUTBOX_RATE_PER_MINUTE', 0))
     
     app.config['SERVER_NAME'] = os.environ.get('FLASK_SERVER_NAME', '127.0.0.1:5000')
     app.template_filter('currency')(format_currency_safe)
@@ -516,4 +537,11 @@ def create_app():
     except Exception as e:
         app.logger.error(f"Error inicializando sistema de filtrado automático: {e}")
 
+    # --- Trabajos y bandeja de salida de un arranque anterior (mismo criterio que el scheduler: no en el proceso del reloader) ---
+    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        from .jobs import fail_interrupted_invoice_generation_jobs
+        fail_interrupted_invoice_generation_jobs(app)
+        from .email_outbox import resume_email_outbox
+        resume_email_outbox(app)
+
     return app
\ No newline at end of file
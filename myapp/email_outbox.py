@@ -0,0 +1,333 @@
+# myapp/email_outbox.py
+"""
+Bandeja de salida de los emails de factura.
+
+Las rutas de envío (individual y masivo) y el envío automático tras generar solo encolan: insertan
+una fila en email_outbox por factura y vuelven enseguida. Un grupo de hilos (EMAIL_OUTBOX_WORKERS)
+vacía la cola: compone cada email al enviarlo (PDF de la caché, plantilla y adjuntos de gastos) y lo
+manda por SMTP con _send_single_invoice_email.
+
+- Un fallo de envío (SEND_ERROR) se reintenta con espera exponencial:
+  EMAIL_OUTBOX_RETRY_BASE_SECONDS * 2^(intento - 1), como mucho EMAIL_OUTBOX_RETRY_MAX_SECONDS,
+  hasta EMAIL_OUTBOX_MAX_ATTEMPTS intentos. Lo que no se arregla reintentando (inquilino sin email,
+  factura inexistente, remitente sin configurar) pasa directamente a 'failed' con el motivo.
+- La cola vive en la base de datos, así que un reinicio no pierde mensajes: create_app reanuda los
+  pendientes, y un mensaje que se quedó en 'sending' (el proceso murió enviándolo) se vuelve a tomar
+  pasados EMAIL_OUTBOX_CLAIM_TIMEOUT_SECONDS.
+- Cada hilo reclama su mensaje con un UPDATE condicionado al estado, así que dos hilos (o dos procesos)
+  nunca envían el mismo.
+- Mientras hay cola, cada hilo reutiliza una sola conexión SMTP (SmtpSession): STARTTLS y login una vez,
+  no por email. Se reconecta si el servidor corta la sesión y, por si el servidor limita los mensajes por
+  conexión, cada EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION emails. Al vaciarse la cola se cierra y se
+  registra el ritmo del lote (emails/s).
+- EMAIL_OUTBOX_RATE_PER_MINUTE limita los emails por minuto de todo el proceso (el proveedor SMTP nos
+  frena si lo superamos). Solo espera el envío SMTP: mientras un hilo espera turno, los demás siguen
+  componiendo (PDF, plantilla) el siguiente mensaje.
+- Un envío masivo encola sus mensajes con un mismo 'lote'; get_batch_progress da los contadores
+  (enviados, fallidos, omitidos, pendientes) que la página consulta mientras se envía.
+"""
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app, g
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.exc import OperationalError
+
+from . import mail
+from .models import db, EmailOutbox, SystemSettings
+
+EMAIL_OUTBOX_WORKERS = 2
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_BASE_SECONDS = 60
+EMAIL_OUTBOX_RETRY_MAX_SECONDS = 3600
+EMAIL_OUTBOX_CLAIM_TIMEOUT_SECONDS = 600
+EMAIL_OUTBOX_POLL_SECONDS = 15
+EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+EMAIL_OUTBOX_RATE_PER_MINUTE = 0 # 0 = sin límite
+
+# Resultados de _send_single_invoice_email que no tiene sentido reintentar
+PERMANENT_FAILURES = {'NO_TENANT', 'NO_EMAIL', 'PDF_ERROR', 'CONFIG_ERROR'}
+
+_wakeup = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+class _RateLimiter:
+    """Reparte los envíos de todos los hilos en turnos de 60/por_minuto segundos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self, por_minuto):
+        if not por_minuto:
+            return
+        with self._lock:
+            ahora = time.monotonic()
+            turno = max(self._next_slot, ahora)
+            self._next_slot = turno + 60.0 / por_minuto
+        if turno > ahora:
+            time.sleep(turno - ahora)
+
+
+_rate_limiter = _RateLimiter()
+
+
+def _config(app, key):
+    return app.config.get(key, globals()[key])
+
+
+def enqueue_invoice_emails(factura_ids, include_bcc_owner=True, user_id=None, lote=None, omitidas=None):
+    """
+    Encola un email por factura, salvo las que ya tienen uno en cola o enviándose (doble clic, reenvíos).
+    Devuelve los EmailOutbox creados.
+    lote: identificador del envío masivo. Con lote, las facturas que ya estaban en cola y las de omitidas
+    ({factura_id: motivo}, p. ej. inquilino sin email) se guardan como 'skipped' para que el progreso
+    del lote cuente todas las facturas seleccionadas.
+    """
+    ids = list(dict.fromkeys(factura_ids))
+    omitidas = dict(omitidas or {})
+    if not ids and not omitidas:
+        return []
+    en_cola = set(db.session.scalars(
+        select(EmailOutbox.factura_id).where(EmailOutbox.factura_id.in_(ids), EmailOutbox.status.in_(('queued', 'sending')))
+    )) if ids else set()
+    nuevos = [EmailOutbox(factura_id=factura_id, include_bcc_owner=include_bcc_owner, user_id=user_id, lote=lote)
+              for factura_id in ids if factura_id not in en_cola]
+    if lote:
+        omitidas.update((factura_id, 'YA_EN_COLA: otro envío de esta factura está pendiente') for factura_id in en_cola)
+        db.session.add_all(EmailOutbox(factura_id=factura_id, include_bcc_owner=include_bcc_owner, user_id=user_id, lote=lote,
+                                       status='skipped', last_error=motivo)
+                           for factura_id, motivo in omitidas.items())
+    db.session.add_all(nuevos)
+    db.session.commit()
+
+    start_email_outbox_workers(current_app._get_current_object())
+    _wakeup.set()
+    current_app.logger.info(f"Bandeja de salida: {len(nuevos)} email(s) de factura encolados, {len(en_cola)} ya estaban en cola.")
+    return nuevos
+
+
+def get_outbox_status(factura_ids=None, limit=100):
+    """Últimos mensajes de la bandeja como dicts serializables. factura_ids: lista o subconsulta de ids (None = todas)."""
+    query = select(EmailOutbox).order_by(EmailOutbox.id.desc()).limit(limit)
+    if factura_ids is not None:
+        query = query.where(EmailOutbox.factura_id.in_(factura_ids))
+    return [mensaje.to_dict() for mensaje in db.session.scalars(query)]
+
+
+def get_batch_progress(lote):
+    """Contadores de un envío masivo como dict serializable, o None si el lote no existe."""
+    filas = db.session.execute(
+        select(EmailOutbox.status, db.func.count(EmailOutbox.id), db.func.min(EmailOutbox.user_id))
+        .where(EmailOutbox.lote == lote).group_by(EmailOutbox.status)
+    ).all()
+    if not filas:
+        return None
+    contadores = {status: 0 for status in ('queued', 'sending', 'sent', 'failed', 'skipped')}
+    contadores.update((status, total) for status, total, _ in filas)
+    return {
+        'lote': lote,
+        'user_id': filas[0][2],
+        'total': sum(contadores.values()),
+        'pending': contadores['queued'] + contadores['sending'],
+        **contadores,
+        'finished': contadores['queued'] + contadores['sending'] == 0,
+    }
+
+
+def start_email_outbox_workers(app):
+    """Arranca los hilos de envío que falten (EMAIL_OUTBOX_WORKERS por proceso)."""
+    with _workers_lock:
+        _workers[:] = [hilo for hilo in _workers if hilo.is_alive()]
+        for i in range(len(_workers), _config(app, 'EMAIL_OUTBOX_WORKERS')):
+            hilo = threading.Thread(target=_worker_loop, args=(app,), name=f'email-outbox-{i}', daemon=True)
+            hilo.start()
+            _workers.append(hilo)
+
+
+def resume_email_outbox(app):
+    """Al arrancar: si quedaron mensajes sin enviar (reinicio a mitad de un envío masivo), arranca los hilos."""
+    with app.app_context():
+        try:
+            pendiente = db.session.scalar(select(EmailOutbox.id).where(EmailOutbox.status.in_(('queued', 'sending'))).limit(1))
+        except OperationalError:
+            app.logger.warning("Tabla email_outbox no existe (falta 'flask db upgrade'). Bandeja de salida no reanudada.")
+            return
+        finally:
+            db.session.remove()
+    if pendiente is not None:
+        app.logger.info("Bandeja de salida: hay emails pendientes de un arranque anterior; reanudando el envío.")
+        start_email_outbox_workers(app)
+
+
+class SmtpSession:
+    """
+    Conexión SMTP de un hilo de envío, abierta con el primer email y reutilizada para los siguientes.
+
+    send(msg) reconecta y reintenta una vez si la sesión se ha caído (el servidor la cerró por inactividad,
+    421, socket roto); un rechazo del propio mensaje (destinatario, contenido) se propaga sin reintentar.
+    Tras max_messages emails se cierra y la siguiente abre otra. Cada envío espera antes su turno del
+    límite EMAIL_OUTBOX_RATE_PER_MINUTE, compartido por todos los hilos. close() registra el ritmo del lote.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.max_messages = _config(app, 'EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION')
+        self.rate_per_minute = _config(app, 'EMAIL_OUTBOX_RATE_PER_MINUTE')
+        self._connection = None
+        self._sent_on_connection = 0
+        self.sent = 0
+        self.connections = 0
+        self.reconnects = 0
+        self._started = None
+
+    def send(self, msg):
+        _rate_limiter.wait(self.rate_per_minute)
+        if self._started is None:
+            self._started = time.perf_counter()
+        for intento in (1, 2):
+            if self._connection is None:
+                self._open()
+            try:
+                self._connection.send(msg)
+            except Exception as e:
+                if intento == 2 or not self._session_lost(e):
+                    self._discard()
+                    raise
+                self.app.logger.info(f"Bandeja de salida: sesión SMTP perdida ({e!r}); reconectando.")
+                self._discard()
+                self.reconnects += 1
+                continue
+            self.sent += 1
+            self._sent_on_connection += 1
+            if self.max_messages and self._sent_on_connection >= self.max_messages:
+                self._quit()
+            return
+
+    def close(self):
+        """Cierra la conexión y registra cuántos emails se enviaron, en cuánto tiempo y con cuántas conexiones."""
+        self._quit()
+        if self.sent:
+            segundos = time.perf_counter() - self._started
+            self.app.logger.info(
+                f"Bandeja de salida ({threading.current_thread().name}): {self.sent} email(s) en {segundos:.1f} s "
+                f"({self.sent / segundos if segundos else 0:.2f} emails/s), {self.connections} conexión(es) SMTP, "
+                f"{self.reconnects} reconexión(es).")
+
+    @staticmethod
+    def _session_lost(error):
+        if isinstance(error, smtplib.SMTPServerDisconnected):
+            return True
+        if isinstance(error, smtplib.SMTPResponseException):
+            return error.smtp_code == 421 # Servicio no disponible: el servidor cierra el canal
+        # Errores de socket (smtplib.SMTPException también hereda de OSError)
+        return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+    def _open(self):
+        connection = mail.connect()
+        self._connection = connection.__enter__() # STARTTLS y login
+        self._sent_on_connection = 0
+        self.connections += 1
+
+    def _quit(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.__exit__(None, None, None) # QUIT
+        except (smtplib.SMTPException, OSError):
+            self._discard()
+        self._connection = None
+
+    def _discard(self):
+        """Suelta la conexión sin QUIT (ya está rota)."""
+        if self._connection is not None and self._connection.host is not None:
+            try:
+                self._connection.host.close()
+            except OSError:
+                pass
+        self._connection = None
+
+
+def _worker_loop(app):
+    while True:
+        _wakeup.clear()
+        smtp = SmtpSession(app)
+        try:
+            while _process_next(app, smtp):
+                pass
+        finally:
+            smtp.close()
+        _wakeup.wait(_config(app, 'EMAIL_OUTBOX_POLL_SECONDS'))
+
+
+def _process_next(app, smtp):
+    """Envía el siguiente mensaje disponible por la sesión SMTP del hilo. Devuelve False si no había ninguno."""
+    try:
+        with app.app_context():
+            outbox_id = _claim_next(app)
+            if outbox_id is None:
+                return False
+            _send(app, outbox_id, smtp)
+            return True
+    except Exception as e:
+        app.logger.error(f"Error en el hilo de la bandeja de salida: {e}", exc_info=True)
+        return False
+
+
+def _claim_next(app):
+    """
+    Marca como 'sending' el siguiente mensaje listo y devuelve su id (None si no hay nada que enviar).
+    Es una sola sentencia UPDATE ... RETURNING: dos hilos no pueden reclamar el mismo mensaje.
+    """
+    ahora = datetime.utcnow()
+    caducado = ahora - timedelta(seconds=_config(app, 'EMAIL_OUTBOX_CLAIM_TIMEOUT_SECONDS'))
+    siguiente = select(EmailOutbox.id).where(or_(
+        and_(EmailOutbox.status == 'queued', EmailOutbox.next_attempt_at <= ahora),
+        and_(EmailOutbox.status == 'sending', EmailOutbox.claimed_at < caducado),
+    )).order_by(EmailOutbox.next_attempt_at, EmailOutbox.id).limit(1).scalar_subquery()
+    outbox_id = db.session.execute(
+        update(EmailOutbox).where(EmailOutbox.id == siguiente)
+        .values(status='sending', claimed_at=ahora, attempts=EmailOutbox.attempts + 1)
+        .returning(EmailOutbox.id)
+    ).scalar()
+    db.session.commit()
+    return outbox_id
+
+
+def _retry_delay(app, attempts):
+    base = _config(app, 'EMAIL_OUTBOX_RETRY_BASE_SECONDS')
+    return min(base * 2 ** (attempts - 1), _config(app, 'EMAIL_OUTBOX_RETRY_MAX_SECONDS'))
+
+
+def _send(app, outbox_id, smtp):
+    # Import diferido: routes.facturas importa este módulo
+    from .routes.facturas import _send_single_invoice_email
+
+    mensaje = db.session.get(EmailOutbox, outbox_id)
+    factura_id, attempts = mensaje.factura_id, mensaje.attempts
+    # La plantilla del email pasa por los context processors de la app, que esperan una request (current_user)
+    with app.test_request_context():
+        # Igual que load_app_settings_to_g, pero fuera de una request real
+        g.settings = db.session.get(SystemSettings, 1)
+        try:
+            resultado, motivo = _send_single_invoice_email(factura_id, include_bcc_owner=mensaje.include_bcc_owner, connection=smtp)
+        except Exception as e:
+            resultado, motivo = 'SEND_ERROR', str(e)
+    db.session.rollback()
+
+    ahora = datetime.utcnow()
+    if resultado == 'SENT':
+        valores = {'status': 'sent', 'sent_at': ahora, 'last_error': None}
+    elif resultado in PERMANENT_FAILURES or attempts >= _config(app, 'EMAIL_OUTBOX_MAX_ATTEMPTS'):
+        valores = {'status': 'failed', 'last_error': f"{resultado}: {motivo}"}
+        app.logger.warning(f"Bandeja de salida: email de la factura {factura_id} fallido tras {attempts} intento(s): {valores['last_error']}")
+    else:
+        espera = _retry_delay(app, attempts)
+        valores = {'status': 'queued', 'last_error': f"{resultado}: {motivo}", 'next_attempt_at': ahora + timedelta(seconds=espera)}
+        app.logger.info(f"Bandeja de salida: email de la factura {factura_id} reintentará en {espera} s (intento {attempts}).")
+    db.session.execute(update(EmailOutbox).where(EmailOutbox.id == outbox_id).values(claimed_at=None, **valores))
+    db.session.commit()
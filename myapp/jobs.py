@@ -0,0 +1,151 @@
+# myapp/jobs.py
+"""
+Trabajos en segundo plano lanzados desde la interfaz web.
+
+La generación mensual de facturas puede tardar (cálculo de rentas, PDFs, emails), así que la
+ruta POST /facturas/generar solo encola el trabajo y devuelve su id; la página consulta el
+progreso en /facturas/generar/estado/<id>.
+
+El estado persistente vive en la tabla invoice_generation_job; los contadores en curso se
+guardan además en memoria (_live_progress) para no escribir en la base de datos por cada contrato.
+Se usa un único hilo: dos generaciones simultáneas competirían por las mismas series de numeración.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app, g
+from sqlalchemy.exc import OperationalError
+
+from .models import db, InvoiceGenerationJob, SystemSettings
+from .utils.calc_trace import get_trace_level
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='invoice-gen')
+_live_progress = {}  # job_id -> {'contracts_processed': int, 'contracts_total': int}
+_live_lock = threading.Lock()
+
+
+def enqueue_invoice_generation(year, month, owner_ids=None, send_emails=False, user_id=None, to_year=None, to_month=None):
+    """
+    Crea el registro del trabajo y lo encola. Devuelve el InvoiceGenerationJob creado.
+    to_year/to_month: último mes del rango en modo recuperación (None = solo year/month).
+    """
+    job = InvoiceGenerationJob(year=year, month=month, to_year=to_year, to_month=to_month, owner_ids=owner_ids,
+                               send_emails=bool(send_emails), user_id=user_id, status='queued',
+                               trace_level=get_trace_level())
+    db.session.add(job)
+    db.session.commit()
+
+    with _live_lock:
+        _live_progress[job.id] = {'contracts_processed': 0, 'contracts_total': 0}
+
+    app = current_app._get_current_object()
+    _executor.submit(_run_invoice_generation_job, app, job.id)
+    current_app.logger.info(f"Trabajo de generación #{job.id} encolado ({month}/{year}, propietarios: {owner_ids or 'todos'}).")
+    return job
+
+
+def _run_invoice_generation_job(app, job_id):
+    # Import diferido: routes.facturas importa este módulo
+    from .routes.facturas import run_monthly_generation
+
+    with app.app_context():
+        job = db.session.get(InvoiceGenerationJob, job_id)
+        if not job:
+            app.logger.error(f"Trabajo de generación #{job_id} no encontrado al iniciarse.")
+            return
+        job.status = 'running'
+        job.started_at = datetime.utcnow()
+        db.session.commit()
+
+        def progress(processed, total):
+            with _live_lock:
+                _live_progress[job_id] = {'contracts_processed': processed, 'contracts_total': total}
+
+        try:
+            # Igual que load_app_settings_to_g, pero fuera de una request
+            g.settings = db.session.get(SystemSettings, 1)
+            result = run_monthly_generation(job.year, job.month, owner_ids=job.owner_ids,
+                                            send_emails_auto=job.send_emails, progress_callback=progress,
+                                            to_year=job.to_year, to_month=job.to_month,
+                                            job_id=job_id, trace_level=job.trace_level)
+            job = db.session.get(InvoiceGenerationJob, job_id)
+            live = _live_progress.get(job_id, {})
+            job.status = 'done'
+            job.contracts_total = live.get('contracts_total', 0)
+            job.contracts_processed = live.get('contracts_processed', 0)
+            job.invoices_created = result['nuevas']
+            job.invoices_skipped = result['omitidas']
+            job.invoice_ids = result['factura_ids']
+            job.errors = result['errores']
+            job.messages = result['messages']
+        except Exception as e:
+            app.logger.error(f"Error en trabajo de generación #{job_id}: {e}", exc_info=True)
+            db.session.rollback()
+            job = db.session.get(InvoiceGenerationJob, job_id)
+            job.status = 'failed'
+            job.messages = [{"category": "danger", "message": f"Error inesperado generando facturas: {e}"}]
+        finally:
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            with _live_lock:
+                _live_progress.pop(job_id, None)
+            db.session.remove()
+
+
+def fail_interrupted_invoice_generation_jobs(app):
+    """
+    Al arrancar: los trabajos que quedaron en cola o en curso los ejecutaba un proceso que ya no existe
+    y no van a terminar; se marcan como fallidos para que la página deje de esperarlos.
+    """
+    with app.app_context():
+        try:
+            with _live_lock:
+                en_curso = set(_live_progress)
+            interrumpidos = []
+            for job in InvoiceGenerationJob.query.filter(InvoiceGenerationJob.status.in_(('queued', 'running'))):
+                if job.id in en_curso:
+                    continue
+                job.status = 'failed'
+                job.finished_at = datetime.utcnow()
+                job.messages = [{"category": "danger", "message": "El trabajo se interrumpió (reinicio del servidor). Vuelve a lanzar la generación."}]
+                interrumpidos.append(job.id)
+            db.session.commit()
+        except OperationalError:
+            app.logger.warning("Tabla invoice_generation_job no existe (falta 'flask db upgrade'). Trabajos interrumpidos no revisados.")
+            return
+        finally:
+            db.session.remove()
+    if interrumpidos:
+        app.logger.warning(f"Trabajos de generación interrumpidos por un reinicio marcados como fallidos: {interrumpidos}")
+
+
+def get_invoice_generation_progress(job_id):
+    """Estado de un trabajo como dict serializable, o None si no existe."""
+    job = db.session.get(InvoiceGenerationJob, job_id)
+    if not job:
+        return None
+
+    with _live_lock:
+        live = _live_progress.get(job_id)
+        if job.status in ('queued', 'running') and live is None:
+            # El hilo acaba de terminar (guardó el resultado y quitó el progreso en memoria): releer la fila
+            db.session.refresh(job)
+
+    processed = live['contracts_processed'] if live else job.contracts_processed
+    total = live['contracts_total'] if live else job.contracts_total
+    return {
+        'job_id': job.id,
+        'user_id': job.user_id,
+        'status': job.status,
+        'year': job.year,
+        'month': job.month,
+        'to_year': job.to_year,
+        'to_month': job.to_month,
+        'contracts_processed': processed or 0,
+        'contracts_total': total or 0,
+        'invoices_created': job.invoices_created or 0,
+        'invoices_skipped': job.invoices_skipped or 0,
+        'messages': job.messages or [],
+        'finished': job.status in ('done', 'failed'),
+    }
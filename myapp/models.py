@@ -239,6 +239,8 @@ class Factura(db.Model):
     irpf_rate_applied = db.Column(Numeric(5, 4), nullable=True) # Ej: 0.19, 0.07, 0.00
     indice_aplicado_info = db.Column(db.JSON, nullable=True) # Almacena {'type': 'IPC', 'month': 11, 'year': 2024, 'percentage': 3.5}
     # -------------------------------------------------------------
+    # Comprobación "¿ya existe factura de este contrato en este mes?" (generación y tareas programadas)
+    __table_args__ = (db.Index('ix_factura_contrato_id_fecha_emision', 'contrato_id', 'fecha_emision'),)
     @property
     def items(self):
         try: return json.loads(self.items_json or '[]')
@@ -345,6 +347,8 @@ class Gasto(db.Model):
     year = db.Column(db.Integer, nullable=True)
     filename = db.Column(db.String(200), nullable=False, unique=True)
     original_filename = db.Column(db.String(200), nullable=False)
+    file_path = db.Column(db.String(1024), nullable=True) # Ruta absoluta en disco, guardada al subir (None en gastos antiguos)
+    mime_type = db.Column(db.String(100), nullable=True) # Tipo MIME del fichero, para adjuntarlo al email
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
     integrated = db.Column(db.Boolean, default=False, nullable=False) # Redundante si usamos 'estado'
     estado = db.Column(db.String(20), nullable=False, default='Pendiente', index=True)  # Pendiente | Facturado
@@ -360,6 +364,8 @@ class Notification(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     related_url = db.Column(db.String(255), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=True, index=True)
+    # Clave de las notificaciones automáticas (tasks.py), p. ej. 'expiring:<contrato>:<semana>:<usuario>'; NULL en las manuales
+    dedupe_key = db.Column(db.String(200), nullable=True, unique=True, index=True)
     # user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True) # Asociar a usuario si es necesario
     def __repr__(self): return f'<Notification {self.id} [{self.level}] Read: {self.is_read}>'
 
@@ -429,4 +435,111 @@ class HistorialActualizacionRenta(db.Model):
     factura = db.relationship('Factura', backref=db.backref('actualizacion_renta_origen', uselist=False))
 
     def __repr__(self):
-        return f'<HistorialActualizacionRenta {self.id} Contrato {self.contrato_id}: {self.renta_anterior}->{self.renta_nueva}>'        
\ No newline at end of file
+        return f'<HistorialActualizacionRenta {self.id} Contrato {self.contrato_id}: {self.renta_anterior}->{self.renta_nueva}>'        
+
+class InvoiceGenerationJob(db.Model):
+    """Ejecución en segundo plano de la generación mensual de facturas (ver myapp/jobs.py)."""
+    __tablename__ = 'invoice_generation_job'
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True) # queued | running | done | failed
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    to_year = db.Column(db.Integer, nullable=True)  # Último mes del rango (modo recuperación); NULL = solo year/month
+    to_month = db.Column(db.Integer, nullable=True)
+    send_emails = db.Column(db.Boolean, nullable=False, default=False)
+    owner_ids = db.Column(db.JSON, nullable=True) # Propietarios a los que se limita; NULL = todos
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    contracts_total = db.Column(db.Integer, nullable=False, default=0)
+    contracts_processed = db.Column(db.Integer, nullable=False, default=0)
+    invoices_created = db.Column(db.Integer, nullable=False, default=0)
+    invoices_skipped = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.JSON, nullable=True)       # Lista de errores/advertencias de la ejecución
+    invoice_ids = db.Column(db.JSON, nullable=True)  # IDs de las facturas creadas
+    messages = db.Column(db.JSON, nullable=True)     # [{category, message}] para mostrar en la página de generación
+    trace_level = db.Column(db.String(10), nullable=True) # INVOICE_TRACE_LEVEL con el que se ejecutó (off | summary | full)
+
+    user = db.relationship('User')
+    traces = db.relationship('InvoiceCalculationTrace', backref='job', lazy='dynamic', cascade='all, delete-orphan')
+
+    def __repr__(self):
+        return f'<InvoiceGenerationJob {self.id} {self.month}/{self.year} [{self.status}]>'
+
+class InvoiceSeriesCounter(db.Model):
+    """
+    Último número usado de cada serie de facturación y año (ver myapp/utils/invoice_series.py).
+    series_key: 'C<contrato_id>' para la serie de un contrato; el prefijo 'MAN-...' para facturas manuales.
+    """
+    __tablename__ = 'invoice_series_counter'
+    series_key = db.Column(db.String(100), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    last_number = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<InvoiceSeriesCounter {self.series_key}/{self.year}: {self.last_number}>'
+
+class InvoiceCalculationTrace(db.Model):
+    """Traza del cálculo de un contrato y mes en una generación con INVOICE_TRACE_LEVEL='full' (ver myapp/utils/calc_trace.py)."""
+    __tablename__ = 'invoice_calculation_trace'
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('invoice_generation_job.id', ondelete='CASCADE'), nullable=True)
+    contrato_id = db.Column(db.Integer, db.ForeignKey('contrato.id', ondelete='CASCADE'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    factura_id = db.Column(db.Integer, db.ForeignKey('factura.id', ondelete='SET NULL'), nullable=True)
+    outcome = db.Column(db.String(20), nullable=False) # creada | existente | error
+    renta_anterior = db.Column(Numeric(10, 2), nullable=True)
+    renta_nueva = db.Column(Numeric(10, 2), nullable=True)
+    events = db.Column(db.JSON, nullable=False, default=list) # [{'step': ..., datos}] en orden
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (db.Index('ix_invoice_calculation_trace_job_id_contrato_id', 'job_id', 'contrato_id'),)
+
+    def to_dict(self):
+        return {
+            'contrato_id': self.contrato_id, 'year': self.year, 'month': self.month, 'factura_id': self.factura_id,
+            'outcome': self.outcome, 'events': self.events or [],
+            'renta_anterior': str(self.renta_anterior) if self.renta_anterior is not None else None,
+            'renta_nueva': str(self.renta_nueva) if self.renta_nueva is not None else None,
+        }
+
+    def __repr__(self):
+        return f'<InvoiceCalculationTrace job={self.job_id} contrato={self.contrato_id} {self.month}/{self.year} [{self.outcome}]>'
+
+class EmailOutbox(db.Model):
+    """
+    Email de factura pendiente de enviar (ver myapp/email_outbox.py). Solo guarda la factura y las opciones:
+    el mensaje (PDF, plantilla y adjuntos) se compone al enviarlo.
+    """
+    __tablename__ = 'email_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    factura_id = db.Column(db.Integer, db.ForeignKey('factura.id', ondelete='CASCADE'), nullable=False, index=True)
+    include_bcc_owner = db.Column(db.Boolean, nullable=False, default=True)
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued | sending | sent | failed | skipped
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False) # No se envía antes (espera entre reintentos)
+    claimed_at = db.Column(db.DateTime, nullable=True) # Cuándo lo tomó un hilo de envío (status 'sending')
+    last_error = db.Column(db.Text, nullable=True) # Motivo del último fallo ('NO_EMAIL: ...', 'SEND_ERROR: ...')
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    lote = db.Column(db.String(32), nullable=True, index=True) # Envío masivo al que pertenece (para consultar su progreso)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    factura = db.relationship('Factura', backref=db.backref('envios_email', lazy='select', cascade='all, delete-orphan', passive_deletes=True))
+
+    __table_args__ = (db.Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+    def to_dict(self):
+        return {
+            'id': self.id, 'factura_id': self.factura_id, 'status': self.status, 'attempts': self.attempts,
+            'last_error': self.last_error, 'lote': self.lote,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at and self.status == 'queued' else None,
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None,
+        }
+
+    def __repr__(self):
+        return f'<EmailOutbox {self.id} factura={self.factura_id} [{self.status}] intentos={self.attempts}>'
\ No newline at end of file
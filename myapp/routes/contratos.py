@@ -21,13 +21,14 @@ from ..decorators import (
 )
 # --------------------------
 
-from ..models import db, Contrato, Propiedad, Inquilino, Documento, Propietario, HistorialActualizacionRenta
+from ..models import db, Contrato, Propiedad, Inquilino, Documento, Propietario, HistorialActualizacionRenta, InvoiceCalculationTrace
 from ..utils.file_helpers import get_owner_document_path
 from ..utils.database_helpers import (
     get_filtered_contratos, get_filtered_propiedades, get_filtered_inquilinos,
     OwnerFilteredQueries
 )
 from ..utils.owner_session import get_active_owner_context
+from ..utils.invoice_series import sync_contract_series_counter, delete_series_counters, contract_series_key
 
 from ..forms import CSRFOnlyForm 
 
@@ -341,6 +342,7 @@ def add_contrato():
         )
         db.session.add(new_contract)
         db.session.flush() 
+        sync_contract_series_counter(new_contract)
 
         archivos_seleccionados_para_vincular = [f for f in files_from_form if f and f.filename] # Solo necesitamos que tengan nombre
         if new_contract.id and archivos_seleccionados_para_vincular:
@@ -518,6 +520,7 @@ def edit_contrato(id):
         else: 
             contract.serie_facturacion_prefijo = None; contract.serie_facturacion_ultimo_numero = 0
             contract.serie_facturacion_ano_actual = None; contract.serie_facturacion_formato_digitos = 4
+        sync_contract_series_counter(contract)
 
         # --- REGISTRAR CAMBIO MANUAL DE RENTA ---
         # Si el precio nuevo del formulario es diferente al precio que tenía el contrato ANTES de esta edición,
@@ -526,7 +529,7 @@ def edit_contrato(id):
             # Solo registrar como manual si el TIPO de actualización es manual
             # O si no se han proporcionado datos para otros tipos de actualización automática
             # que podrían haber sido la causa del cambio de precio.
-            # La lógica actual de _calculate_updated_rent_for_invoice es la que crea el historial para IPC/Fijo.
+            # La lógica actual de calculate_rent (utils/rent_engine.py) es la que crea el historial para IPC/Fijo.
             # Aquí, solo registramos si el tipo es explícitamente manual o si el cambio es "puramente manual".
             
             # Condición: si el precio cambió Y el tipo de actualización del contrato es manual
@@ -623,6 +626,8 @@ def delete_contrato(id):
         # Eliminar el contrato. Si cascade="all, delete-orphan" está en Contrato.facturas
         # y Contrato.documentos, esos registros relacionados también se eliminarán.
         db.session.delete(contract)
+        delete_series_counters(contract_series_key(id))
+        InvoiceCalculationTrace.query.filter_by(contrato_id=id).delete(synchronize_session=False)
         current_app.logger.info(f"Contrato ID: {id} marcado para eliminar de la BD.")
 
         # Actualizar estado de la propiedad si el contrato eliminado era el único activo
@@ -8,14 +8,16 @@ import uuid
 import io
 import traceback
 import re
+import time
+from typing import Optional
 
 from flask import (
     Blueprint, render_template, request, redirect, url_for,
     flash, abort, current_app, jsonify, g, send_from_directory,
-    send_file
+    send_file, Response, stream_with_context
 )
 from werkzeug.exceptions import NotFound # Importar para manejo de errores
-from sqlalchemy import func, or_, extract
+from sqlalchemy import or_, extract
 from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import joinedload, selectinload
 from werkzeug.utils import secure_filename
@@ -23,11 +25,26 @@ from flask_mail import Message
 
 from ..models import (
     db, Factura, Inquilino, Propiedad, Contrato, Gasto, Propietario,
-    IPCData, IRAVData, DEFAULT_IVA_RATE, DEFAULT_IRPF_RATE, SystemSettings, Notification, User, HistorialActualizacionRenta
+    IPCData, IRAVData, DEFAULT_IVA_RATE, DEFAULT_IRPF_RATE, SystemSettings, Notification, User, HistorialActualizacionRenta,
+    InvoiceCalculationTrace, InvoiceGenerationJob
 )
 from .ipc import MESES_STR # Asumiendo que ipc.py existe y tiene MESES_STR
 from ..utils.file_helpers import get_owner_document_path
-from ..utils.pdf_generator import generate_invoice_pdf # O la v2 que prefieras
+from ..utils.expense_files import (
+    EXPENSE_SUBFOLDER, expense_disk_filename, expense_file_path, expense_mime_type, get_expense_file_cache,
+    guess_expense_mime_type, read_expense_file
+)
+from ..utils.pdf_generator import (
+    snapshot_invoice_for_render, render_invoice_pdfs_parallel, load_invoices_for_pdf, get_invoice_pdf_settings
+)
+from ..utils.pdf_cache import (
+    get_invoice_pdf, get_invoice_pdf_cache, invoice_pdf_key, invoice_pdf_cache_key, discard_invoice_pdf
+)
+from ..utils.pdf_bundle import stream_invoice_zip, stream_merged_pdf
+from ..utils.rent_engine import IndexLookup, ContractSnapshot, calculate_rent
+from ..utils.calc_trace import CalcTrace, get_trace_level
+from ..utils.invoice_series import SeriesReservation, contract_series_key, allocate_series_numbers, sync_contract_series_counter
+from ..utils.savepoint_session import savepoint_session
 from ..forms import CSRFOnlyForm
 from .. import mail
 from flask_login import login_required, current_user
@@ -40,6 +57,8 @@ from ..utils.database_helpers import (
     get_filtered_inquilinos, OwnerFilteredQueries
 )
 from ..utils.owner_session import get_active_owner_context
+from ..jobs import enqueue_invoice_generation, get_invoice_generation_progress
+from ..email_outbox import enqueue_invoice_emails, get_batch_progress, get_outbox_status
 
 
 
@@ -54,6 +73,7 @@ def before_request():
 # --- Constantes y Helpers ---
 TWO_PLACES = Decimal('0.01')
 ALLOWED_EXTENSIONS_EXPENSES = {'pdf', 'png', 'jpg', 'jpeg', 'gif'}
+MAX_GENERATION_RANGE_MONTHS = 24 # Meses como máximo por generación en modo recuperación
 MESES_STR = ["", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
 
 def allowed_expense_file(filename: str) -> bool:
@@ -79,246 +99,13 @@ def get_rates():
 def last_day_of_month(year: int, month: int) -> int:
     return calendar.monthrange(year, month)[1]    
 
-def _calculate_updated_rent_for_invoice(contract: Contrato, target_year: int, target_month: int, current_base_rent: Decimal):
-    log_info = []
-    conceptos_adicionales = []
-    info_indice_aplicado_para_factura = None 
-    
-    renta_para_linea_principal_alquiler = current_base_rent
-    nueva_renta_contrato_a_persistir_calculada = current_base_rent 
-    indice_pendiente_valor_raw = None 
-
-    # --- 1. MANEJO DE ÍNDICES PENDIENTES (SI `aplicar_indice_retroactivo` ES TRUE) ---
-    if contract.aplicar_indice_retroactivo and \
-       contract.indice_pendiente_mes and contract.indice_pendiente_ano and contract.indice_pendiente_tipo and \
-       contract.renta_base_pre_actualizacion_pendiente is not None:
-
-        log_info.append(f"Intentando resolver índice pendiente: {contract.indice_pendiente_tipo} de {contract.indice_pendiente_mes}/{contract.indice_pendiente_ano} sobre base {contract.renta_base_pre_actualizacion_pendiente}.")
-        db_model_to_query = IPCData if contract.indice_pendiente_tipo == 'IPC' else IRAVData if contract.indice_pendiente_tipo == 'IRAV' else None
-        
-        if db_model_to_query:
-            indice_pendiente_valor_raw = db.session.query(db_model_to_query.percentage_change)\
-                                        .filter_by(year=contract.indice_pendiente_ano, month=contract.indice_pendiente_mes)\
-                                        .scalar()
-            if indice_pendiente_valor_raw is not None:
-                log_info.append(f"RESOLVIENDO PENDIENTE: Índice {contract.indice_pendiente_tipo} ({contract.indice_pendiente_mes}/{contract.indice_pendiente_ano}) DISPONIBLE: {indice_pendiente_valor_raw}%.")
-                renta_base_del_periodo_pendiente = contract.renta_base_pre_actualizacion_pendiente
-                pct_pendiente = (Decimal(str(indice_pendiente_valor_raw)) / Decimal('100')).quantize(Decimal('0.000001'), rounding=ROUND_HALF_UP)
-                incremento_del_indice_pendiente_mensual = (renta_base_del_periodo_pendiente * pct_pendiente).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                incremento_del_fijo_pendiente_una_vez = Decimal('0.00')
-                
-                info_indice_aplicado_para_factura = {
-                    'type': contract.indice_pendiente_tipo,
-                    'month': contract.indice_pendiente_mes,
-                    'year': contract.indice_pendiente_ano, # Año del índice
-                    'percentage': float(indice_pendiente_valor_raw)
-                }
-
-                if incremento_del_indice_pendiente_mensual != Decimal('0.00'):
-                    conceptos_adicionales.append({
-                        "description": f"Aplic. Act. Pendiente ({contract.indice_pendiente_mes}/{contract.indice_pendiente_ano}): {contract.indice_pendiente_tipo} s/ {renta_base_del_periodo_pendiente:.2f}",
-                        "quantity": 1, "unitPrice": float(incremento_del_indice_pendiente_mensual), "total": float(incremento_del_indice_pendiente_mensual)
-                    })
-                    log_info.append(f"Añadido concepto por aplicación de índice pendiente ({contract.indice_pendiente_tipo}) este mes: {incremento_del_indice_pendiente_mensual}")
-
-                if contract.tipo_actualizacion_renta == 'indice_mas_fijo' and contract.importe_actualizacion_fija is not None:
-                    incremento_del_fijo_pendiente_una_vez = contract.importe_actualizacion_fija.quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                    if incremento_del_fijo_pendiente_una_vez != Decimal('0.00'):
-                        conceptos_adicionales.append({
-                            "description": f"Aplic. Act. Fija Pendiente ({contract.importe_actualizacion_fija:.2f})",
-                            "quantity": 1, "unitPrice": float(incremento_del_fijo_pendiente_una_vez), "total": float(incremento_del_fijo_pendiente_una_vez)
-                        })
-                        log_info.append(f"Añadido concepto por aplicación de fijo pendiente (una vez): {incremento_del_fijo_pendiente_una_vez}")
-                
-                nueva_renta_contrato_a_persistir_calculada = (renta_base_del_periodo_pendiente + incremento_del_indice_pendiente_mensual + incremento_del_fijo_pendiente_una_vez).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                renta_para_linea_principal_alquiler = renta_base_del_periodo_pendiente
-                log_info.append(f"Nueva base contrato a persistir: {nueva_renta_contrato_a_persistir_calculada}. Renta para línea alquiler este mes: {renta_para_linea_principal_alquiler}")
-
-                if contract.indice_pendiente_ano_original_aplicacion and contract.indice_pendiente_mes_original_aplicacion:
-                    fecha_inicio_efectiva_actualizacion = date(contract.indice_pendiente_ano_original_aplicacion, contract.indice_pendiente_mes_original_aplicacion, 1)
-                    fecha_factura_actual_obj = date(target_year, target_month, 1)
-                    meses_atraso = 0
-                    temp_date_atraso = fecha_inicio_efectiva_actualizacion
-                    while temp_date_atraso < fecha_factura_actual_obj:
-                        meses_atraso += 1
-                        m_temp, y_temp = (temp_date_atraso.month + 1, temp_date_atraso.year) if temp_date_atraso.month < 12 else (1, temp_date_atraso.year + 1)
-                        temp_date_atraso = date(y_temp, m_temp, 1)
-
-                    if meses_atraso > 0 and incremento_del_indice_pendiente_mensual != Decimal('0.00'):
-                        total_atrasos_indice = (incremento_del_indice_pendiente_mensual * meses_atraso).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                        conceptos_adicionales.append({
-                            "description": f"Atrasos act. {contract.indice_pendiente_tipo} ({incremento_del_indice_pendiente_mensual:.2f}/mes) - {meses_atraso} mes(es)",
-                            "quantity": 1, "unitPrice": float(total_atrasos_indice), "total": float(total_atrasos_indice)
-                        })
-                        log_info.append(f"ATRASOS ÍNDICE ({contract.indice_pendiente_mes}/{contract.indice_pendiente_ano}): {meses_atraso} meses. Total: {total_atrasos_indice}.")
-                else:
-                    log_info.append("ADVERTENCIA: No se pudieron calcular atrasos (faltan fechas originales de aplic. del índice pendiente).")
-
-                contract.indice_pendiente_mes = None; contract.indice_pendiente_ano = None; contract.indice_pendiente_tipo = None
-                contract.renta_base_pre_actualizacion_pendiente = None
-                contract.indice_pendiente_mes_original_aplicacion = None; contract.indice_pendiente_ano_original_aplicacion = None
-            else: # El índice pendiente SIGUE sin estar disponible
-                renta_para_linea_principal_alquiler = contract.renta_base_pre_actualizacion_pendiente 
-                nueva_renta_contrato_a_persistir_calculada = contract.renta_base_pre_actualizacion_pendiente
-                log_info.append(f"Índice {contract.indice_pendiente_tipo} ({contract.indice_pendiente_mes}/{contract.indice_pendiente_ano}) PENDIENTE y AÚN NO disponible. Facturando con renta guardada: {renta_para_linea_principal_alquiler}.")
-        else: # No se pudo determinar db_model_to_query
-            log_info.append(f"ADVERTENCIA: Tipo de índice pendiente '{contract.indice_pendiente_tipo}' no reconocido. No se puede resolver pendiente.")
-            if contract.renta_base_pre_actualizacion_pendiente is not None:
-                 renta_para_linea_principal_alquiler = contract.renta_base_pre_actualizacion_pendiente
-                 nueva_renta_contrato_a_persistir_calculada = contract.renta_base_pre_actualizacion_pendiente
-    
-    # --- 2. LÓGICA DE ACTUALIZACIÓN PERIÓDICA (ANUAL, etc., para ESTE mes) ---
-    renta_base_para_actualizacion_periodica = nueva_renta_contrato_a_persistir_calculada
-    
-    es_mes_aniversario_contrato = (target_month == contract.fecha_inicio.month)
-    
-    # Condición final para aplicar actualización periódica de índice:
-    # 1. Es el mes de aniversario del contrato.
-    # 2. Ha pasado al menos un año desde el inicio del contrato (target_year > inicio.year O (mismo año Y target_month > inicio.month))
-    # 3. El año de la factura actual (target_year) es igual o mayor que el año de inicio de IPC configurado en el contrato.
-    debe_intentar_actualizacion_periodica_indice = \
-        es_mes_aniversario_contrato and \
-        (target_year > contract.fecha_inicio.year or \
-         (target_year == contract.fecha_inicio.year and target_month > contract.fecha_inicio.month)) and \
-        (contract.ipc_ano_inicio is not None and target_year >= contract.ipc_ano_inicio)
-
-    log_info.append(f"Chequeo Act. Periódica: MesAniversario={es_mes_aniversario_contrato}, "
-                    f"TargetYear({target_year}) >= IpcAnoInicio({contract.ipc_ano_inicio if contract.ipc_ano_inicio else 'N/A'}), "
-                    f"Cond. Completa={debe_intentar_actualizacion_periodica_indice}")
-
-    incremento_indice_periodico_este_mes = Decimal('0.00')
-    incremento_fijo_periodico_este_mes = Decimal('0.00')
-    descripcion_indice_periodico_este_mes = ""
-
-    # Solo procesar actualización periódica si NO hay un índice pendiente activo
-    if not (contract.indice_pendiente_mes and contract.indice_pendiente_ano): 
-        if debe_intentar_actualizacion_periodica_indice:
-            # A. Actualización Periódica por ÍNDICE
-            if contract.tipo_actualizacion_renta in ['indice', 'indice_mas_fijo'] and \
-               (contract.actualiza_ipc or contract.actualiza_irav) and \
-               contract.ipc_mes_inicio: # Ya no necesitamos contract.ipc_ano_inicio aquí porque se usó arriba
-                
-                index_model_periodico = IPCData if contract.actualiza_ipc else IRAVData
-                index_name_periodico = "IPC" if contract.actualiza_ipc else "IRAV"
-                mes_indice_referencia_contrato = contract.ipc_mes_inicio 
-                
-                # Corrección Lógica del Año del Índice a Consultar
-                ano_indice_a_consultar = target_year
-                if mes_indice_referencia_contrato > target_month:
-                    ano_indice_a_consultar = target_year - 1
-                elif mes_indice_referencia_contrato == target_month: # Si el índice es del mismo mes que la factura, se usa el del año anterior
-                    ano_indice_a_consultar = target_year - 1
-                
-                log_info.append(f"Intento Act. Periódica: target_year={target_year}, target_month={target_month}, mes_indice_ref_contrato={mes_indice_referencia_contrato} => ano_indice_a_consultar={ano_indice_a_consultar}")
-
-                if not (1 <= mes_indice_referencia_contrato <= 12):
-                    log_info.append(f"Error: Mes de referencia del índice ({mes_indice_referencia_contrato}) en contrato no es válido.");
-                else:
-                    indice_periodico_valor_raw = db.session.query(index_model_periodico.percentage_change)\
-                                                 .filter_by(year=ano_indice_a_consultar, month=mes_indice_referencia_contrato)\
-                                                 .scalar()
-
-                    if indice_periodico_valor_raw is not None:
-                        pct_periodico = (Decimal(str(indice_periodico_valor_raw)) / Decimal('100')).quantize(Decimal('0.000001'), rounding=ROUND_HALF_UP)
-                        incremento_indice_periodico_este_mes = (renta_base_para_actualizacion_periodica * pct_periodico).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                        descripcion_indice_periodico_este_mes = f"Actualización {index_name_periodico} ({mes_indice_referencia_contrato}/{ano_indice_a_consultar})"
-                        log_info.append(f"ACT. PERIÓDICA ÍNDICE ({MESES_STR[target_month]}/{target_year}): {descripcion_indice_periodico_este_mes}. Incremento: {incremento_indice_periodico_este_mes} sobre base {renta_base_para_actualizacion_periodica}.")
-                        
-                        if info_indice_aplicado_para_factura is None: # Solo si no se resolvió uno pendiente antes
-                            info_indice_aplicado_para_factura = {
-                                'type': index_name_periodico,
-                                'month': mes_indice_referencia_contrato,
-                                'year': ano_indice_a_consultar, 
-                                'percentage': float(indice_periodico_valor_raw)
-                            }
-                    else: 
-                        if contract.aplicar_indice_retroactivo:
-                            if not (contract.indice_pendiente_tipo and contract.indice_pendiente_mes and contract.indice_pendiente_ano):
-                                contract.renta_base_pre_actualizacion_pendiente = renta_base_para_actualizacion_periodica
-                                contract.indice_pendiente_mes = mes_indice_referencia_contrato 
-                                contract.indice_pendiente_ano = ano_indice_a_consultar       
-                                contract.indice_pendiente_tipo = index_name_periodico
-                                contract.indice_pendiente_mes_original_aplicacion = target_month 
-                                contract.indice_pendiente_ano_original_aplicacion = target_year  
-                                log_info.append(f"ACT. PERIÓDICA ÍNDICE: {index_name_periodico} ({mes_indice_referencia_contrato}/{ano_indice_a_consultar}) NO disponible. MARCADO COMO PENDIENTE.")
-                            else:
-                                log_info.append(f"ACT. PERIÓDICA ÍNDICE: {index_name_periodico} ({mes_indice_referencia_contrato}/{ano_indice_a_consultar}) NO disponible, pero YA EXISTE OTRO ÍNDICE PENDIENTE.")
-                        
-                        elif getattr(g, 'settings', SystemSettings()).generate_invoice_if_index_missing:
-                            log_info.append(f"ADVERTENCIA (ACT. PERIÓDICA): {index_name_periodico} ({mes_indice_referencia_contrato}/{ano_indice_a_consultar}) no encontrado. Factura sin este incremento (config lo permite).")
-                        else: 
-                            raise ValueError(f"Índice periódico {index_name_periodico} ({mes_indice_referencia_contrato}/{ano_indice_a_consultar}) no encontrado y config no permite generar factura ni aplicar retroactivamente.")
-            
-            # B. Actualización Periódica por IMPORTE FIJO
-            es_aniversario_real_posterior_al_inicio_para_fijo = (target_month == contract.fecha_inicio.month) and \
-                                                               (target_year > contract.fecha_inicio.year or \
-                                                               (target_year == contract.fecha_inicio.year and target_month > contract.fecha_inicio.month))
-            
-            es_mes_aplicacion_fija_valida = (es_aniversario_real_posterior_al_inicio_para_fijo or \
-                                     (contract.mes_aplicacion_fija is not None and \
-                                      target_month == contract.mes_aplicacion_fija and \
-                                      (target_year > contract.fecha_inicio.year or \
-                                       (target_year == contract.fecha_inicio.year and target_month >= contract.fecha_inicio.month))
-                                     )
-                                    )
-
-            if contract.tipo_actualizacion_renta in ['fijo', 'indice_mas_fijo'] and \
-               contract.importe_actualizacion_fija is not None and es_mes_aplicacion_fija_valida:
-                
-                aplicar_fijo_periodico_ahora = not (contract.tipo_actualizacion_renta == 'indice_mas_fijo' and contract.aplicar_indice_retroactivo and indice_pendiente_valor_raw is not None and 'incremento_del_fijo_pendiente_una_vez' in locals() and locals().get('incremento_del_fijo_pendiente_una_vez', Decimal('0.00')) != Decimal('0.00'))
-                
-                if aplicar_fijo_periodico_ahora:
-                    incremento_fijo_periodico_este_mes = contract.importe_actualizacion_fija.quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                    log_info.append(f"ACT. PERIÓDICA FIJA ({MESES_STR[target_month]}/{target_year}): Aplicando incremento: {incremento_fijo_periodico_este_mes} sobre base {renta_base_para_actualizacion_periodica}.")
-
-    # --- Añadir conceptos de actualización periódica de ESTE MES (si los hubo y no hay pendiente activo) ---
-    if not (contract.indice_pendiente_mes and contract.indice_pendiente_ano and \
-            contract.renta_base_pre_actualizacion_pendiente == renta_base_para_actualizacion_periodica and \
-            contract.indice_pendiente_mes_original_aplicacion == target_month and \
-            contract.indice_pendiente_ano_original_aplicacion == target_year): 
-
-        if incremento_indice_periodico_este_mes != Decimal('0.00'):
-            conceptos_adicionales.append({
-                "description": descripcion_indice_periodico_este_mes,
-                "quantity": 1, "unitPrice": float(incremento_indice_periodico_este_mes), "total": float(incremento_indice_periodico_este_mes)
-            })
-            nueva_renta_contrato_a_persistir_calculada = (nueva_renta_contrato_a_persistir_calculada + incremento_indice_periodico_este_mes).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-
-        if incremento_fijo_periodico_este_mes != Decimal('0.00'):
-            conceptos_adicionales.append({
-                "description": f"Actualización Renta Importe Fijo ({MESES_STR[target_month]}/{target_year})",
-                "quantity": 1, "unitPrice": float(incremento_fijo_periodico_este_mes), "total": float(incremento_fijo_periodico_este_mes)
-            })
-            nueva_renta_contrato_a_persistir_calculada = (nueva_renta_contrato_a_persistir_calculada + incremento_fijo_periodico_este_mes).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-
-    # Determinar si la renta del contrato realmente cambió para persistir
-    nueva_renta_contrato_a_persistir_final = None
-    if nueva_renta_contrato_a_persistir_calculada.compare(current_base_rent) != Decimal('0'):
-        nueva_renta_contrato_a_persistir_final = nueva_renta_contrato_a_persistir_calculada
-    
-    # Caso especial: Si se marcó un índice como pendiente EN ESTE CICLO
-    if contract.aplicar_indice_retroactivo and \
-       contract.indice_pendiente_mes and contract.indice_pendiente_ano and \
-       contract.renta_base_pre_actualizacion_pendiente is not None and \
-       contract.indice_pendiente_mes_original_aplicacion == target_month and \
-       contract.indice_pendiente_ano_original_aplicacion == target_year:
-        renta_para_linea_principal_alquiler = contract.renta_base_pre_actualizacion_pendiente
-        if nueva_renta_contrato_a_persistir_final is not None and \
-           nueva_renta_contrato_a_persistir_final.compare(contract.renta_base_pre_actualizacion_pendiente) != Decimal('0') and \
-           (incremento_indice_periodico_este_mes != Decimal('0.00') or incremento_fijo_periodico_este_mes != Decimal('0.00')):
-             if not (indice_pendiente_valor_raw is not None and 'incremento_del_indice_pendiente_mensual' in locals()):
-                 # Si el cambio en nueva_renta_contrato_a_persistir_final se debió SOLO a la actualización periódica
-                 # que AHORA está pendiente, entonces la renta del contrato NO debe cambiar.
-                 # Se revierte a la renta base original si esa era la renta antes de este intento de actualización periódica.
-                 if current_base_rent.compare(contract.renta_base_pre_actualizacion_pendiente) == Decimal('0'):
-                     nueva_renta_contrato_a_persistir_final = None # No cambiar la renta del contrato
-                 else: # Esto es un caso raro, la renta ya había cambiado por un pendiente anterior resuelto
-                     nueva_renta_contrato_a_persistir_final = contract.renta_base_pre_actualizacion_pendiente
-
-
-    log_info_str = " | ".join(log_info) if log_info else "Sin logs específicos de cálculo de renta."
-    log_info.append(f"FINAL: Renta Línea Principal={renta_para_linea_principal_alquiler}, ConceptosAdicionales={len(conceptos_adicionales)}, NuevaRentaContratoPersistir={nueva_renta_contrato_a_persistir_final}, InfoIndice={info_indice_aplicado_para_factura}")
-    return renta_para_linea_principal_alquiler, conceptos_adicionales, nueva_renta_contrato_a_persistir_final, " | ".join(log_info), info_indice_aplicado_para_factura
+def month_bounds(year: int, month: int):
+    """
+    Rango semiabierto [primer día del mes, primer día del mes siguiente).
+    Para filtrar Factura.fecha_emision por mes sin extract(), que impide usar el índice (contrato_id, fecha_emision).
+    """
+    inicio = date(year, month, 1)
+    return inicio, date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
 
 # --- Ruta Generar Facturas ---
 @facturas_bp.route('/generar', methods=['GET', 'POST'])
@@ -327,55 +114,25 @@ def _calculate_updated_rent_for_invoice(contract: Contrato, target_year: int, ta
 def generar_facturas_mes():
     if request.method == 'POST':
         send_emails_auto = request.form.get('send_emails_auto') == 'on'
-        response_messages = []
-        n, o, emails_sent_ok, emails_failed, emails_skipped = 0, 0, 0, 0, 0
-        errs_gen, upd_ids_contrato, nuevas_facturas_ids = [], [], []
-
         try:
-            year = int(request.form['year'])
-            month = int(request.form['month'])
-            if not (1 <= month <= 12 and 1900 < year < 2200):
-                raise ValueError("Fecha de facturación inválida.")
-
-            n, o, errs_gen, upd_ids_contrato, nuevas_facturas_ids = generate_monthly_invoices(year, month)
-
-            gen_msg = f"{MESES_STR[month]}/{year}: {n} nuevas facturas generadas, {o} omitidas."
-            if upd_ids_contrato: gen_msg += f" {len(upd_ids_contrato)} contrato(s) actualizados con índice."
-            
-            gen_category = 'info' # Default
-            if n > 0 and not any('Error:' in e for e in errs_gen): gen_category = 'success'
-            elif any('Error:' in e for e in errs_gen): gen_category = 'danger'
-            elif errs_gen: gen_category = 'warning' # Solo advertencias
-            response_messages.append({"category": gen_category, "message": gen_msg})
-
-            for error_item in errs_gen: # Añadir todos los errores/advertencias individuales
-                response_messages.append({"category": 'warning' if 'Advertencia' in error_item else 'danger', "message": error_item})
-
-            real_errors_in_generation = [e for e in errs_gen if 'Advertencia' not in e]
-            if send_emails_auto and n > 0 and not real_errors_in_generation:
-                current_app.logger.info(f"--> Iniciando envío automático de {len(nuevas_facturas_ids)} facturas...")
-                if not nuevas_facturas_ids:
-                     response_messages.append({"category": "warning", "message": "No hay facturas nuevas para enviar (posiblemente IDs no generados tras commit)."})
-                else:
-                    for invoice_id_to_send in nuevas_facturas_ids:
-                        email_status = _send_single_invoice_email(invoice_id_to_send, include_bcc_owner=True)
-                        if email_status == "SENT": emails_sent_ok += 1
-                        elif email_status in ["NO_TENANT", "NO_EMAIL"]: emails_skipped += 1
-                        else: emails_failed += 1 # PDF_ERROR, CONFIG_ERROR, SEND_ERROR
-                
-                if emails_sent_ok > 0: response_messages.append({"category": "success", "message": f"{emails_sent_ok} email(s) enviados correctamente."})
-                if emails_skipped > 0: response_messages.append({"category": "info", "message": f"{emails_skipped} email(s) omitidos (ej. inquilino sin email)."})
-                if emails_failed > 0: response_messages.append({"category": "danger", "message": f"Errores críticos enviando {emails_failed} email(s). Revisa logs."})
-
-            elif send_emails_auto and real_errors_in_generation:
-                response_messages.append({"category": "warning", "message": "Errores críticos en generación, envío automático cancelado."})
-
-            final_status_code = 200
-            if any(m['category'] == 'danger' for m in response_messages): final_status_code = 500 # Si hay errores graves
-            
-            return jsonify({ "messages": response_messages}), final_status_code
-
-        except ValueError as ve:
+            year, month, to_year, to_month = _parse_generation_period(request.form)
+
+            owner_ids, scope_error = _resolve_generation_owner_scope()
+            if scope_error:
+                return jsonify({"messages": [{"category": "danger", "message": scope_error}]}), 200
+
+            # La generación (y el envío de emails) se ejecuta en segundo plano; la página consulta el progreso
+            job = enqueue_invoice_generation(year, month, owner_ids, send_emails_auto, current_user.id,
+                                             to_year=to_year, to_month=to_month)
+            periodo_str = f"{MESES_STR[month]}/{year}" + (f" - {MESES_STR[to_month]}/{to_year}" if to_year else "")
+            return jsonify({
+                "job_id": job.id,
+                "status": job.status,
+                "status_url": url_for('facturas_bp.estado_generacion', job_id=job.id),
+                "messages": [{"category": "info", "message": f"Generación de {periodo_str} en cola (trabajo #{job.id})."}]
+            }), 202
+
+        except (KeyError, ValueError) as ve:
             return jsonify({"messages": [{"category": "danger", "message": f"Error en datos de entrada: {ve}"}]}), 400
         except Exception as e:
             current_app.logger.error(f"Error general en POST /facturas/generar: {e}", exc_info=True)
@@ -388,264 +145,690 @@ def generar_facturas_mes():
                            default_year=hoy.year, default_month=hoy.month, # Mes actual para el default
                            years_list=años, meses=MESES_STR, csrf_form=csrf_form)
 
+def _parse_generation_period(form):
+    """
+    Periodo de generar_facturas_mes y preview_generacion: (year, month, to_year, to_month).
+    to_year/to_month son None salvo en modo recuperación (range_mode), limitado a MAX_GENERATION_RANGE_MONTHS meses.
+    Lanza KeyError si falta un campo y ValueError si no es válido.
+    """
+    year, month = int(form['year']), int(form['month'])
+    if not (1 <= month <= 12 and 1900 < year < 2200):
+        raise ValueError("Fecha de facturación inválida.")
+    to_year, to_month = None, None
+    if form.get('range_mode') == 'on': # Modo recuperación: varios meses seguidos
+        to_year, to_month = int(form['to_year']), int(form['to_month'])
+        if not (1 <= to_month <= 12 and 1900 < to_year < 2200):
+            raise ValueError("Mes final del rango inválido.")
+        if (year, month) > (to_year, to_month):
+            raise ValueError("El mes final del rango debe ser igual o posterior al inicial.")
+        if (to_year - year) * 12 + to_month - month + 1 > MAX_GENERATION_RANGE_MONTHS:
+            raise ValueError(f"El rango no puede superar {MAX_GENERATION_RANGE_MONTHS} meses.")
+    return year, month, to_year, to_month
+
+@facturas_bp.route('/generar/preview', methods=['POST'])
+@login_required
+@role_required('admin', 'gestor')
+def preview_generacion():
+    """Vista previa (JSON) de lo que generaría generar_facturas_mes, sin escribir nada."""
+    try:
+        year, month, to_year, to_month = _parse_generation_period(request.form)
+        if to_year is None:
+            to_year, to_month = year, month
+    except (KeyError, ValueError) as ve:
+        return jsonify({"messages": [{"category": "danger", "message": f"Error en datos de entrada: {ve}"}]}), 400
+
+    owner_ids, scope_error = _resolve_generation_owner_scope()
+    if scope_error:
+        return jsonify({"messages": [{"category": "danger", "message": scope_error}]}), 200
+    try:
+        resultado = preview_invoices_range(year, month, to_year, to_month, owner_ids=owner_ids)
+    except Exception as e:
+        current_app.logger.error(f"Error en vista previa de generación: {e}", exc_info=True)
+        return jsonify({"messages": [{"category": "danger", "message": "Error inesperado calculando la vista previa."}]}), 500
+
+    propuestas = [{
+        'numero_contrato': pr['numero_contrato'], 'inquilino': pr['inquilino'],
+        'periodo': f"{MESES_STR[pr['month']]}/{pr['year']}", 'numero_factura': pr['numero_visible'],
+        'fecha_emision': pr['fecha_emision'].isoformat(), 'items': pr['items'],
+        'subtotal': float(pr['subtotal']), 'total': float(pr['total']),
+        'renta_anterior': float(pr['renta_anterior']),
+        'nueva_renta': float(pr['nueva_renta']) if pr['nueva_renta'] is not None else None,
+        'indice_aplicado': pr['indice_aplicado'], 'avisos': pr['avisos'],
+    } for pr in resultado['propuestas']]
+    messages = [{"category": "info", "message": f"Vista previa: {len(propuestas)} factura(s) a generar, {resultado['omitidas']} omitida(s). No se ha guardado nada."}]
+    messages.extend({"category": 'warning' if 'Advertencia' in e else 'danger', "message": e} for e in resultado['errores'])
+    return jsonify({"messages": messages, "propuestas": propuestas})
+
+@facturas_bp.route('/generar/estado/<int:job_id>', methods=['GET'])
+@login_required
+@role_required('admin', 'gestor')
+def estado_generacion(job_id):
+    """Progreso (JSON) de un trabajo de generación lanzado desde generar_facturas_mes."""
+    progress = get_invoice_generation_progress(job_id)
+    if progress is None:
+        return jsonify({"error": "Trabajo de generación no encontrado."}), 404
+    if current_user.role != 'admin' and progress.get('user_id') != current_user.id:
+        return jsonify({"error": "No tienes acceso a este trabajo de generación."}), 403
+    return jsonify(progress)
+
+@facturas_bp.route('/generar/traza/<int:job_id>', methods=['GET'])
+@login_required
+@role_required('admin', 'gestor')
+def traza_generacion(job_id):
+    """Trazas de cálculo (JSON) de un trabajo ejecutado con INVOICE_TRACE_LEVEL='full'. ?contrato_id= filtra por contrato."""
+    job = db.session.get(InvoiceGenerationJob, job_id)
+    if job is None:
+        return jsonify({"error": "Trabajo de generación no encontrado."}), 404
+    if current_user.role != 'admin' and job.user_id != current_user.id:
+        return jsonify({"error": "No tienes acceso a este trabajo de generación."}), 403
+    query = job.traces.order_by(InvoiceCalculationTrace.id)
+    contrato_id = request.args.get('contrato_id', type=int)
+    if contrato_id:
+        query = query.filter(InvoiceCalculationTrace.contrato_id == contrato_id)
+    return jsonify({'job_id': job.id, 'trace_level': job.trace_level, 'traces': [t.to_dict() for t in query]})
+
+def _resolve_generation_owner_scope():
+    """
+    Propietarios a los que se limita la generación según la sesión del usuario.
+
+    Returns:
+        tuple: (owner_ids, error). owner_ids es None si no hay límite (admin sin propietario activo).
+    """
+    active_owner_context = get_active_owner_context()
+    if active_owner_context and active_owner_context.get('active_owner'):
+        # Si hay propietario activo, solo generar facturas para ese propietario
+        active_owner = active_owner_context['active_owner']
+        current_app.logger.info(f"generate_monthly_invoices: Generando facturas solo para propietario activo: {active_owner.nombre} (ID: {active_owner.id})")
+        return [active_owner.id], None
+    if current_user.role != 'admin':
+        # Si no hay propietario activo, aplicar filtro por rol para gestores
+        assigned_owner_ids = [p.id for p in current_user.propietarios_asignados]
+        if not assigned_owner_ids:
+            current_app.logger.info("generate_monthly_invoices: Usuario no admin sin propietarios asignados.")
+            return [], "No tienes propietarios asignados para generar facturas."
+        return assigned_owner_ids, None
+    return None, None
+
+def run_monthly_generation(year: int, month: int, owner_ids=None, send_emails_auto=False, progress_callback=None,
+                           to_year: int = None, to_month: int = None, job_id=None, trace_level=None):
+    """
+    Genera las facturas del mes y, si se pide, las envía por email. No depende de la request:
+    la usa el runner de trabajos en segundo plano (myapp/jobs.py).
+    Con to_year/to_month genera todos los meses del rango (ver generate_invoices_range).
+    job_id/trace_level: trabajo al que se enlazan las trazas de cálculo (ver utils/calc_trace.py).
+
+    Returns:
+        dict: nuevas, omitidas, errores, contratos_actualizados, factura_ids, resumen y
+              messages ([{category, message}] para la página de generación).
+    """
+    response_messages = []
+    emails_queued, emails_skipped = 0, 0
+
+    to_year, to_month = to_year or year, to_month or month
+    n, o, errs_gen, upd_ids_contrato, nuevas_facturas_ids, resumen_gen = generate_invoices_range(
+        year, month, to_year, to_month, owner_ids=owner_ids, progress_callback=progress_callback,
+        job_id=job_id, trace_level=trace_level)
+
+    periodo_str = f"{MESES_STR[month]}/{year}"
+    if (to_year, to_month) != (year, month): periodo_str += f" - {MESES_STR[to_month]}/{to_year}"
+    gen_msg = f"{periodo_str}: {n} nuevas facturas generadas, {o} omitidas."
+    if upd_ids_contrato: gen_msg += f" {len(upd_ids_contrato)} contrato(s) actualizados con índice."
+    if resumen_gen: gen_msg += f" Índices IPC/IRAV: {resumen_gen.get('index_cache_hits', 0)} encontrados, {resumen_gen.get('index_cache_misses', 0)} no disponibles."
+    
+    gen_category = 'info' # Default
+    if n > 0 and not any('Error:' in e for e in errs_gen): gen_category = 'success'
+    elif any('Error:' in e for e in errs_gen): gen_category = 'danger'
+    elif errs_gen: gen_category = 'warning' # Solo advertencias
+    response_messages.append({"category": gen_category, "message": gen_msg})
+
+    for error_item in errs_gen: # Añadir todos los errores/advertencias individuales
+        response_messages.append({"category": 'warning' if 'Advertencia' in error_item else 'danger', "message": error_item})
+
+    real_errors_in_generation = [e for e in errs_gen if 'Advertencia' not in e]
+    if send_emails_auto and n > 0 and not real_errors_in_generation:
+        current_app.logger.info(f"--> Iniciando envío automático de {len(nuevas_facturas_ids)} facturas...")
+        if not nuevas_facturas_ids:
+             response_messages.append({"category": "warning", "message": "No hay facturas nuevas para enviar (posiblemente IDs no generados tras commit)."})
+        else:
+            # Se encolan en la bandeja de salida: el envío (con reintentos) no retrasa el fin del trabajo
+            con_email, sin_email = _split_by_tenant_email(nuevas_facturas_ids)
+            emails_queued, emails_skipped = len(enqueue_invoice_emails(con_email, include_bcc_owner=True)), len(sin_email)
+        
+        if emails_queued > 0: response_messages.append({"category": "success", "message": f"{emails_queued} email(s) en cola de envío."})
+        if emails_skipped > 0: response_messages.append({"category": "info", "message": f"{emails_skipped} email(s) omitidos (ej. inquilino sin email)."})
+
+    elif send_emails_auto and real_errors_in_generation:
+        response_messages.append({"category": "warning", "message": "Errores críticos en generación, envío automático cancelado."})
+
+    return {
+        "nuevas": n, "omitidas": o, "errores": errs_gen, "contratos_actualizados": upd_ids_contrato,
+        "factura_ids": nuevas_facturas_ids, "resumen": resumen_gen, "messages": response_messages,
+    }
+
 # --- FUNCIÓN generate_monthly_invoices (COMPLETA Y CORREGIDA) ---
-def generate_monthly_invoices(year: int, month: int):
+def generate_monthly_invoices(year: int, month: int, owner_ids=None, progress_callback=None, preview: bool = False):
+    """
+    Genera las facturas del mes para los contratos activos.
+    owner_ids limita la generación a esos propietarios (None = todos); ver _resolve_generation_owner_scope.
+    progress_callback(procesados, total) se llama tras cada contrato.
+    Con preview=True no escribe nada y devuelve las facturas propuestas (ver preview_invoices_range).
+    """
+    if preview:
+        return preview_invoices_range(year, month, year, month, owner_ids=owner_ids)
+    return generate_invoices_range(year, month, year, month, owner_ids=owner_ids, progress_callback=progress_callback)
+
+def _months_in_range(from_year: int, from_month: int, to_year: int, to_month: int):
+    """Lista de (año, mes) desde from hasta to, ambos incluidos."""
+    meses = []
+    year, month = from_year, from_month
+    while (year, month) <= (to_year, to_month):
+        meses.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return meses
+
+def _allow_missing_index():
+    """SystemSettings.generate_invoice_if_index_missing de la petición (o trabajo) actual."""
+    settings = getattr(g, 'settings', None)
+    return bool(settings and settings.generate_invoice_if_index_missing)
+
+def _build_invoice_proposal(contrato: ContractSnapshot, year: int, month: int, gastos_del_mes, iva_rate_global, irpf_rate_global,
+                            index_lookup: IndexLookup, numero_secuencial: int, allow_missing_index: bool = False,
+                            trace: Optional[CalcTrace] = None):
+    """
+    Calcula la factura de un contrato para un mes sin tocar la base de datos ni el Contrato.
+    numero_secuencial: número de la serie del contrato para ese año, ya reservado (ver SeriesReservation).
+    Los cambios que el contrato debe recibir (reflejo de la serie e índice pendiente) se devuelven en
+    'cambios_contrato'; la nueva renta base, en 'nueva_renta'.
+    trace: CalcTrace del contrato/mes si INVOICE_TRACE_LEVEL es 'full' (ver utils/calc_trace.py).
+
+    Returns:
+        dict: numero_factura, fecha_emision, items, subtotal, iva, irpf, total, tasas aplicadas, notas,
+              renta_anterior, nueva_renta (None si no cambia), indice_aplicado, cambios_contrato y avisos.
+    """
+    renta_original_contrato_antes_calculo = contrato.precio_mensual
+    calculo_renta = calculate_rent(contrato, year, month, renta_original_contrato_antes_calculo, index_lookup, allow_missing_index, trace)
+    renta_principal_a_facturar, items_actualizacion_y_atrasos = calculo_renta.renta_linea_principal, calculo_renta.conceptos_adicionales
+    nueva_renta_base_contrato_a_persistir = calculo_renta.nueva_renta
+    info_indice_para_esta_factura = calculo_renta.indice_aplicado
+    cambios_contrato = dict(calculo_renta.changes)
+
+    items_gastos_para_factura, total_importe_gastos_mes, gastos_objetos_a_actualizar_en_bd = [], Decimal('0.00'), []
+    for gasto_obj_db in gastos_del_mes:
+        items_gastos_para_factura.append({"description": f"Gasto: {gasto_obj_db.concepto}", "quantity": 1, "unitPrice": float(gasto_obj_db.importe), "total": float(gasto_obj_db.importe)})
+        total_importe_gastos_mes += gasto_obj_db.importe; gastos_objetos_a_actualizar_en_bd.append(gasto_obj_db)
+
+    items_json_final_factura = [{"description": f"Alquiler {MESES_STR[month]} {year}", "quantity": 1, "unitPrice": float(renta_principal_a_facturar), "total": float(renta_principal_a_facturar)}]
+    items_json_final_factura.extend(items_actualizacion_y_atrasos); items_json_final_factura.extend(items_gastos_para_factura)
+    subtotal_calculado_factura = renta_principal_a_facturar
+    for item_adicional in items_actualizacion_y_atrasos: subtotal_calculado_factura += Decimal(str(item_adicional.get('total', '0.00')))
+    subtotal_calculado_factura = (subtotal_calculado_factura + total_importe_gastos_mes).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+    tasa_iva_a_aplicar_factura = iva_rate_global if contrato.aplicar_iva else Decimal('0.00')
+    tasa_irpf_a_aplicar_factura = irpf_rate_global if contrato.aplicar_irpf else Decimal('0.00')
+    iva_monto_calculado_factura = (subtotal_calculado_factura * tasa_iva_a_aplicar_factura).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+    irpf_monto_calculado_factura = (subtotal_calculado_factura * tasa_irpf_a_aplicar_factura).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+    total_calculado_factura = (subtotal_calculado_factura + iva_monto_calculado_factura - irpf_monto_calculado_factura).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+    fecha_emision_calculada = date(year, month, contrato.dia_pago if 1 <= contrato.dia_pago <= last_day_of_month(year, month) else 1)
+
+    numero_factura_visible_final = ""
+    numero_factura_bd_final = "" 
+    serie_usada_log_detalle_local = "No especificada" 
+
+    if contrato.serie_facturacion_prefijo and contrato.serie_facturacion_prefijo.strip():
+        # --- CASO 1: El contrato SÍ tiene un prefijo de serie definido ---
+        serie_usada_log_detalle_local = f"Contrato ({contrato.serie_facturacion_prefijo})"
+        prefijo_de_contrato = contrato.serie_facturacion_prefijo
+        formato_digitos_de_contrato = contrato.serie_facturacion_formato_digitos or 4 # Default 4 si no está
+        # El contador es por (contrato, año): un año nuevo para la serie empieza en 1
+        proximo_secuencial_para_este_contrato = numero_secuencial
+    
+        secuencial_formateado = f"{proximo_secuencial_para_este_contrato:0{formato_digitos_de_contrato}d}"
+    
+        # Construir la parte visible
+        if str(year) in prefijo_de_contrato: # Si el año ya está en el prefijo (poco común pero posible)
+            numero_factura_visible_final = f"{prefijo_de_contrato}{secuencial_formateado}"
+        else:
+            numero_factura_visible_final = f"{prefijo_de_contrato.rstrip('-')}-{year}-{secuencial_formateado}"
+    
+        # El número para la BD siempre lleva el identificador del contrato
+        numero_factura_bd_final = f"C{contrato.id}-{numero_factura_visible_final}" 
+    
+        # Actualizar el contrato con el último número y año de la serie
+        cambios_contrato['serie_facturacion_ultimo_numero'] = proximo_secuencial_para_este_contrato
+        cambios_contrato['serie_facturacion_ano_actual'] = year
+
+    else: 
+        # --- CASO 2: El contrato NO tiene un prefijo de serie definido ---
+        serie_usada_log_detalle_local = "Sin prefijo (Año-Secuencial)"
+        # El prefijo para la BD contendrá el ID del contrato y el año.
+        # La parte visible será AÑO-SECUENCIAL.
+    
+        # También sin prefijo hay una secuencia por contrato/año (mismo contador).
+        formato_digitos_sin_prefijo = contrato.serie_facturacion_formato_digitos or 3 # Default 3 para este caso si lo prefieres
+        proximo_secuencial_sin_prefijo = numero_secuencial
+    
+        secuencial_formateado_sin_prefijo = f"{proximo_secuencial_sin_prefijo:0{formato_digitos_sin_prefijo}d}"
+    
+        numero_factura_visible_final = f"{year}-{secuencial_formateado_sin_prefijo}"
+        numero_factura_bd_final = f"C{contrato.id}-{numero_factura_visible_final}"
+
+        # Actualizar el contrato con el último número y año, incluso sin prefijo,
+        # para que la secuencia continúe correctamente la próxima vez.
+        cambios_contrato['serie_facturacion_ultimo_numero'] = proximo_secuencial_sin_prefijo
+        cambios_contrato['serie_facturacion_ano_actual'] = year
+        # No es necesario guardar `serie_facturacion_prefijo = None` explícitamente si ya es None.
+        # `serie_facturacion_formato_digitos` se mantendría o usaría el default.
+
+    # --- FIN LÓGICA MODIFICADA ---
+
+    if trace is not None:
+        trace.add('numeracion', serie=serie_usada_log_detalle_local, secuencial=numero_secuencial,
+                  numero_bd=numero_factura_bd_final, numero_visible=numero_factura_visible_final)
+
+    notas_factura_final_list = [f"Factura correspondiente al periodo de {MESES_STR[month]}/{year}."]
+    if info_indice_para_esta_factura and isinstance(info_indice_para_esta_factura, dict):
+        tipo_idx, mes_idx, ano_idx, porc_idx = info_indice_para_esta_factura.get('type'), info_indice_para_esta_factura.get('month'), info_indice_para_esta_factura.get('year'), info_indice_para_esta_factura.get('percentage')
+        nota_idx = f"Incluye actualización de renta por {tipo_idx or 'Índice'}"
+        if mes_idx and ano_idx: nota_idx += f" de {MESES_STR[int(mes_idx)]}/{ano_idx}"
+        if porc_idx is not None: nota_idx += f" ({porc_idx:+.2f}%)".replace('.', ',')
+        notas_factura_final_list.append(nota_idx + ".")
+    if any("Atrasos act." in item.get("description","") for item in items_actualizacion_y_atrasos if isinstance(item, dict)): notas_factura_final_list.append("Incluye regularización de atrasos por actualización de índice.")
+    if gastos_objetos_a_actualizar_en_bd: notas_factura_final_list.append(f"Incluye {len(gastos_objetos_a_actualizar_en_bd)} gasto(s) repercutido(s).")
+    notas_factura_para_bd = " ".join(notas_factura_final_list)
+
+    return {
+        'numero_factura': numero_factura_bd_final, 'numero_visible': numero_factura_visible_final,
+        'fecha_emision': fecha_emision_calculada, 'items': items_json_final_factura,
+        'subtotal': subtotal_calculado_factura, 'iva': iva_monto_calculado_factura, 'irpf': irpf_monto_calculado_factura,
+        'total': total_calculado_factura, 'iva_rate': tasa_iva_a_aplicar_factura, 'irpf_rate': tasa_irpf_a_aplicar_factura,
+        'notas': notas_factura_para_bd.strip(), 'renta_anterior': renta_original_contrato_antes_calculo,
+        'nueva_renta': nueva_renta_base_contrato_a_persistir, 'indice_aplicado': info_indice_para_esta_factura,
+        'cambios_contrato': cambios_contrato, 'avisos': calculo_renta.avisos,
+    }
+
+def _load_generation_data(meses_rango, owner_ids=None):
+    """
+    Datos de entrada de una generación (real o vista previa), cargados una sola vez para todo el rango.
+
+    Returns:
+        tuple: (contratos, facturas_existentes {(contrato_id, año, mes)}, IndexLookup, gastos pendientes por contrato)
+    """
+    (from_year, from_month), (to_year, to_month) = meses_rango[0], meses_rango[-1]
+    inicio_periodo_factura = date(from_year, from_month, 1)
+    fin_periodo_factura = date(to_year, to_month, last_day_of_month(to_year, to_month))
+    inicio_mes_siguiente = month_bounds(to_year, to_month)[1]
+
+    query_contratos = db.session.query(Contrato).options(
+        joinedload(Contrato.propiedad_ref).joinedload(Propiedad.propietario_ref),
+        joinedload(Contrato.inquilino_ref)
+    ).filter(
+        Contrato.estado == 'activo',
+        Contrato.fecha_inicio <= fin_periodo_factura,
+        or_(Contrato.fecha_fin.is_(None), Contrato.fecha_fin >= inicio_periodo_factura)
+    )
+    if owner_ids is not None:
+        query_contratos = query_contratos.join(Propiedad, Contrato.propiedad_id == Propiedad.id)\
+                                         .filter(Propiedad.propietario_id.in_(owner_ids))
+    contratos_a_procesar = query_contratos.all()
+    if not contratos_a_procesar:
+        return [], set(), None, {}
+
+    contrato_ids_a_procesar = [c.id for c in contratos_a_procesar]
+    facturas_existentes_tuplas = db.session.query(
+        Factura.contrato_id, extract('year', Factura.fecha_emision), extract('month', Factura.fecha_emision)
+    ).filter(
+        Factura.contrato_id.in_(contrato_ids_a_procesar),
+        Factura.fecha_emision >= inicio_periodo_factura,
+        Factura.fecha_emision < inicio_mes_siguiente
+    ).distinct().all()
+    facturas_existentes = {(c_id, int(f_year), int(f_month)) for c_id, f_year, f_month in facturas_existentes_tuplas}
+    index_lookup = IndexLookup.load() # IPC/IRAV en memoria: 2 consultas por ejecución en lugar de 1-2 por contrato
+
+    # Gastos pendientes de TODOS los contratos y meses en una sola consulta, agrupados por contrato en memoria.
+    # El filtro exacto por mes se aplica en el bucle (_pending_expenses_for_month).
+    gastos_pendientes_por_contrato = {}
+    gastos_pendientes_todos = Gasto.query.filter(Gasto.contrato_id.in_(contrato_ids_a_procesar), Gasto.estado == 'Pendiente',
+        or_(Gasto.month.is_(None), Gasto.month.in_({m for _, m in meses_rango})),
+        or_(Gasto.year.is_(None), Gasto.year.in_({y for y, _ in meses_rango}))
+    ).order_by(Gasto.upload_date, Gasto.id).all()
+    for gasto_pendiente in gastos_pendientes_todos:
+        gastos_pendientes_por_contrato.setdefault(gasto_pendiente.contrato_id, []).append(gasto_pendiente)
+    return contratos_a_procesar, facturas_existentes, index_lookup, gastos_pendientes_por_contrato
+
+def _no_contracts_errors(periodo_str, owner_ids):
+    msg = f"No hay contratos activos para generar facturas en {periodo_str}."
+    current_app.logger.info(msg)
+    # Devolver lista vacía de errores si no hay contratos, en lugar de mensaje de error,
+    # a menos que la generación no esté limitada (admin) y no haya contratos activos en absoluto.
+    no_active_contracts_at_all_system = not db.session.query(Contrato.id).filter_by(estado='activo').first()
+    if owner_ids is None and no_active_contracts_at_all_system:
+        return [msg]
+    return [] # No es un error, simplemente no hay nada que procesar para este usuario
+
+def _contracts_by_month(meses_rango, contratos):
+    """Trabajo a realizar: cada mes en orden, con los contratos vigentes en ese mes -> [(año, mes, contrato)]."""
+    trabajo_por_mes = []
+    for year, month in meses_rango:
+        inicio_mes, fin_mes = date(year, month, 1), date(year, month, last_day_of_month(year, month))
+        trabajo_por_mes.extend((year, month, c) for c in contratos
+                               if c.fecha_inicio <= fin_mes and (c.fecha_fin is None or c.fecha_fin >= inicio_mes))
+    return trabajo_por_mes
+
+def _series_numbers_needed(trabajo_por_mes, facturas_existentes):
+    """Números a reservar por serie de contrato y año -> {(serie, año): (facturas, último número del reflejo en el contrato)}."""
+    necesarios = {}
+    for year, month, contrato in trabajo_por_mes:
+        if (contrato.id, year, month) in facturas_existentes: continue
+        clave = (contract_series_key(contrato.id), year)
+        seed = (contrato.serie_facturacion_ultimo_numero or 0) if contrato.serie_facturacion_ano_actual == year else 0
+        necesarios[clave] = (necesarios.get(clave, (0, seed))[0] + 1, seed)
+    return necesarios
+
+def _pending_expenses_for_month(gastos, year, month):
+    """Gastos asignados a ese mes/año o sin mes y/o año asignado."""
+    return [gasto for gasto in gastos if gasto.month in (month, None) and gasto.year in (year, None)]
+
+def generate_invoices_range(from_year: int, from_month: int, to_year: int, to_month: int, owner_ids=None, progress_callback=None,
+                            job_id=None, trace_level=None):
+    """
+    Genera las facturas de varios meses seguidos (modo recuperación tras vacaciones o una caída).
+    Contratos, facturas existentes, índices y gastos pendientes se cargan una sola vez; los meses se
+    recorren en orden y la renta y la serie de cada contrato avanzan en memoria, de modo que el
+    resultado es el mismo que llamando a generate_monthly_invoices mes a mes.
+    trace_level: nivel de traza (por defecto INVOICE_TRACE_LEVEL); en 'full' se guarda la traza de
+    cada contrato y mes en InvoiceCalculationTrace, enlazada a job_id.
+
+    Returns:
+        tuple: (nuevas, omitidas, errores, contratos_actualizados, committed_invoice_ids, resumen)
+    """
+    nivel_traza = trace_level or get_trace_level()
+    inicio_ejecucion = time.perf_counter()
+
+    meses_rango = _months_in_range(from_year, from_month, to_year, to_month)
+    if not meses_rango:
+        return 0, 0, [f"Rango de meses inválido: {from_month}/{from_year} - {to_month}/{to_year}."], [], [], {}
+    periodo_str = f"{MESES_STR[from_month]}/{from_year}"
+    if len(meses_rango) > 1: periodo_str += f" - {MESES_STR[to_month]}/{to_year}"
+
+    # ETAPA 1: facturas, rentas y numeración, en una sesión propia con SAVEPOINTs (un contrato por SAVEPOINT).
+    # El commit por lotes no expira los contratos pendientes de procesar (evita recargarlos uno a uno).
+    with savepoint_session(expire_on_commit=False):
+        nuevas, omitidas, errores, contratos_actualizados_con_renta, committed_invoice_ids, resumen, total_contratos = \
+            _create_invoices_range(meses_rango, periodo_str, owner_ids, progress_callback, job_id, nivel_traza)
+    if total_contratos is None:
+        return nuevas, omitidas, errores, contratos_actualizados_con_renta, committed_invoice_ids, resumen
+
+    # --- ETAPA 2: PDFs fuera de la transacción; un fallo de render no deshace las facturas ya confirmadas ---
+    if committed_invoice_ids:
+        resumen['pdfs_generados'], errores_pdf = _render_generated_invoice_pdfs(committed_invoice_ids)
+        resumen['pdfs_fallidos'] = len(errores_pdf)
+        errores.extend(errores_pdf)
+    if nivel_traza != 'off':
+        current_app.logger.info(
+            f"generate_invoices_range {periodo_str}{f' (trabajo #{job_id})' if job_id else ''}: {total_contratos} contrato(s)/mes, "
+            f"{nuevas} nuevas, {omitidas} omitidas, {len(errores)} errores/avisos, {len(contratos_actualizados_con_renta)} rentas actualizadas; "
+            f"índices en caché -> {resumen['index_cache_hits']} aciertos, {resumen['index_cache_misses']} fallos; "
+            f"{time.perf_counter() - inicio_ejecucion:.2f}s.")
+    return nuevas, omitidas, errores, contratos_actualizados_con_renta, committed_invoice_ids, resumen
+
+def _create_invoices_range(meses_rango, periodo_str, owner_ids, progress_callback, job_id, nivel_traza):
+    """
+    Etapa 1 de generate_invoices_range: crea y confirma (por lotes) las facturas del rango.
+
+    Returns:
+        tuple: (nuevas, omitidas, errores, contratos_actualizados, committed_invoice_ids, resumen de índices,
+                contratos/mes procesados o None si no se llegó a procesar ninguno)
+    """
     iva_rate_global, irpf_rate_global = get_rates()
+    permitir_sin_indice = _allow_missing_index()
     nuevas, omitidas = 0, 0
-    errores, contratos_actualizados_con_renta, nuevas_notificaciones_a_anadir_db, committed_invoice_ids = [], [], [], []
-    historial_actualizaciones_a_anadir = []
-    
-    inicio_periodo_factura = date(year, month, 1)
-    fin_periodo_factura = date(year, month, last_day_of_month(year, month))
-    contratos_a_procesar = []
+    errores, contratos_actualizados_con_renta, committed_invoice_ids = [], [], []
 
     try:
-        query_contratos = db.session.query(Contrato).options(
-            joinedload(Contrato.propiedad_ref).joinedload(Propiedad.propietario_ref),
-            joinedload(Contrato.inquilino_ref)
-        ).filter(
-            Contrato.estado == 'activo',
-            Contrato.fecha_inicio <= fin_periodo_factura,
-            or_(Contrato.fecha_fin.is_(None), Contrato.fecha_fin >= inicio_periodo_factura)
-        )
-        # Primero verificar si hay propietario activo
-        active_owner_context = get_active_owner_context()
-        if active_owner_context and active_owner_context.get('active_owner'):
-            # Si hay propietario activo, solo generar facturas para ese propietario
-            active_owner_id = active_owner_context['active_owner'].id
-            query_contratos = query_contratos.join(Propiedad, Contrato.propiedad_id == Propiedad.id)\
-                                             .filter(Propiedad.propietario_id == active_owner_id)
-            current_app.logger.info(f"generate_monthly_invoices: Generando facturas solo para propietario activo: {active_owner_context['active_owner'].nombre} (ID: {active_owner_id})")
-        elif current_user.role != 'admin':
-            # Si no hay propietario activo, aplicar filtro por rol para gestores
-            assigned_owner_ids = [p.id for p in current_user.propietarios_asignados]
-            if not assigned_owner_ids:
-                current_app.logger.info("generate_monthly_invoices: Usuario no admin sin propietarios asignados.")
-                return 0, 0, ["No tienes propietarios asignados para generar facturas."], [], []
-            query_contratos = query_contratos.join(Propiedad, Contrato.propiedad_id == Propiedad.id)\
-                                             .filter(Propiedad.propietario_id.in_(assigned_owner_ids))
-        
-        contratos_a_procesar = query_contratos.all()
-
+        if owner_ids is not None and not owner_ids:
+            return 0, 0, ["No tienes propietarios asignados para generar facturas."], [], [], {}, None
+        contratos_a_procesar, facturas_existentes, index_lookup, gastos_pendientes_por_contrato = \
+            _load_generation_data(meses_rango, owner_ids)
         if not contratos_a_procesar:
-            msg = f"No hay contratos activos ({current_user.role}) para generar facturas en {MESES_STR[month]}/{year}."
-            current_app.logger.info(msg)
-            # Devolver lista vacía de errores si no hay contratos, en lugar de mensaje de error,
-            # a menos que sea un admin y no haya contratos activos en absoluto.
-            no_active_contracts_at_all_system = not db.session.query(Contrato.id).filter_by(estado='activo').first()
-            if current_user.role == 'admin' and no_active_contracts_at_all_system:
-                return 0,0,[msg],[],[]
-            return 0, 0, [], [], [] # No es un error, simplemente no hay nada que procesar para este usuario
-
-        contrato_ids_a_procesar = [c.id for c in contratos_a_procesar]
-        facturas_existentes_tuplas = db.session.query(Factura.contrato_id).filter(
-            extract('year', Factura.fecha_emision) == year,
-            extract('month', Factura.fecha_emision) == month,
-            Factura.contrato_id.in_(contrato_ids_a_procesar)
-        ).distinct().all()
-        facturas_existentes = {f[0] for f in facturas_existentes_tuplas} # Convertir lista de tuplas a set de IDs
-
+            return 0, 0, _no_contracts_errors(periodo_str, owner_ids), [], [], {}, None
     except Exception as e_initial:
         db.session.rollback()
         errores.append(f"Error inicial obteniendo datos para generación: {e_initial}")
         current_app.logger.error(f"Error fatal en generate_monthly_invoices (fase inicial): {e_initial}", exc_info=True)
-        return 0, 0, errores, [], []
+        return 0, 0, errores, [], [], {}, None
 
-    facturas_nuevas_a_anadir_db = []
-    gastos_a_vincular_con_factura = {} 
-    contratos_modificados_por_actualizacion_renta_o_serie = []
-    ultimos_secuenciales_usados_en_sesion = {}
+    lote_size = current_app.config.get('INVOICE_GENERATION_BATCH_SIZE') or 200
+    facturas_lote, contratos_renta_lote, series_lote = [], [], []
 
-    for contrato in contratos_a_procesar:
+    def _confirmar_lote():
+        nonlocal nuevas, omitidas
+        if not facturas_lote: return
+        try:
+            db.session.commit()
+            committed_invoice_ids.extend(f.id for f in facturas_lote)
+            contratos_actualizados_con_renta.extend(contratos_renta_lote)
+        except Exception as e_commit:
+            db.session.rollback()
+            # Los números del lote son los últimos entregados de cada serie: se devuelven a la reserva
+            # para que las facturas siguientes los reutilicen y no queden huecos en la numeración
+            for clave_serie_lote, year_lote in series_lote: reservas_serie.undo(clave_serie_lote, year_lote)
+            numeros_lote = ", ".join(f.numero_factura for f in facturas_lote)
+            errores.append(f"Error crítico commit lote ({len(facturas_lote)} facturas: {numeros_lote}; sus números se reutilizan): {e_commit}")
+            current_app.logger.error(f"Error crítico en commit de lote generate_monthly_invoices ({numeros_lote}): {e_commit}\n{traceback.format_exc()}")
+            nuevas -= len(facturas_lote); omitidas += len(facturas_lote)
+        facturas_lote.clear(); contratos_renta_lote.clear(); series_lote.clear()
+
+    trabajo_por_mes = _contracts_by_month(meses_rango, contratos_a_procesar)
+    # Números de factura de todo el rango reservados de una vez; la reserva se confirma ya para que el
+    # rollback de un lote fallido no deshaga la de los lotes confirmados (sus números vuelven a la reserva
+    # en _confirmar_lote y release() devuelve al contador los que sobren al final)
+    reservas_serie = SeriesReservation()
+    try:
+        reservas_serie.reserve(_series_numbers_needed(trabajo_por_mes, facturas_existentes))
+        db.session.commit()
+    except Exception as e_reserva:
+        db.session.rollback()
+        errores.append(f"Error reservando numeración de facturas: {e_reserva}")
+        current_app.logger.error(f"Error reservando numeración en generate_invoices_range: {e_reserva}", exc_info=True)
+        return 0, 0, errores, [], [], {}, None
+
+    def _guardar_traza(traza, contrato, year, month, outcome, factura=None, renta_anterior=None, renta_nueva=None):
+        # Fuera del SAVEPOINT: la traza de un contrato con error también se guarda (con el commit del lote o el final)
+        db.session.add(InvoiceCalculationTrace(job_id=job_id, contrato_id=contrato.id, year=year, month=month,
+                                               factura_id=factura.id if factura is not None else None, outcome=outcome,
+                                               renta_anterior=renta_anterior, renta_nueva=renta_nueva, events=traza.events))
+
+    total_contratos = len(trabajo_por_mes)
+    for indice_contrato, (year, month, contrato) in enumerate(trabajo_por_mes, start=1):
+        if progress_callback and indice_contrato > 1: progress_callback(indice_contrato - 1, total_contratos)
         factura_temporal_obj = None 
-        log_mensajes_este_contrato_iteracion = []
+        renta_actualizada_este_contrato = False
+        contrato_str = contrato.numero_contrato if len(meses_rango) == 1 else f"{contrato.numero_contrato} ({MESES_STR[month]}/{year})"
+        traza = CalcTrace() if nivel_traza == 'full' else None
 
-        if contrato.id in facturas_existentes:
+        if (contrato.id, year, month) in facturas_existentes:
             omitidas += 1
-            current_app.logger.info(f"Contrato {contrato.numero_contrato}: Factura ya existe para {month}/{year}, omitiendo.")
+            if traza is not None:
+                traza.add('omitida', motivo='factura_existente')
+                _guardar_traza(traza, contrato, year, month, 'existente')
             continue
         
+        # Los ya facturados en un mes anterior del rango quedan como 'Facturado'
+        gastos_del_mes = [gasto for gasto in _pending_expenses_for_month(gastos_pendientes_por_contrato.get(contrato.id, []), year, month)
+                          if gasto.estado == 'Pendiente']
+        clave_serie = contract_series_key(contrato.id)
+        numero_serie = reservas_serie.take(clave_serie, year)
+        renta_anterior = contrato.precio_mensual
         try:
-            renta_original_contrato_antes_calculo = contrato.precio_mensual
-            renta_principal_a_facturar, items_actualizacion_y_atrasos, \
-            nueva_renta_base_contrato_a_persistir, log_calculo_renta, \
-            info_indice_para_esta_factura = \
-                _calculate_updated_rent_for_invoice(contrato, year, month, renta_original_contrato_antes_calculo)
-            
-            if log_calculo_renta: log_mensajes_este_contrato_iteracion.append(f"Cálculo Renta: {log_calculo_renta}")
-
-            items_gastos_para_factura, total_importe_gastos_mes, gastos_objetos_a_actualizar_en_bd = [], Decimal('0.00'), []
-            gastos_pendientes_query = Gasto.query.filter(Gasto.contrato_id == contrato.id, Gasto.estado == 'Pendiente',
-                or_((Gasto.month == month) & (Gasto.year == year), (Gasto.month.is_(None)) & (Gasto.year.is_(None)),
-                    (Gasto.month.is_(None)) & (Gasto.year == year), (Gasto.month == month) & (Gasto.year.is_(None)))
-            ).order_by(Gasto.upload_date).all()
-            for gasto_obj_db in gastos_pendientes_query:
-                items_gastos_para_factura.append({"description": f"Gasto: {gasto_obj_db.concepto}", "quantity": 1, "unitPrice": float(gasto_obj_db.importe), "total": float(gasto_obj_db.importe)})
-                total_importe_gastos_mes += gasto_obj_db.importe; gastos_objetos_a_actualizar_en_bd.append(gasto_obj_db)
-
-            items_json_final_factura = [{"description": f"Alquiler {MESES_STR[month]} {year}", "quantity": 1, "unitPrice": float(renta_principal_a_facturar), "total": float(renta_principal_a_facturar)}]
-            items_json_final_factura.extend(items_actualizacion_y_atrasos); items_json_final_factura.extend(items_gastos_para_factura)
-            subtotal_calculado_factura = renta_principal_a_facturar
-            for item_adicional in items_actualizacion_y_atrasos: subtotal_calculado_factura += Decimal(str(item_adicional.get('total', '0.00')))
-            subtotal_calculado_factura = (subtotal_calculado_factura + total_importe_gastos_mes).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-            tasa_iva_a_aplicar_factura = iva_rate_global if contrato.aplicar_iva else Decimal('0.00')
-            tasa_irpf_a_aplicar_factura = irpf_rate_global if contrato.aplicar_irpf else Decimal('0.00')
-            iva_monto_calculado_factura = (subtotal_calculado_factura * tasa_iva_a_aplicar_factura).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-            irpf_monto_calculado_factura = (subtotal_calculado_factura * tasa_irpf_a_aplicar_factura).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-            total_calculado_factura = (subtotal_calculado_factura + iva_monto_calculado_factura - irpf_monto_calculado_factura).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-            fecha_emision_calculada = date(year, month, contrato.dia_pago if 1 <= contrato.dia_pago <= last_day_of_month(year, month) else 1)
-            
-            
-            numero_factura_visible_final = ""
-            numero_factura_bd_final = "" 
-            serie_usada_log_detalle_local = "No especificada" 
+            # SAVEPOINT por contrato: un error solo deshace la factura, serie, renta y gastos de este contrato
+            with db.session.begin_nested():
+                propuesta = _build_invoice_proposal(ContractSnapshot.from_contract(contrato), year, month, gastos_del_mes,
+                                                    iva_rate_global, irpf_rate_global, index_lookup, numero_serie, permitir_sin_indice, traza)
+                for campo, valor in propuesta['cambios_contrato'].items(): setattr(contrato, campo, valor)
+                factura_temporal_obj = Factura(numero_factura=propuesta['numero_factura'], contrato_id=contrato.id, inquilino_id=contrato.inquilino_id, propiedad_id=contrato.propiedad_id, fecha_emision=propuesta['fecha_emision'], subtotal=propuesta['subtotal'], iva=propuesta['iva'], irpf=propuesta['irpf'], total=propuesta['total'], estado='pendiente', items_json=json.dumps(propuesta['items'], ensure_ascii=False), notas=propuesta['notas'], iva_rate_applied=propuesta['iva_rate'], irpf_rate_applied=propuesta['irpf_rate'], indice_aplicado_info=propuesta['indice_aplicado'])
+                db.session.add(factura_temporal_obj); db.session.flush()
+                # El PDF se genera en la etapa 2, tras el commit (ver _render_generated_invoice_pdfs)
             
-            if contrato.serie_facturacion_prefijo and contrato.serie_facturacion_prefijo.strip():
-                # --- CASO 1: El contrato SÍ tiene un prefijo de serie definido ---
-                serie_usada_log_detalle_local = f"Contrato ({contrato.serie_facturacion_prefijo})"
-                prefijo_de_contrato = contrato.serie_facturacion_prefijo
-                ultimo_numero_guardado_en_contrato = contrato.serie_facturacion_ultimo_numero or 0
-                ano_serie_guardado_en_contrato = contrato.serie_facturacion_ano_actual
-                formato_digitos_de_contrato = contrato.serie_facturacion_formato_digitos or 4 # Default 4 si no está
-                
-                proximo_secuencial_para_este_contrato = 0
-                if ano_serie_guardado_en_contrato is None or ano_serie_guardado_en_contrato != year:
-                    # Si es un año nuevo para la serie, o si nunca se ha usado, empezar en 1
-                    proximo_secuencial_para_este_contrato = 1
-                else:
-                    proximo_secuencial_para_este_contrato = ultimo_numero_guardado_en_contrato + 1
-                
-                secuencial_formateado = f"{proximo_secuencial_para_este_contrato:0{formato_digitos_de_contrato}d}"
-                
-                # Construir la parte visible
-                if str(year) in prefijo_de_contrato: # Si el año ya está en el prefijo (poco común pero posible)
-                    numero_factura_visible_final = f"{prefijo_de_contrato}{secuencial_formateado}"
-                else:
-                    numero_factura_visible_final = f"{prefijo_de_contrato.rstrip('-')}-{year}-{secuencial_formateado}"
-                
-                # El número para la BD siempre lleva el identificador del contrato
-                numero_factura_bd_final = f"C{contrato.id}-{numero_factura_visible_final}" 
-                
-                # Actualizar el contrato con el último número y año de la serie
-                contrato.serie_facturacion_ultimo_numero = proximo_secuencial_para_este_contrato
-                contrato.serie_facturacion_ano_actual = year
-                if contrato not in contratos_modificados_por_actualizacion_renta_o_serie:
-                    contratos_modificados_por_actualizacion_renta_o_serie.append(contrato)
-                log_mensajes_este_contrato_iteracion.append(f"Serie Contrato '{prefijo_de_contrato}', año {year}. Próximo secuencial: {proximo_secuencial_para_este_contrato}.")
-
-            else: 
-                # --- CASO 2: El contrato NO tiene un prefijo de serie definido ---
-                serie_usada_log_detalle_local = "Sin prefijo (Año-Secuencial)"
-                # El prefijo para la BD contendrá el ID del contrato y el año.
-                # La parte visible será AÑO-SECUENCIAL.
-                
-                # Usaremos el último número y año guardados en el contrato si existen,
-                # incluso sin prefijo, para mantener una secuencia por contrato/año.
-                ultimo_numero_guardado_sin_prefijo = contrato.serie_facturacion_ultimo_numero or 0
-                ano_serie_guardado_sin_prefijo = contrato.serie_facturacion_ano_actual
-                formato_digitos_sin_prefijo = contrato.serie_facturacion_formato_digitos or 3 # Default 3 para este caso si lo prefieres
-
-                proximo_secuencial_sin_prefijo = 0
-                if ano_serie_guardado_sin_prefijo is None or ano_serie_guardado_sin_prefijo != year:
-                    proximo_secuencial_sin_prefijo = 1
-                else:
-                    proximo_secuencial_sin_prefijo = ultimo_numero_guardado_sin_prefijo + 1
-                
-                secuencial_formateado_sin_prefijo = f"{proximo_secuencial_sin_prefijo:0{formato_digitos_sin_prefijo}d}"
-                
-                numero_factura_visible_final = f"{year}-{secuencial_formateado_sin_prefijo}"
-                numero_factura_bd_final = f"C{contrato.id}-{numero_factura_visible_final}"
-
-                # Actualizar el contrato con el último número y año, incluso sin prefijo,
-                # para que la secuencia continúe correctamente la próxima vez.
-                contrato.serie_facturacion_ultimo_numero = proximo_secuencial_sin_prefijo
-                contrato.serie_facturacion_ano_actual = year
-                # No es necesario guardar `serie_facturacion_prefijo = None` explícitamente si ya es None.
-                # `serie_facturacion_formato_digitos` se mantendría o usaría el default.
-                if contrato not in contratos_modificados_por_actualizacion_renta_o_serie:
-                    contratos_modificados_por_actualizacion_renta_o_serie.append(contrato)
-                log_mensajes_este_contrato_iteracion.append(f"Serie sin prefijo. Próximo secuencial para contrato {contrato.id}, año {year}: {proximo_secuencial_sin_prefijo}")
-
-            # --- FIN LÓGICA MODIFICADA ---
-            
-            current_app.logger.info(f"Contrato {contrato.numero_contrato}: Info Serie Factura: {' '.join(log_mensajes_este_contrato_iteracion)} | Serie Usada Final: {serie_usada_log_detalle_local}. Número BD: {numero_factura_bd_final}, Visible: {numero_factura_visible_final}")
-            
-            
-            
-            notas_factura_final_list = [f"Factura correspondiente al periodo de {MESES_STR[month]}/{year}."]
-            if info_indice_para_esta_factura and isinstance(info_indice_para_esta_factura, dict):
-                tipo_idx, mes_idx, ano_idx, porc_idx = info_indice_para_esta_factura.get('type'), info_indice_para_esta_factura.get('month'), info_indice_para_esta_factura.get('year'), info_indice_para_esta_factura.get('percentage')
-                nota_idx = f"Incluye actualización de renta por {tipo_idx or 'Índice'}"
-                if mes_idx and ano_idx: nota_idx += f" de {MESES_STR[int(mes_idx)]}/{ano_idx}"
-                if porc_idx is not None: nota_idx += f" ({porc_idx:+.2f}%)".replace('.', ',')
-                notas_factura_final_list.append(nota_idx + ".")
-            if any("Atrasos act." in item.get("description","") for item in items_actualizacion_y_atrasos if isinstance(item, dict)): notas_factura_final_list.append("Incluye regularización de atrasos por actualización de índice.")
-            if gastos_objetos_a_actualizar_en_bd: notas_factura_final_list.append(f"Incluye {len(gastos_objetos_a_actualizar_en_bd)} gasto(s) repercutido(s).")
-            notas_factura_para_bd = " ".join(notas_factura_final_list)
-
-            factura_temporal_obj = Factura(numero_factura=numero_factura_bd_final, contrato_id=contrato.id, inquilino_id=contrato.inquilino_id, propiedad_id=contrato.propiedad_id, fecha_emision=fecha_emision_calculada, subtotal=subtotal_calculado_factura, iva=iva_monto_calculado_factura, irpf=irpf_monto_calculado_factura, total=total_calculado_factura, estado='pendiente', items_json=json.dumps(items_json_final_factura, ensure_ascii=False), notas=notas_factura_para_bd.strip(), iva_rate_applied=tasa_iva_a_aplicar_factura, irpf_rate_applied=tasa_irpf_a_aplicar_factura, indice_aplicado_info=info_indice_para_esta_factura)
-            db.session.add(factura_temporal_obj); db.session.flush()
-            
-            if factura_temporal_obj.id and contrato.propiedad_ref and contrato.propiedad_ref.propietario_ref:
-                nombre_pdf = f"factura_{factura_temporal_obj.numero_factura_mostrado_al_cliente}.pdf"
-                ruta_pdf = get_owner_document_path(contrato.propiedad_ref.propietario_ref, "Facturas Alquiler", year, nombre_pdf)
-                if ruta_pdf:
-                    pdf_buffer = generate_invoice_pdf(factura_temporal_obj.id)
-                    if pdf_buffer:
-                        try:
-                            with open(ruta_pdf, 'wb') as f_pdf: f_pdf.write(pdf_buffer.getbuffer())
-                        except Exception as e_save_pdf: current_app.logger.error(f"Error guardando PDF {nombre_pdf}: {e_save_pdf}"); errores.append(f"Adv: No se guardó PDF para {factura_temporal_obj.numero_factura}.")
-                    else: errores.append(f"Adv: No se generó PDF para {contrato.numero_contrato}.")
-            
-            if factura_temporal_obj not in facturas_nuevas_a_anadir_db: facturas_nuevas_a_anadir_db.append(factura_temporal_obj)
-            nuevas += 1
-            if gastos_objetos_a_actualizar_en_bd: gastos_a_vincular_con_factura[factura_temporal_obj] = gastos_objetos_a_actualizar_en_bd
-
-            if nueva_renta_base_contrato_a_persistir is not None and contrato.precio_mensual != nueva_renta_base_contrato_a_persistir:
-                hist_entry = HistorialActualizacionRenta(contrato_id=contrato.id, factura_id=factura_temporal_obj.id, fecha_actualizacion=date(year,month,1), renta_anterior=renta_original_contrato_antes_calculo, renta_nueva=nueva_renta_base_contrato_a_persistir, tipo_actualizacion=contrato.tipo_actualizacion_renta)
-                if info_indice_para_esta_factura:
-                    hist_entry.indice_nombre=info_indice_para_esta_factura.get('type'); hist_entry.indice_mes=info_indice_para_esta_factura.get('month')
-                    hist_entry.indice_ano=info_indice_para_esta_factura.get('year'); hist_entry.indice_porcentaje=Decimal(str(info_indice_para_esta_factura.get('percentage','0.0')))
-                if contrato.tipo_actualizacion_renta in ['fijo', 'indice_mas_fijo'] and contrato.importe_actualizacion_fija: hist_entry.importe_fijo_aplicado = contrato.importe_actualizacion_fija
-                historial_actualizaciones_a_anadir.append(hist_entry)
-                contrato.precio_mensual = nueva_renta_base_contrato_a_persistir
-                if contrato.id not in contratos_actualizados_con_renta: contratos_actualizados_con_renta.append(contrato.id)
-                if contrato not in contratos_modificados_por_actualizacion_renta_o_serie: contratos_modificados_por_actualizacion_renta_o_serie.append(contrato)
-            if db.session.is_modified(contrato) and contrato not in contratos_modificados_por_actualizacion_renta_o_serie: contratos_modificados_por_actualizacion_renta_o_serie.append(contrato)
+                for gasto_a_upd in gastos_del_mes:
+                    gasto_a_upd.factura_id = factura_temporal_obj.id; gasto_a_upd.estado = 'Facturado'; gasto_a_upd.integrated = True
+
+                nueva_renta_base_contrato_a_persistir, info_indice_para_esta_factura = propuesta['nueva_renta'], propuesta['indice_aplicado']
+                if nueva_renta_base_contrato_a_persistir is not None and contrato.precio_mensual != nueva_renta_base_contrato_a_persistir:
+                    hist_entry = HistorialActualizacionRenta(contrato_id=contrato.id, factura_id=factura_temporal_obj.id, fecha_actualizacion=date(year,month,1), renta_anterior=propuesta['renta_anterior'], renta_nueva=nueva_renta_base_contrato_a_persistir, tipo_actualizacion=contrato.tipo_actualizacion_renta)
+                    if info_indice_para_esta_factura:
+                        hist_entry.indice_nombre=info_indice_para_esta_factura.get('type'); hist_entry.indice_mes=info_indice_para_esta_factura.get('month')
+                        hist_entry.indice_ano=info_indice_para_esta_factura.get('year'); hist_entry.indice_porcentaje=Decimal(str(info_indice_para_esta_factura.get('percentage','0.0')))
+                    if contrato.tipo_actualizacion_renta in ['fijo', 'indice_mas_fijo'] and contrato.importe_actualizacion_fija: hist_entry.importe_fijo_aplicado = contrato.importe_actualizacion_fija
+                    db.session.add(hist_entry)
+                    contrato.precio_mensual = nueva_renta_base_contrato_a_persistir
+                    renta_actualizada_este_contrato = True
+                db.session.flush()
 
         except ValueError as ve_calc: 
-            db.session.rollback(); errores.append(f"Error Contrato {contrato.numero_contrato}: {ve_calc}"); omitidas +=1
+            reservas_serie.undo(clave_serie, year) # El número lo usará el siguiente mes del contrato
+            errores.append(f"Error Contrato {contrato_str}: {ve_calc}"); omitidas +=1
             current_app.logger.warning(f"ValueError procesando Contrato {contrato.numero_contrato}: {ve_calc}")
             # ... (lógica de notificación por error de índice) ...
+            if traza is not None:
+                traza.add('error', mensaje=str(ve_calc))
+                _guardar_traza(traza, contrato, year, month, 'error', renta_anterior=renta_anterior)
+            continue
         except Exception as e_item: 
-            db.session.rollback(); errores.append(f"Error Inesperado Contrato {contrato.numero_contrato}: {e_item}"); omitidas +=1
+            reservas_serie.undo(clave_serie, year)
+            errores.append(f"Error Inesperado Contrato {contrato_str}: {e_item}"); omitidas +=1
             current_app.logger.error(f"Error procesando contrato {contrato.numero_contrato}: {e_item}\n{traceback.format_exc()}")
-            if factura_temporal_obj in facturas_nuevas_a_anadir_db: facturas_nuevas_a_anadir_db.remove(factura_temporal_obj); nuevas = max(0, nuevas-1)
-            if factura_temporal_obj in gastos_a_vincular_con_factura: del gastos_a_vincular_con_factura[factura_temporal_obj]
+            if traza is not None:
+                traza.add('error', mensaje=str(e_item), tipo=type(e_item).__name__)
+                _guardar_traza(traza, contrato, year, month, 'error', renta_anterior=renta_anterior)
+            continue
+
+        if traza is not None:
+            _guardar_traza(traza, contrato, year, month, 'creada', factura_temporal_obj, renta_anterior, contrato.precio_mensual)
+        nuevas += 1
+        facturas_lote.append(factura_temporal_obj)
+        series_lote.append((clave_serie, year))
+        if renta_actualizada_este_contrato: contratos_renta_lote.append(contrato.id)
+        if len(facturas_lote) >= lote_size: _confirmar_lote()
 
-    if facturas_nuevas_a_anadir_db or nuevas_notificaciones_a_anadir_db or contratos_modificados_por_actualizacion_renta_o_serie or any(gastos_a_vincular_con_factura.values()) or historial_actualizaciones_a_anadir:
+    if progress_callback: progress_callback(total_contratos, total_contratos)
+    _confirmar_lote()
+    try:
+        reservas_serie.release(); db.session.commit()
+    except Exception as e_release:
+        db.session.rollback()
+        current_app.logger.warning(f"No se pudieron devolver los números de factura no usados: {e_release}")
+    return nuevas, omitidas, errores, list(set(contratos_actualizados_con_renta)), committed_invoice_ids, index_lookup.stats(), total_contratos
+
+def preview_invoices_range(from_year: int, from_month: int, to_year: int, to_month: int, owner_ids=None):
+    """
+    Vista previa de generate_invoices_range: mismo cálculo de renta, numeración y gastos, pero sobre
+    instantáneas de los contratos (ContractSnapshot). No hace flush ni commit ni modifica ningún objeto de la sesión.
+
+    Returns:
+        dict: propuestas (una por factura que se generaría), omitidas, errores y resumen (índices).
+    """
+    resultado = {'propuestas': [], 'omitidas': 0, 'errores': [], 'resumen': {}}
+    meses_rango = _months_in_range(from_year, from_month, to_year, to_month)
+    if not meses_rango:
+        resultado['errores'].append(f"Rango de meses inválido: {from_month}/{from_year} - {to_month}/{to_year}.")
+        return resultado
+    periodo_str = f"{MESES_STR[from_month]}/{from_year}"
+    if len(meses_rango) > 1: periodo_str += f" - {MESES_STR[to_month]}/{to_year}"
+    if owner_ids is not None and not owner_ids:
+        resultado['errores'].append("No tienes propietarios asignados para generar facturas.")
+        return resultado
+
+    iva_rate_global, irpf_rate_global = get_rates()
+    permitir_sin_indice = _allow_missing_index()
+    contratos, facturas_existentes, index_lookup, gastos_pendientes_por_contrato = _load_generation_data(meses_rango, owner_ids)
+    if not contratos:
+        resultado['errores'] = _no_contracts_errors(periodo_str, owner_ids)
+        return resultado
+
+    trabajo_por_mes = _contracts_by_month(meses_rango, contratos)
+    reservas_serie = SeriesReservation(preview=True) # Solo lee los contadores
+    reservas_serie.reserve(_series_numbers_needed(trabajo_por_mes, facturas_existentes))
+    estados_contrato = {} # contrato_id -> ContractSnapshot, avanza mes a mes
+    gastos_ya_propuestos = set()
+    for year, month, contrato in trabajo_por_mes:
+        if (contrato.id, year, month) in facturas_existentes:
+            resultado['omitidas'] += 1
+            continue
+        contrato_str = contrato.numero_contrato if len(meses_rango) == 1 else f"{contrato.numero_contrato} ({MESES_STR[month]}/{year})"
+        gastos_del_mes = [gasto for gasto in _pending_expenses_for_month(gastos_pendientes_por_contrato.get(contrato.id, []), year, month)
+                          if gasto.id not in gastos_ya_propuestos]
+        # Si el cálculo falla, el estado del contrato y su numeración no avanzan (como el SAVEPOINT en la generación real)
+        estado = estados_contrato.get(contrato.id) or ContractSnapshot.from_contract(contrato)
+        clave_serie = contract_series_key(contrato.id)
+        numero_serie = reservas_serie.take(clave_serie, year)
         try:
-            if nuevas_notificaciones_a_anadir_db: db.session.add_all(nuevas_notificaciones_a_anadir_db)
-            if historial_actualizaciones_a_anadir: db.session.add_all(historial_actualizaciones_a_anadir)
-            for contrato_mod in contratos_modificados_por_actualizacion_renta_o_serie:
-                if contrato_mod not in db.session: db.session.add(contrato_mod) # Si no está ya en sesión (aunque debería)
-            
-            # db.session.flush() # No es estrictamente necesario aquí si el flush ya se hizo en el bucle para obtener IDs de factura.
-            
-            for factura_obj_con_gastos, lista_gastos in gastos_a_vincular_con_factura.items():
-                if factura_obj_con_gastos.id: 
-                    for gasto_a_upd in lista_gastos: 
-                        gasto_a_upd.factura_id = factura_obj_con_gastos.id; gasto_a_upd.estado = 'Facturado'; gasto_a_upd.integrated = True
-                        if gasto_a_upd not in db.session: db.session.add(gasto_a_upd) # Solo añadir si no estaba ya
-            
-            db.session.commit()
-            committed_invoice_ids = [f.id for f in facturas_nuevas_a_anadir_db if f.id]
-        except Exception as e_commit: 
-            db.session.rollback(); errores.append(f"Error crítico commit final: {e_commit}")
-            current_app.logger.error(f"Error crítico en commit final generate_monthly_invoices: {e_commit}\n{traceback.format_exc()}")
-            nuevas=0; omitidas=len(contratos_a_procesar); contratos_actualizados_con_renta=[]; committed_invoice_ids=[]
-            
-    return nuevas, omitidas, errores, list(set(contratos_actualizados_con_renta)), committed_invoice_ids
+            propuesta = _build_invoice_proposal(estado, year, month, gastos_del_mes, iva_rate_global, irpf_rate_global,
+                                                index_lookup, numero_serie, permitir_sin_indice)
+        except ValueError as ve_calc:
+            reservas_serie.undo(clave_serie, year)
+            resultado['errores'].append(f"Error Contrato {contrato_str}: {ve_calc}"); resultado['omitidas'] += 1
+            continue
+        except Exception as e_item:
+            reservas_serie.undo(clave_serie, year)
+            current_app.logger.error(f"Vista previa: error en contrato {contrato.numero_contrato}: {e_item}", exc_info=True)
+            resultado['errores'].append(f"Error Inesperado Contrato {contrato_str}: {e_item}"); resultado['omitidas'] += 1
+            continue
+
+        cambios = dict(propuesta['cambios_contrato'])
+        if propuesta['nueva_renta'] is not None and estado.precio_mensual != propuesta['nueva_renta']:
+            cambios['precio_mensual'] = propuesta['nueva_renta']
+        else:
+            propuesta['nueva_renta'] = None
+        estados_contrato[contrato.id] = estado.with_changes(**cambios)
+        gastos_ya_propuestos.update(gasto.id for gasto in gastos_del_mes)
+
+        propuesta.update({
+            'contrato_id': contrato.id, 'numero_contrato': contrato.numero_contrato,
+            'inquilino': contrato.inquilino_ref.nombre if contrato.inquilino_ref else None,
+            'year': year, 'month': month, 'gasto_ids': [gasto.id for gasto in gastos_del_mes],
+        })
+        resultado['propuestas'].append(propuesta)
+
+    resultado['resumen'] = index_lookup.stats()
+    return resultado
+
+def _render_generated_invoice_pdfs(invoice_ids):
+    """
+    Etapa 2 de la generación: guarda en la carpeta "Facturas Alquiler" del propietario el PDF
+    de cada factura ya confirmada. El render se reparte en un pool de procesos (uno por CPU
+    salvo que INVOICE_PDF_WORKERS diga otra cosa).
+
+    Returns:
+        tuple: (pdfs_generados, lista_de_advertencias_por_factura)
+    """
+    settings_obj = get_invoice_pdf_settings()
+    facturas = load_invoices_for_pdf(invoice_ids)
+
+    jobs, errores_pdf = [], []
+    numeros_por_id = {f.id: f.numero_factura for f in facturas}
+    for factura in facturas:
+        propietario = factura.propiedad_ref.propietario_ref if factura.propiedad_ref else None
+        if not propietario: continue
+        if not factura.inquilino_ref:
+            errores_pdf.append(f"Adv: No se generó PDF para {factura.numero_factura}."); continue
+        nombre_pdf = f"factura_{factura.numero_factura_mostrado_al_cliente}.pdf"
+        ruta_pdf = get_owner_document_path(propietario, "Facturas Alquiler", factura.fecha_emision.year, nombre_pdf)
+        if ruta_pdf: jobs.append((snapshot_invoice_for_render(factura, settings_obj), ruta_pdf))
+
+    pdfs_ok = 0
+    cache_pdf = get_invoice_pdf_cache()
+    rutas_y_claves = {snapshot.invoice.id: (ruta_pdf, invoice_pdf_key(snapshot)) for snapshot, ruta_pdf in jobs} if cache_pdf else {}
+    for invoice_id, error_render in render_invoice_pdfs_parallel(jobs, current_app.config.get('INVOICE_PDF_WORKERS')):
+        if error_render:
+            current_app.logger.error(f"Error guardando PDF de factura {numeros_por_id.get(invoice_id, invoice_id)}: {error_render}")
+            errores_pdf.append(f"Adv: No se guardó PDF para {numeros_por_id.get(invoice_id, invoice_id)}.")
+            continue
+        pdfs_ok += 1
+        if cache_pdf:
+            # El envío y la descarga posteriores usan esta copia en lugar de volver a renderizar
+            ruta_pdf, clave_pdf = rutas_y_claves[invoice_id]
+            try: cache_pdf.put_file(clave_pdf, ruta_pdf)
+            except OSError as e_cache: current_app.logger.warning(f"No se pudo copiar a la caché el PDF de la factura {invoice_id}: {e_cache}")
+    return pdfs_ok, errores_pdf
 
 @facturas_bp.route('/enviar_masivo', methods=['GET', 'POST'])
 @login_required # Asegurar que está protegido
@@ -654,6 +837,16 @@ def enviar_facturas_masivo():
     csrf_form = CSRFOnlyForm() # Para el método GET y el formulario
 
     if request.method == 'POST':
+        # La página envía el formulario por fetch y espera JSON (con la URL de progreso); sin JS, flash y redirección
+        wants_json = request.accept_mimetypes.best == 'application/json'
+
+        def _responder(mensajes, status=200, **extra):
+            if wants_json:
+                return jsonify({"messages": [{"category": categoria, "message": texto} for texto, categoria in mensajes], **extra}), status
+            for texto, categoria in mensajes:
+                flash(texto, categoria)
+            return redirect(url_for('facturas_bp.enviar_facturas_masivo'))
+
         try:
             year = int(request.form['year'])
             month = int(request.form['month'])
@@ -663,14 +856,10 @@ def enviar_facturas_masivo():
             current_app.logger.info(f"Iniciando búsqueda de facturas para envío masivo por {current_user.username}: {month}/{year}")
 
             # --- Query Base para Facturas ---
+            inicio_mes, inicio_mes_siguiente = month_bounds(year, month)
             query_facturas = db.session.query(Factura).filter(
-                extract('year', Factura.fecha_emision) == year,
-                extract('month', Factura.fecha_emision) == month
-            ).options( # Cargar relaciones necesarias para la función de envío
-                joinedload(Factura.inquilino_ref),
-                joinedload(Factura.propiedad_ref).joinedload(Propiedad.propietario_ref),
-                joinedload(Factura.contrato_ref),
-                selectinload(Factura.gastos_incluidos) # Para adjuntar gastos
+                Factura.fecha_emision >= inicio_mes,
+                Factura.fecha_emision < inicio_mes_siguiente
             )
 
             # *** APLICAR FILTRO POR PROPIETARIO ACTIVO Y ROL ***
@@ -687,9 +876,8 @@ def enviar_facturas_masivo():
                 # Si no hay propietario activo, aplicar filtro por rol para gestores
                 assigned_owner_ids = [p.id for p in current_user.propietarios_asignados]
                 if not assigned_owner_ids:
-                    flash(f"No tienes propietarios asignados para el envío masivo de facturas.", 'warning')
                     current_app.logger.warning(f"Usuario {current_user.username} (rol {current_user.role}) intentó envío masivo sin propietarios asignados.")
-                    return redirect(url_for('facturas_bp.enviar_facturas_masivo'))
+                    return _responder([("No tienes propietarios asignados para el envío masivo de facturas.", 'warning')])
                 
                 # Filtrar facturas para que solo incluya las de propiedades de sus propietarios asignados
                 query_facturas = query_facturas.join(Factura.propiedad_ref).filter(
@@ -700,46 +888,35 @@ def enviar_facturas_masivo():
                 current_app.logger.info(f"Envío masivo como ADMIN (todos los propietarios aplicables al mes/año).")
             # *** FIN FILTRO ***
 
-            facturas_a_enviar = query_facturas.all()
+            # Solo los ids: los hilos de la bandeja de salida cargan cada factura al enviarla
+            facturas_a_enviar = [fid for (fid,) in query_facturas.with_entities(Factura.id).order_by(Factura.id)]
 
             if not facturas_a_enviar:
-                flash(f"No se encontraron facturas ({'tus ' if current_user.role != 'admin' else ''}facturas) emitidas en {MESES_STR[month]}/{year} para enviar.", 'warning')
-                return redirect(url_for('facturas_bp.enviar_facturas_masivo', csrf_form=csrf_form))
-
-            current_app.logger.info(f"Se encontraron {len(facturas_a_enviar)} facturas. Iniciando proceso de envío masivo...")
-
-            # --- Proceso de Envío Masivo (sin cambios en la lógica interna del bucle) ---
-            emails_sent_ok, emails_failed, emails_skipped = 0, 0, 0
-            for factura in facturas_a_enviar:
-                # ... (tu lógica existente para comprobar email de inquilino y llamar a _send_single_invoice_email) ...
-                if not factura.inquilino_ref or not factura.inquilino_ref.email:
-                     current_app.logger.warning(f"[Envío Masivo] Saltando Factura {factura.numero_factura}: Inquilino sin email.")
-                     emails_skipped += 1
-                     continue
-                try:
-                    success = _send_single_invoice_email(factura.id, include_bcc_owner=True)
-                    if success is True: emails_sent_ok += 1
-                    elif success is False: emails_failed += 1
-                    else: emails_skipped +=1 # Considerar valor inesperado como omitido/otro
-                except Exception as e_send_masivo:
-                     current_app.logger.error(f"[Envío Masivo] Excepción enviando email para factura ID {factura.id}: {e_send_masivo}", exc_info=True)
-                     emails_failed += 1
-            # --- Fin Proceso de Envío ---
-
-            # Mensajes flash con el resumen
-            flash(f"Proceso de envío masivo para {MESES_STR[month]}/{year} completado.", 'info')
-            if emails_sent_ok > 0: flash(f"{emails_sent_ok} email(s) enviados/omitidos correctamente.", 'success')
-            if emails_skipped > 0: flash(f"{emails_skipped} factura(s) omitidas (ej. inquilino sin email).", 'warning')
-            if emails_failed > 0: flash(f"Hubo errores críticos al enviar {emails_failed} email(s). Revisa los logs.", 'danger')
-
-        except ValueError as ve:
-            flash(f"Error en los datos: {ve}", 'danger')
+                return _responder([(f"No se encontraron facturas ({'tus ' if current_user.role != 'admin' else ''}facturas) emitidas en {MESES_STR[month]}/{year} para enviar.", 'warning')])
+
+            current_app.logger.info(f"Se encontraron {len(facturas_a_enviar)} facturas. Encolando envío masivo...")
+
+            # --- Encolar en la bandeja de salida (el envío SMTP se hace en segundo plano) ---
+            con_email, sin_email = _split_by_tenant_email(facturas_a_enviar)
+            if sin_email:
+                current_app.logger.warning(f"[Envío Masivo] Saltando {len(sin_email)} factura(s) con inquilino sin email: ids {sin_email[:20]}")
+            lote = uuid.uuid4().hex
+            encoladas = enqueue_invoice_emails(con_email, include_bcc_owner=True, user_id=current_user.id, lote=lote,
+                                               omitidas={fid: 'NO_EMAIL: inquilino sin email' for fid in sin_email})
+
+            # Resumen y URL de progreso del lote
+            mensajes = [(f"Envío masivo para {MESES_STR[month]}/{year} en cola: los emails se envían en segundo plano.", 'info')]
+            if encoladas: mensajes.append((f"{len(encoladas)} email(s) en cola de envío.", 'success'))
+            if len(con_email) > len(encoladas): mensajes.append((f"{len(con_email) - len(encoladas)} factura(s) ya estaban en cola de envío.", 'info'))
+            if sin_email: mensajes.append((f"{len(sin_email)} factura(s) omitidas (inquilino sin email).", 'warning'))
+            return _responder(mensajes, 202, lote=lote, status_url=url_for('facturas_bp.estado_envio_masivo', lote=lote))
+
+        except (KeyError, ValueError) as ve:
+            return _responder([(f"Error en los datos: {ve}", 'danger')], 400)
         except Exception as e:
-            flash(f"Error inesperado durante el envío masivo: {e}", 'danger')
             current_app.logger.error(f"Error en POST /enviar_masivo: {e}", exc_info=True)
-            db.session.rollback() # Rollback por si acaso, aunque aquí no modificamos BD
-
-        return redirect(url_for('facturas_bp.enviar_facturas_masivo'))
+            db.session.rollback() # Rollback por si acaso
+            return _responder([(f"Error inesperado durante el envío masivo: {e}", 'danger')], 500)
 
     # --- GET Request ---
     # Preparar datos para los selectores de año/mes (similar a generar_facturas)
@@ -877,9 +1054,8 @@ def borrar_facturas_masivo():
             joinedload(Factura.gastos_incluidos),
             joinedload(Factura.actualizacion_renta_origen) # Cargar el historial asociado
         ).filter(
-            extract('year', Factura.fecha_emision) == ano,
-            extract('month', Factura.fecha_emision) >= mes_desde,
-            extract('month', Factura.fecha_emision) <= mes_hasta
+            Factura.fecha_emision >= date(ano, mes_desde, 1),
+            Factura.fecha_emision < month_bounds(ano, mes_hasta)[1]
         )
 
         if propietario_id_str and propietario_id_str != 'all':
@@ -974,7 +1150,8 @@ def borrar_facturas_masivo():
                 
                 ultima_factura_restante_db = db.session.query(Factura.numero_factura)\
                     .filter(Factura.contrato_id == contrato_id_serie,
-                            extract('year', Factura.fecha_emision) == ano_serie_a_recalcular)\
+                            Factura.fecha_emision >= date(ano_serie_a_recalcular, 1, 1),
+                            Factura.fecha_emision < date(ano_serie_a_recalcular + 1, 1, 1))\
                     .order_by(Factura.id.desc()).first()
 
                 if ultima_factura_restante_db:
@@ -986,18 +1163,21 @@ def borrar_facturas_masivo():
                         contrato_obj_serie.serie_facturacion_ultimo_numero = nuevo_ult_num
                         contrato_obj_serie.serie_facturacion_ano_actual = ano_serie_a_recalcular
                         db.session.add(contrato_obj_serie)
+                        sync_contract_series_counter(contrato_obj_serie)
                         current_app.logger.info(f"Contrato {contrato_obj_serie.numero_contrato}: Serie ajustada a {nuevo_ult_num} para año {ano_serie_a_recalcular}.")
                     except Exception as e_parse:
                         current_app.logger.warning(f"Fallo parseo serie para contrato {contrato_obj_serie.numero_contrato} (factura {ultima_factura_restante_db[0]}): {e_parse}. Reseteando para {ano_serie_a_recalcular}.")
                         contrato_obj_serie.serie_facturacion_ultimo_numero = 0
                         contrato_obj_serie.serie_facturacion_ano_actual = ano_serie_a_recalcular
                         db.session.add(contrato_obj_serie)
+                        sync_contract_series_counter(contrato_obj_serie)
                 else: # No quedan facturas en este año de serie
                     if contrato_obj_serie.serie_facturacion_ano_actual == ano_serie_a_recalcular or \
                        (contrato_obj_serie.serie_facturacion_ano_actual is None and ano_serie_a_recalcular == ano): # si el año de la serie era el que se borró
                         contrato_obj_serie.serie_facturacion_ultimo_numero = 0
                         contrato_obj_serie.serie_facturacion_ano_actual = ano_serie_a_recalcular # Mantener el año para el que se reseteó
                         db.session.add(contrato_obj_serie)
+                        sync_contract_series_counter(contrato_obj_serie)
                         current_app.logger.info(f"Contrato {contrato_obj_serie.numero_contrato}: No quedan facturas para año {ano_serie_a_recalcular}. Serie reseteada.")
             
             db.session.commit()
@@ -1097,13 +1277,9 @@ def add_factura():
         irpf_amt = (subtotal * irpf_rate).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
         total = (subtotal + iva_amt - irpf_amt).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
 
-        # Generar número de factura manual
+        # Generar número de factura manual (contador por prefijo; se deshace con el rollback si algo falla)
         prefix = f"MAN-{prop_id}-{tenant_id}-{fecha.strftime('%Y%m%d')}-"
-        last_num_str = db.session.query(func.max(Factura.numero_factura)).filter(Factura.numero_factura.like(f"{prefix}%")).scalar()
-        seq = 1
-        if last_num_str:
-            try: seq = int(last_num_str.rsplit('-', 1)[-1]) + 1
-            except (ValueError, IndexError): pass
+        seq = allocate_series_numbers(prefix, fecha.year)
         numero = f"{prefix}{seq:03d}"
 
         # Crear y guardar factura
@@ -1169,6 +1345,7 @@ def delete_factura(id):
     renta_revertida_info = None; gastos_reseteados_count = 0
 
     try:
+        clave_pdf_borrada = invoice_pdf_cache_key(inv, get_invoice_pdf_settings())
         if hasattr(inv, 'gastos_incluidos') and inv.gastos_incluidos:
             for gasto in inv.gastos_incluidos: gasto.estado = 'Pendiente'; gasto.integrated = False; gasto.factura_id = None; db.session.add(gasto); gastos_reseteados_count += 1
         
@@ -1187,10 +1364,12 @@ def delete_factura(id):
                 if contrato_asociado.serie_facturacion_ultimo_numero == sec_borrado_int:
                     contrato_asociado.serie_facturacion_ultimo_numero = max(0, sec_borrado_int - 1)
                     db.session.add(contrato_asociado)
+                    sync_contract_series_counter(contrato_asociado)
             except: pass # Ignorar errores de parseo de serie aquí
 
         db.session.delete(inv)
         db.session.commit() 
+        discard_invoice_pdf(clave_pdf_borrada)
         flash_msg = f'Factura {numero_factura_visible_borrada} eliminada.'
         if gastos_reseteados_count > 0: flash_msg += f" {gastos_reseteados_count} gasto(s) reseteados."
         if renta_revertida_info: flash_msg += f" Renta del contrato revertida de {renta_revertida_info['nueva']:.2f}€ a {renta_revertida_info['anterior']:.2f}€."
@@ -1273,24 +1452,30 @@ def ver_factura(id):
 
 @facturas_bp.route('/download/<int:id>', methods=['GET'])
 def download_factura(id):
-    """Genera y descarga el PDF de una factura."""
-    invoice = Factura.query.get_or_404(id)
+    """Descarga el PDF de una factura (desde la caché de PDFs si ya se renderizó con estos mismos datos)."""
+    invoice = Factura.query.options(
+        joinedload(Factura.inquilino_ref),
+        joinedload(Factura.propiedad_ref).joinedload(Propiedad.propietario_ref),
+        joinedload(Factura.contrato_ref)
+    ).get(id)
+    if invoice is None: abort(404)
     try:
-        current_app.logger.info(f"Iniciando generación PDF para Factura ID: {id}")
-        pdf_buffer = generate_invoice_pdf(id) # Llama a la función importada (v1 o v2)
+        pdf = get_invoice_pdf(invoice, get_invoice_pdf_settings())
 
-        if pdf_buffer:
+        if pdf:
             filename = f"factura_{invoice.numero_factura_mostrado_al_cliente.replace('/', '-')}.pdf"
-            current_app.logger.info(f"Enviando PDF generado: {filename}")
+            # ETag = clave de la caché: el navegador recibe 304 si la factura no ha cambiado
             return send_file(
-                pdf_buffer,
+                pdf.path or io.BytesIO(pdf.data),
                 mimetype='application/pdf',
                 as_attachment=True,
-                download_name=filename
+                download_name=filename,
+                etag=pdf.etag,
+                conditional=True
             )
         else:
             flash("Error interno al generar el PDF de la factura.", 'danger')
-            current_app.logger.error(f"generate_invoice_pdf devolvió None para Factura ID: {id}")
+            current_app.logger.error(f"get_invoice_pdf devolvió None para Factura ID: {id}")
             return redirect(url_for('facturas_bp.ver_factura', id=id))
 
     except Exception as e:
@@ -1299,6 +1484,62 @@ def download_factura(id):
         # Considerar abort(500) si es un error grave irrecuperable
         return redirect(url_for('facturas_bp.ver_factura', id=id))
 
+DESCARGA_LOTE_CHUNK = 100 # Facturas cargadas por consulta al generar la descarga por lotes
+
+@facturas_bp.route('/descargar_lote', methods=['GET'])
+@login_required
+def descargar_facturas_lote():
+    """
+    Descarga en un solo fichero las facturas visibles para el usuario, filtradas por propietario_id,
+    contrato_id, year y month: un ZIP con un PDF por factura (formato=zip) o un PDF combinado (formato=pdf).
+    La respuesta se envía a medida que se obtiene cada PDF (de la caché o renderizado), sin montarla en memoria.
+    """
+    formato = request.args.get('formato', 'zip')
+    propietario_id = request.args.get('propietario_id', type=int)
+    contrato_id = request.args.get('contrato_id', type=int)
+    year = request.args.get('year', type=int)
+    month = request.args.get('month', type=int)
+    if formato not in ('zip', 'pdf') or (month and not year) or (month and not 1 <= month <= 12):
+        abort(400)
+
+    query = get_filtered_facturas(include_relations=False) # Ya limitado al propietario activo / asignados
+    if propietario_id:
+        query = query.filter(Factura.propiedad_id.in_(db.session.query(Propiedad.id).filter(Propiedad.propietario_id == propietario_id)))
+    if contrato_id:
+        query = query.filter(Factura.contrato_id == contrato_id)
+    if year:
+        inicio, fin = month_bounds(year, month) if month else (date(year, 1, 1), date(year + 1, 1, 1))
+        query = query.filter(Factura.fecha_emision >= inicio, Factura.fecha_emision < fin)
+    ids = [fid for (fid,) in query.with_entities(Factura.id).order_by(Factura.fecha_emision, Factura.id)]
+    if not ids:
+        flash("No hay facturas que coincidan con los filtros para descargar.", 'warning')
+        return redirect(url_for('facturas_bp.listar_facturas'))
+
+    partes = ['facturas']
+    if propietario_id: partes.append(f"prop{propietario_id}")
+    if contrato_id: partes.append(f"contrato{contrato_id}")
+    if year: partes.append(f"{year}-{month:02d}" if month else str(year))
+    nombre_descarga = f"{'_'.join(partes)}.{formato}"
+    current_app.logger.info(f"Descarga por lotes ({formato}) de {len(ids)} facturas por {current_user.username}: {nombre_descarga}")
+
+    def _pdfs():
+        settings_obj = get_invoice_pdf_settings()
+        for inicio_lote in range(0, len(ids), DESCARGA_LOTE_CHUNK):
+            for invoice in load_invoices_for_pdf(ids[inicio_lote:inicio_lote + DESCARGA_LOTE_CHUNK]):
+                pdf = get_invoice_pdf(invoice, settings_obj)
+                if pdf is None:
+                    current_app.logger.warning(f"Descarga por lotes: factura {invoice.id} omitida (sin PDF)")
+                    continue
+                # numero_factura (no el mostrado al cliente, que se repite entre series) para que no choquen en el ZIP
+                yield f"factura_{invoice.numero_factura.replace('/', '-')}.pdf", pdf
+
+    if formato == 'zip':
+        cuerpo, mimetype = stream_invoice_zip(_pdfs()), 'application/zip'
+    else:
+        cuerpo, mimetype = stream_merged_pdf(pdf.read_bytes() for _, pdf in _pdfs()), 'application/pdf'
+    return Response(stream_with_context(cuerpo), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{nombre_descarga}"'})
+
 @facturas_bp.route('/edit/<int:id>', methods=['POST'])
 @role_required('admin', 'gestor')
 @validate_entity_access('factura', 'id')
@@ -1314,6 +1555,7 @@ def edit_factura(id):
         return redirect(url_for('facturas_bp.listar_facturas'))
 
     try:
+        clave_pdf_anterior = invoice_pdf_cache_key(inv, get_invoice_pdf_settings())
         items_json_str = request.form.get('editItemsJson', '[]') # Input oculto donde JS pone el JSON
         notas = request.form.get('editInvoiceNotes', '').strip() or None
         
@@ -1369,6 +1611,7 @@ def edit_factura(id):
         inv.notas = notas
 
         db.session.commit()
+        discard_invoice_pdf(clave_pdf_anterior) # El PDF editado tendrá otra clave; el anterior ya no se sirve
         flash(f'Factura {inv.numero_factura} actualizada correctamente.', 'success')
 
     except (ValueError, json.JSONDecodeError) as ve:
@@ -1448,13 +1691,10 @@ def gestionar_gastos():
         for file_item in files: # Cambiado 'file' a 'file_item' para evitar conflicto con la función allowed_file
             if file_item and file_item.filename and allowed_expense_file(file_item.filename):
                 original_filename_user = file_item.filename
-                
-                fecha_creacion_str = datetime.now().strftime("%Y%m%d-%H%M%S")
-                concepto_saneado = "".join(c if c.isalnum() or c in (' ', '-') else '_' for c in concepto.strip()[:50])
                 ext_gasto = original_filename_user.rsplit('.', 1)[1].lower() if '.' in original_filename_user else ''
                 
                 # Nombre para guardar en disco: "YYYYMMDD-HHMMSS - SaneadoConcepto.ext"
-                nombre_archivo_gasto_en_disco = f"{fecha_creacion_str} - {concepto_saneado}.{ext_gasto}" if ext_gasto else f"{fecha_creacion_str} - {concepto_saneado}"
+                nombre_archivo_gasto_en_disco = expense_disk_filename(concepto, original_filename_user, datetime.now())
                 
                 # Nombre para la BD (único con UUID)
                 nombre_archivo_gasto_para_bd = f"gasto_{uuid.uuid4().hex}.{ext_gasto}" if ext_gasto else f"gasto_{uuid.uuid4().hex}"
@@ -1464,7 +1704,7 @@ def gestionar_gastos():
                 
                 full_file_path_on_disk = get_owner_document_path(
                     propietario=propietario_del_gasto,
-                    subfolder_type="Facturas Gastos",
+                    subfolder_type=EXPENSE_SUBFOLDER,
                     year=year_subfolder_gasto, 
                     filename_to_secure=nombre_archivo_gasto_en_disco # Usar el nombre descriptivo para el disco
                 )
@@ -1480,6 +1720,8 @@ def gestionar_gastos():
                         importe=importe_dec, month=month_gasto, year=year_gasto,
                         filename=nombre_archivo_gasto_para_bd, # Guardar el nombre único en BD
                         original_filename=secure_filename(original_filename_user), # Guardar el original (asegurado) en BD
+                        file_path=full_file_path_on_disk, # El email y la descarga lo leen de aquí, sin reconstruir la ruta
+                        mime_type=guess_expense_mime_type(original_filename_user),
                         estado='Pendiente'
                     )
                     db_objects_to_add.append(gasto_obj)
@@ -1675,8 +1917,11 @@ def delete_gasto(id):
     try:
         # Eliminar archivo físico
         file_deleted = False
-        if upload_folder_expenses and filename_to_delete:
-            file_path = os.path.join(upload_folder_expenses, secure_filename(filename_to_delete)) # Usar secure_filename
+        if gasto.file_path or (upload_folder_expenses and filename_to_delete):
+            # Ruta guardada al subirlo; gastos antiguos: carpeta de uploads
+            file_path = gasto.file_path or os.path.join(upload_folder_expenses, secure_filename(filename_to_delete)) # Usar secure_filename
+            cache_gastos = get_expense_file_cache()
+            if cache_gastos: cache_gastos.discard(file_path)
             if os.path.exists(file_path):
                 try:
                     os.remove(file_path); file_deleted = True
@@ -1721,66 +1966,58 @@ def download_expense(filename):
                  flash("No tienes permiso para descargar este archivo de gasto.", "danger")
                  abort(403)
 
-        year_subfolder_gasto = gasto.year if gasto.year else gasto.upload_date.year
-        
-        # Obtener la CARPETA donde se guardó el archivo
-        # El `filename_to_secure` aquí es el nombre con el que se guardó en disco
-        # que reconstruimos o recuperamos si es diferente al Gasto.filename
-        
-        # Reconstruir el nombre con el que se guardó en disco: "fecha - concepto.ext"
-        fecha_creacion_gasto_str = gasto.upload_date.strftime("%Y%m%d-%H%M%S") # Usar upload_date para consistencia
-        concepto_saneado_gasto = "".join(c if c.isalnum() or c in (' ', '-') else '_' for c in gasto.concepto.strip()[:50])
-        ext_gasto_original = ''
-        if gasto.original_filename and '.' in gasto.original_filename: # Usar extensión del original_filename
-            ext_gasto_original = gasto.original_filename.rsplit('.', 1)[1].lower()
-        
-        nombre_archivo_real_en_disco = f"{fecha_creacion_gasto_str} - {concepto_saneado_gasto}.{ext_gasto_original}" if ext_gasto_original else f"{fecha_creacion_gasto_str} - {concepto_saneado_gasto}"
-        
-        gasto_folder_path = get_owner_document_path(
-            propietario=propietario_del_gasto,
-            subfolder_type="Facturas Gastos",
-            year=year_subfolder_gasto
-            # No pasamos filename_to_secure aquí si solo queremos la carpeta
-        )
-
-        if not gasto_folder_path:
-            current_app.logger.error(f"No se pudo determinar la carpeta para el gasto con DB filename {filename} del prop. {propietario_del_gasto.id}")
+        # Ruta guardada al subirlo (o reconstruida, en gastos antiguos)
+        ruta_gasto = expense_file_path(gasto)
+        if not ruta_gasto:
+            current_app.logger.error(f"No se pudo determinar la ruta del gasto con DB filename {filename} del prop. {propietario_del_gasto.id}")
             abort(404)
-        
-        # Usamos el nombre_archivo_real_en_disco para buscarlo, y gasto.original_filename para la descarga
-        # secure_filename se aplica al nombre real en disco por si acaso.
-        return send_from_directory(gasto_folder_path, 
-                                   secure_filename(nombre_archivo_real_en_disco), # El nombre tal como está en el disco
+
+        return send_from_directory(os.path.dirname(ruta_gasto),
+                                   os.path.basename(ruta_gasto), # El nombre tal como está en el disco
                                    as_attachment=True, 
-                                   download_name=gasto.original_filename or secure_filename(nombre_archivo_real_en_disco))
+                                   download_name=gasto.original_filename or os.path.basename(ruta_gasto),
+                                   mimetype=expense_mime_type(gasto))
 
     except FileNotFoundError:
         flash(f'Archivo de gasto "{filename}" (o su nombre en disco) no encontrado.', 'warning')
-        current_app.logger.warning(f"FileNotFoundError para Gasto.filename: {filename}, intentando con nombre en disco: {nombre_archivo_real_en_disco if 'nombre_archivo_real_en_disco' in locals() else 'No calculado'}")
+        current_app.logger.warning(f"FileNotFoundError para Gasto.filename: {filename}, ruta en disco: {ruta_gasto if 'ruta_gasto' in locals() else 'No calculada'}")
         abort(404)
     except Exception as e:
         flash(f'Error al servir archivo de gasto: {e}', 'danger')
         current_app.logger.error(f"Error sirviendo archivo de gasto (DB filename: {filename}): {e}\n{traceback.format_exc()}")
         abort(500)
 
-def _send_single_invoice_email(invoice_id, include_bcc_owner=True):
+def _split_by_tenant_email(factura_ids):
+    """(ids cuyo inquilino tiene email, ids sin email o sin inquilino), en el orden de factura_ids."""
+    con_email = set()
+    for inicio in range(0, len(factura_ids), 500):
+        con_email.update(fid for (fid,) in db.session.query(Factura.id).join(Factura.inquilino_ref).filter(
+            Factura.id.in_(factura_ids[inicio:inicio + 500]), Inquilino.email.isnot(None), Inquilino.email != ''))
+    return [fid for fid in factura_ids if fid in con_email], [fid for fid in factura_ids if fid not in con_email]
+
+def _send_single_invoice_email(invoice_id, include_bcc_owner=True, invoice=None, connection=None):
+    """
+    Compone y envía por SMTP el email de una factura. Lo llaman los hilos de la bandeja de salida (myapp/email_outbox.py).
+    invoice: la factura ya cargada por load_invoices_for_pdf; si no, se carga aquí.
+    connection: objeto con send(msg), p. ej. la SmtpSession del hilo de envío; None = mail.send (una conexión SMTP por email).
+
+    Returns:
+        tuple: (resultado, motivo). resultado: SENT | NO_TENANT | NO_EMAIL | PDF_ERROR | CONFIG_ERROR | SEND_ERROR.
+    """
     current_app.logger.info(f"--- INICIO _send_single_invoice_email para ID: {invoice_id} ---")
-    invoice = Factura.query.options(
-        db.joinedload(Factura.inquilino_ref),
-        db.joinedload(Factura.propiedad_ref).joinedload(Propiedad.propietario_ref),
-        db.joinedload(Factura.contrato_ref),
-        db.selectinload(Factura.gastos_incluidos)
-    ).get(invoice_id)
+    if invoice is None:
+        facturas = load_invoices_for_pdf([invoice_id], selectinload(Factura.gastos_incluidos))
+        invoice = facturas[0] if facturas else None
 
-    if not invoice: current_app.logger.error(f"Factura ID {invoice_id} no encontrada."); return "PDF_ERROR" # Cambiado de False
+    if not invoice: current_app.logger.error(f"Factura ID {invoice_id} no encontrada."); return "PDF_ERROR", "Factura no encontrada"
     
     inquilino = invoice.inquilino_ref
     propiedad = invoice.propiedad_ref
     propietario_obj = propiedad.propietario_ref if propiedad else None
     # contrato = invoice.contrato_ref # Ya cargado
 
-    if not inquilino: current_app.logger.warning(f"Factura {invoice.id} sin inquilino."); return "NO_TENANT"
-    if not inquilino.email: current_app.logger.warning(f"Inquilino {inquilino.id} sin email."); return "NO_EMAIL"
+    if not inquilino: current_app.logger.warning(f"Factura {invoice.id} sin inquilino."); return "NO_TENANT", "Factura sin inquilino"
+    if not inquilino.email: current_app.logger.warning(f"Inquilino {inquilino.id} sin email."); return "NO_EMAIL", f"Inquilino {inquilino.nombre} sin email"
 
     ine_ipc_link = None
     if invoice.indice_aplicado_info and isinstance(invoice.indice_aplicado_info, dict):
@@ -1794,51 +2031,27 @@ def _send_single_invoice_email(invoice_id, include_bcc_owner=True):
     subject = f"Factura Alquiler: {invoice.numero_factura_mostrado_al_cliente} - {propiedad.direccion if propiedad else 'Propiedad'}"
     sender_email = settings_obj.mail_default_sender or current_app.config.get('MAIL_DEFAULT_SENDER')
     sender_name = settings_obj.mail_sender_display_name or current_app.config.get('MAIL_SENDER_DISPLAY_NAME', 'RentalSys')
-    if not sender_email: current_app.logger.error("MAIL_DEFAULT_SENDER no configurado."); return "CONFIG_ERROR"
+    if not sender_email: current_app.logger.error("MAIL_DEFAULT_SENDER no configurado."); return "CONFIG_ERROR", "Remitente (MAIL_DEFAULT_SENDER) no configurado"
     sender = (sender_name, sender_email) if sender_name else sender_email
     recipients = [inquilino.email]; bcc_list = [propietario_obj.email] if include_bcc_owner and propietario_obj and propietario_obj.email else []
-    pdf_filename = f"factura_{invoice.numero_factura_mostrado_al_cliente.replace('/', '-')}.pdf"; pdf_buffer = None
+    pdf_filename = f"factura_{invoice.numero_factura_mostrado_al_cliente.replace('/', '-')}.pdf"
 
     try:
-        pdf_buffer = generate_invoice_pdf(invoice_id)
-        if not pdf_buffer: raise RuntimeError("Generador PDF devolvió None.")
+        pdf = get_invoice_pdf(invoice, settings_obj)
+        if not pdf: current_app.logger.error(f"Generador PDF devolvió None para factura ID {invoice_id}."); return "PDF_ERROR", "No se pudo generar el PDF"
         html_body = render_template('email/invoice_email.html', invoice=invoice, inquilino=inquilino, propiedad=propiedad, propietario=propietario_obj, settings=settings_obj, ine_link=ine_ipc_link)
         msg = Message(subject=subject, sender=sender, recipients=recipients, bcc=bcc_list, html=html_body)
-        pdf_buffer.seek(0); msg.attach(filename=pdf_filename, content_type='application/pdf', data=pdf_buffer.read())
+        msg.attach(filename=pdf_filename, content_type='application/pdf', data=pdf.read_bytes())
         
-        # Adjuntar Gastos
-        expense_folder_base = current_app.config.get('UPLOAD_FOLDER_EXPENSES_REL_FOR_TASKS', 'uploads/expenses') # Necesitarás pasar la ruta base absoluta o construirla
-        if invoice.gastos_incluidos:
-            for gasto in invoice.gastos_incluidos:
-                if gasto.filename and gasto.contrato and gasto.contrato.propiedad_ref and gasto.contrato.propiedad_ref.propietario_ref:
-                    # Reconstruir ruta al archivo de gasto
-                    year_subfolder_gasto = gasto.year if gasto.year else gasto.upload_date.year
-                    fecha_creacion_gasto_str = gasto.upload_date.strftime("%Y%m%d-%H%M%S")
-                    concepto_saneado_gasto = "".join(c if c.isalnum() or c in (' ', '-') else '_' for c in gasto.concepto.strip()[:50])
-                    ext_gasto_original = gasto.original_filename.rsplit('.', 1)[1].lower() if gasto.original_filename and '.' in gasto.original_filename else ''
-                    nombre_archivo_real_en_disco = f"{fecha_creacion_gasto_str} - {concepto_saneado_gasto}.{ext_gasto_original}" if ext_gasto_original else f"{fecha_creacion_gasto_str} - {concepto_saneado_gasto}"
-
-                    gasto_file_path_on_disk = get_owner_document_path(
-                        propietario=gasto.contrato.propiedad_ref.propietario_ref,
-                        subfolder_type="Facturas Gastos", # O el subfolder_type correcto
-                        year=year_subfolder_gasto,
-                        filename_to_secure=nombre_archivo_real_en_disco # Este es el nombre en disco
-                    )
-                    if gasto_file_path_on_disk and os.path.exists(gasto_file_path_on_disk):
-                        with open(gasto_file_path_on_disk, 'rb') as fp_gasto:
-                            attach_name_gasto = gasto.original_filename or secure_filename(nombre_archivo_real_en_disco)
-                            # Determinar content_type para el gasto
-                            ext_g = attach_name_gasto.rsplit('.', 1)[-1].lower() if '.' in attach_name_gasto else ''
-                            ct_gasto = 'application/octet-stream'
-                            if ext_g == 'pdf': ct_gasto = 'application/pdf'
-                            elif ext_g in ['png', 'jpg', 'jpeg', 'gif']: ct_gasto = f'image/{ext_g}'
-                            msg.attach(filename=attach_name_gasto, content_type=ct_gasto, data=fp_gasto.read())
-                    else: current_app.logger.warning(f"Archivo de gasto no encontrado en disco: {gasto_file_path_on_disk}")
+        # Adjuntar Gastos: ruta y tipo guardados al subirlos; los bytes, de la caché compartida por los hilos de envío
+        for gasto in invoice.gastos_incluidos or []:
+            if not gasto.filename: continue
+            ruta_gasto, datos_gasto = read_expense_file(gasto)
+            if datos_gasto is None: continue # Ya registrado en read_expense_file
+            msg.attach(filename=gasto.original_filename or os.path.basename(ruta_gasto), content_type=expense_mime_type(gasto), data=datos_gasto)
         
-        mail.send(msg); return "SENT"
-    except Exception as e_mail: current_app.logger.error(f"EXCEPCIÓN enviando email factura ID {invoice_id}: {e_mail}", exc_info=True); return "SEND_ERROR"
-    finally:
-        if pdf_buffer: pdf_buffer.close()
+        (connection or mail).send(msg); return "SENT", None
+    except Exception as e_mail: current_app.logger.error(f"EXCEPCIÓN enviando email factura ID {invoice_id}: {e_mail}", exc_info=True); return "SEND_ERROR", str(e_mail)
 
 
 
@@ -1846,21 +2059,44 @@ def _send_single_invoice_email(invoice_id, include_bcc_owner=True):
 @facturas_bp.route('/send_email/<int:id>', methods=['POST'])
 @login_required
 def send_invoice_email(id):
-    """Envía la factura PDF por email al inquilino con CCO al propietario."""
-
-    # Llamamos a la función auxiliar interna
-    success = _send_single_invoice_email(id, include_bcc_owner=True) # Pasamos True para incluir CCO
-
-    if success:
-        # Intentamos obtener el número de factura para el mensaje flash
-        invoice_num = db.session.query(Factura.numero_factura).filter_by(id=id).scalar() or f"ID {id}"
-        flash(f"Factura {invoice_num} enviada por email. Revisa logs para detalles.", 'success')
+    """Encola el email de la factura (PDF al inquilino con CCO al propietario); lo envía la bandeja de salida."""
+    invoice_num = db.session.query(Factura.numero_factura).filter_by(id=id).scalar()
+    if invoice_num is None:
+        flash(f"Factura ID {id} no encontrada.", 'danger')
+    elif not _split_by_tenant_email([id])[0]:
+        flash(f"La factura {invoice_num} no se puede enviar: el inquilino no tiene email.", 'warning')
+    elif enqueue_invoice_emails([id], include_bcc_owner=True, user_id=current_user.id):
+        flash(f"Factura {invoice_num} en cola de envío por email. Se enviará en segundo plano.", 'success')
     else:
-        flash(f"Error crítico al enviar la factura ID {id}. Revisa la configuración de email y los logs.", 'danger')
+        flash(f"La factura {invoice_num} ya estaba en cola de envío.", 'info')
 
     # Redirigir siempre a la lista, independientemente del resultado del envío
     return redirect(url_for('facturas_bp.listar_facturas'))
 
+@facturas_bp.route('/envios/estado', methods=['GET'])
+@login_required
+def estado_envios():
+    """Estado (JSON) de los últimos emails de la bandeja de salida. ?factura_id= (repetible) filtra por factura."""
+    factura_ids = request.args.getlist('factura_id', type=int)
+    if current_user.role != 'admin':
+        # Solo facturas que el usuario puede ver (propietario activo / asignados)
+        visibles = get_filtered_facturas(include_relations=False).with_entities(Factura.id)
+        if factura_ids:
+            visibles = visibles.filter(Factura.id.in_(factura_ids))
+        return jsonify({'envios': get_outbox_status(visibles.scalar_subquery())})
+    return jsonify({'envios': get_outbox_status(factura_ids or None)})
+
+@facturas_bp.route('/envios/lote/<string:lote>', methods=['GET'])
+@login_required
+def estado_envio_masivo(lote):
+    """Progreso (JSON) de un envío masivo lanzado desde enviar_facturas_masivo: enviados, fallidos, omitidos y pendientes."""
+    progress = get_batch_progress(lote)
+    if progress is None:
+        return jsonify({"error": "Envío masivo no encontrado."}), 404
+    if current_user.role != 'admin' and progress.get('user_id') != current_user.id:
+        return jsonify({"error": "No tienes acceso a este envío masivo."}), 403
+    return jsonify(progress)
+
 
 # DEBUG TEMPORAL - BORRADO MASIVO
 @facturas_bp.route('/debug-borrado-masivo')
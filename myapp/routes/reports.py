@@ -1,10 +1,13 @@
 # myapp/routes/reports.py
 
+import gc
 import os
 import json
 import tempfile
 from datetime import datetime, date
 from decimal import Decimal
+from itertools import chain, groupby
+from operator import attrgetter
 from flask import (
     Blueprint, render_template, request, redirect, url_for, 
     flash, send_file, current_app, jsonify
@@ -38,10 +41,129 @@ from ..decorators import role_required, with_owner_filtering
 from ..models import db, Factura, Contrato, Propietario, Inquilino, Propiedad
 from ..utils.database_helpers import get_filtered_facturas, get_filtered_contratos
 from ..utils.owner_session import get_active_owner_context
+from ..utils.pdf_bundle import stream_merged_pdf
+from ..utils.rent_engine import IndexLookup
+from ..utils.rent_forecast import load_forecast_contracts, project_rents
 from ..forms import CSRFOnlyForm
 
 reports_bp = Blueprint('reports_bp', __name__, url_prefix='/reports')
 
+# --- Listados PDF con memoria acotada ---
+REPORT_PDF_YIELD_PER = 500  # Facturas leídas de la BD por lote al generar un listado PDF
+REPORT_PDF_TABLE_ROWS = 40  # Filas de factura por tabla: la tabla de un contrato se parte en tablas seguidas (número par: alterna el color de fila)
+REPORT_PDF_PAGES_PER_PART = 20  # Páginas por pasada de ReportLab; las partes se unen con stream_merged_pdf
+
+if REPORTLAB_AVAILABLE:
+    class _ReportPartTemplate(SimpleDocTemplate):
+        """
+        Una pasada de ReportLab sobre el listado. Pide los flowables al _ReportStory según los va maquetando
+        (filterFlowables) y, al cerrar la página max_pages, vacía la lista: build termina sin abrir otra página
+        y lo que faltaba por maquetar queda en self.carried para la parte siguiente.
+        """
+        def __init__(self, filename, story, max_pages, **kwargs):
+            super().__init__(filename, **kwargs)
+            self.story = story
+            self.max_pages = max_pages
+            self.carried = []
+            self._flowables = []
+
+        def build(self, flowables, **kwargs):
+            self._flowables = flowables
+            super().build(flowables, **kwargs)
+
+        def filterFlowables(self, flowables):
+            if flowables is self._flowables: # No la lista interna de acciones de página (clean_hanging)
+                self.story.fill(flowables)
+
+        def handle_pageEnd(self):
+            super().handle_pageEnd()
+            if self.page >= self.max_pages and self._flowables:
+                self.carried = self._flowables[:]
+                del self._flowables[:]
+
+class _ReportStory:
+    """
+    Flowables de un listado, tomados de un generador por partes de REPORT_PDF_PAGES_PER_PART páginas.
+    ReportLab guarda todas las páginas de un documento hasta save(): maquetar por partes y unirlas deja en
+    memoria una parte y una ventana de flowables, por muchas facturas que tenga el listado.
+    """
+    def __init__(self, flowables):
+        self._pending = iter(flowables)
+        self.exhausted = False
+        self.finished = False
+
+    def fill(self, flowables):
+        """Completa la ventana: dos flowables como mínimo y uno sin keepWithNext (handle_keepWithNext mira hacia delante)."""
+        while not self.exhausted and (len(flowables) < 2 or all(f.getKeepWithNext() for f in flowables)):
+            try:
+                flowables.append(next(self._pending))
+            except StopIteration:
+                self.exhausted = True
+
+    def parts(self, **doc_kwargs):
+        """Genera los bytes de cada parte (un PDF completo); al acabar, finished es True."""
+        flowables = []
+        self.fill(flowables)
+        while flowables:
+            buffer = BytesIO()
+            doc = _ReportPartTemplate(buffer, self, REPORT_PDF_PAGES_PER_PART, **doc_kwargs)
+            doc.build(flowables)
+            flowables = doc.carried
+            self.fill(flowables)
+            self.finished = not flowables
+            data = buffer.getvalue()
+            # El documento y su canvas forman ciclos de referencias: sin recogerlos aquí, las páginas de cada
+            # parte esperarían a la siguiente pasada del recolector y la memoria crecería con el listado
+            del doc, buffer
+            gc.collect()
+            yield data
+
+def _facturas_por_contrato(query):
+    """
+    Facturas de la consulta agrupadas por contrato (orden: contrato, fecha, número), leídas por lotes
+    con yield_per. Genera (contrato_id, iterador de sus facturas), que hay que recorrer antes de pedir el siguiente.
+    """
+    query = query.order_by(None).order_by(Factura.contrato_id, Factura.fecha_emision, Factura.numero_factura)
+    return groupby(query.yield_per(REPORT_PDF_YIELD_PER), key=attrgetter('contrato_id'))
+
+def _tablas_por_trozos(cabecera, filas, fila_total, crear_tabla):
+    """
+    Tabla de un contrato partida en tablas seguidas de REPORT_PDF_TABLE_ROWS filas, creadas a medida que se
+    leen las filas. La primera lleva la cabecera y la última la fila de fila_total(), que se pide al agotar
+    `filas` (los totales se acumulan mientras tanto). crear_tabla(data, con_cabecera, con_total) da la Table.
+    """
+    trozo, con_cabecera = [cabecera], True
+    for fila in filas:
+        if len(trozo) - con_cabecera == REPORT_PDF_TABLE_ROWS:
+            yield crear_tabla(trozo, con_cabecera, False)
+            trozo, con_cabecera = [], False
+        trozo.append(fila)
+    trozo.append(fila_total())
+    yield crear_tabla(trozo, con_cabecera, True)
+
+def _send_report_pdf(story, filename, **doc_kwargs):
+    """
+    Maqueta el listado por partes (ver _ReportStory) en un fichero temporal, uniendo las partes con
+    stream_merged_pdf si hay más de una, y lo envía por trozos con send_file.
+    """
+    pdf_file = tempfile.TemporaryFile(suffix='.pdf')
+    try:
+        report = _ReportStory(story)
+        partes = report.parts(pagesize=A4, **doc_kwargs)
+        primera = next(partes)
+        if report.finished:
+            pdf_file.write(primera)
+        else:
+            partes = chain([primera], partes)
+            del primera
+            for trozo in stream_merged_pdf(partes):
+                pdf_file.write(trozo)
+        pdf_file.seek(0)
+    except BaseException:
+        pdf_file.close()
+        raise
+    return send_file(pdf_file, as_attachment=True, download_name=filename, mimetype='application/pdf')
+
 @reports_bp.route('/api/contratos/<int:propietario_id>')
 @login_required
 @role_required(['admin', 'gestor'])
@@ -82,6 +204,41 @@ def obtener_contratos_propietario(propietario_id):
         current_app.logger.error(f"Error obteniendo contratos del propietario {propietario_id}: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
 
+@reports_bp.route('/api/prevision-rentas')
+@login_required
+@role_required(['admin', 'gestor'])
+def prevision_rentas():
+    """
+    API de previsión de rentas de la cartera (dashboard e informes).
+    Parámetros: anos (1-10, por defecto 3), ipc / irav (% anual supuesto para los índices aún no
+    publicados; por defecto el último publicado). Respeta el propietario activo y los asignados al gestor.
+    """
+    from .facturas import get_rates
+    try:
+        anos = int(request.args.get('anos', 3))
+        if not 1 <= anos <= 10: raise ValueError("anos debe estar entre 1 y 10")
+        supuestos = {tipo.upper(): float(request.args[tipo]) for tipo in ('ipc', 'irav') if request.args.get(tipo) not in (None, '')}
+    except ValueError as e:
+        return jsonify({'error': f'Parámetros inválidos: {e}'}), 400
+
+    active_owner_context = get_active_owner_context()
+    if active_owner_context and active_owner_context.get('active_owner'):
+        owner_ids = [active_owner_context['active_owner'].id]
+    elif current_user.role != 'admin':
+        owner_ids = [p.id for p in current_user.propietarios_asignados]
+    else:
+        owner_ids = None
+
+    try:
+        hoy = date.today()
+        iva_rate, irpf_rate = get_rates()
+        prevision = project_rents(load_forecast_contracts(owner_ids), IndexLookup.load(), hoy.year, hoy.month, anos * 12,
+                                  assumed_index=supuestos, iva_rate=iva_rate, irpf_rate=irpf_rate)
+        return jsonify({'success': True, **prevision.to_dict()})
+    except Exception as e:
+        current_app.logger.error(f"Error calculando previsión de rentas: {e}", exc_info=True)
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
 @reports_bp.route('/')
 @login_required
 @role_required(['admin', 'gestor'])
@@ -696,58 +853,18 @@ def listado_facturacion_pdf():
             query = query.filter(Factura.contrato_id == contrato_id_int)
             current_app.logger.info(f"🎯 PDF: Filtro por contrato agregado: contrato_id={contrato_id_int}")
             
-        facturas = query.all()
-        current_app.logger.info(f"📊 PDF: Facturas encontradas: {len(facturas)}")
+        total_facturas = query.order_by(None).count()
+        current_app.logger.info(f"📊 PDF: Facturas encontradas: {total_facturas}")
         
         if filtrar_por_contrato and contrato_id_int:
             current_app.logger.info(f"✅ PDF: FILTRO APLICADO - Solo facturas del contrato {contrato_id_int}")
-            current_app.logger.info(f"📋 PDF: Facturas: {[f.numero_factura for f in facturas]}")
         else:
             current_app.logger.info(f"📋 PDF: SIN FILTRO DE CONTRATO - Todas las facturas del propietario")
             
-        if not facturas:
+        if not total_facturas:
             flash("No hay facturas para generar PDF", "warning")
             return redirect(url_for('reports_bp.index'))
         
-        # Agrupar por contratos igual que función HTML
-        facturas_por_contrato = {}
-        
-        for factura in facturas:
-            contrato_id = factura.contrato_id
-            
-            if contrato_id not in facturas_por_contrato:
-                try:
-                    contrato = db.session.get(Contrato, contrato_id)
-                    facturas_por_contrato[contrato_id] = {
-                        'contrato': contrato,
-                        'facturas': [],
-                        'totales': {
-                            'base_imponible': Dec('0'),
-                            'importe_iva': Dec('0'),
-                            'importe_irpf': Dec('0'),
-                            'total': Dec('0')
-                        }
-                    }
-                except Exception as e:
-                    current_app.logger.warning(f"Error obteniendo contrato {contrato_id}: {e}")
-                    continue
-            
-            facturas_por_contrato[contrato_id]['facturas'].append(factura)
-            facturas_por_contrato[contrato_id]['totales']['base_imponible'] += Dec(str(factura.subtotal or 0))
-            facturas_por_contrato[contrato_id]['totales']['importe_iva'] += Dec(str(factura.iva or 0))
-            facturas_por_contrato[contrato_id]['totales']['importe_irpf'] += Dec(str(factura.irpf or 0))
-            facturas_por_contrato[contrato_id]['totales']['total'] += Dec(str(factura.total or 0))
-        
-        # Calcular totales generales
-        total_subtotal = sum(data['totales']['base_imponible'] for data in facturas_por_contrato.values())
-        total_iva = sum(data['totales']['importe_iva'] for data in facturas_por_contrato.values())
-        total_irpf = sum(data['totales']['importe_irpf'] for data in facturas_por_contrato.values())
-        total_general = sum(data['totales']['total'] for data in facturas_por_contrato.values())
-        
-        # Crear PDF en memoria
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=0.7*inch, bottomMargin=0.5*inch)
-        
         # Estilos optimizados para menos espacio
         styles = getSampleStyleSheet()
         title_style = ParagraphStyle(
@@ -776,146 +893,163 @@ def listado_facturacion_pdf():
             leftIndent=10
         )
         
-        # Contenido del PDF
-        story = []
-        
-        # Título
-        story.append(Paragraph("LISTADO DE FACTURACIÓN", title_style))
-        story.append(Spacer(1, 6))
-        
-        # Información del propietario (separada en dos líneas)
-        propietario_info = f"<b>Propietario:</b> {propietario.nombre} | <b>NIF:</b> {propietario.nif}"
-        periodo_info = f"<b>Período:</b> {fecha_desde_dt.strftime('%d/%m/%Y')} - {fecha_hasta_dt.strftime('%d/%m/%Y')}"
-        story.append(Paragraph(propietario_info, subtitle_style))
-        story.append(Paragraph(periodo_info, subtitle_style))
-        story.append(Spacer(1, 10))
-        
-        # Generar tablas por contrato
-        for contrato_id, contrato_data in facturas_por_contrato.items():
-            contrato = contrato_data['contrato']
-            
-            # Título del contrato con información completa
-            story.append(Spacer(1, 12))
-            contract_title = f"<b>CONTRATO: {contrato.numero_contrato if contrato else contrato_id}</b>"
-            story.append(Paragraph(contract_title, subtitle_style))
-            
-            # Información detallada del contrato
-            if contrato:
-                # Información de la propiedad
-                if contrato.propiedad_ref:
-                    direccion = contrato.propiedad_ref.direccion or "Sin dirección"
-                    ref_catastral = contrato.propiedad_ref.referencia_catastral or "Sin ref. catastral"
-                    propiedad_info = f"🏠 <b>Propiedad:</b> {direccion} | <b>Ref. Catastral:</b> {ref_catastral}"
-                    story.append(Paragraph(propiedad_info, contract_info_style))
-                
-                # Información del inquilino
-                if contrato.inquilino_ref:
-                    inquilino_nombre = contrato.inquilino_ref.nombre or "Sin nombre"
-                    inquilino_nif = contrato.inquilino_ref.nif or "Sin NIF"
-                    inquilino_info = f"👤 <b>Inquilino:</b> {inquilino_nombre} | <b>DNI/NIF:</b> {inquilino_nif}"
-                    story.append(Paragraph(inquilino_info, contract_info_style))
-            
-            story.append(Spacer(1, 6))
-            
-            # Tabla del contrato
-            data = [['Fecha', 'Nº Factura', 'Subtotal', 'IVA', 'IRPF', 'Total']]
-            
-            for factura in contrato_data['facturas']:
-                data.append([
+        def contract_table_style(con_cabecera, con_total):
+            """Estilo de cada trozo de la tabla de un contrato (ver _tablas_por_trozos)."""
+            primera, ultima = (1 if con_cabecera else 0), (-2 if con_total else -1)
+            comandos = [('ALIGN', (0, 0), (-1, -1), 'CENTER')]
+            if con_cabecera:
+                comandos += [
+                    # Header
+                    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                    ('FONTSIZE', (0, 0), (-1, 0), 9),
+                    ('ROWBACKGROUNDS', (0, 0), (-1, 0), [colors.grey]),
+                ]
+            comandos += [
+                # Datos
+                ('FONTNAME', (0, primera), (-1, ultima), 'Helvetica'),
+                ('FONTSIZE', (0, primera), (-1, ultima), 8),
+                ('GRID', (0, 0), (-1, ultima), 0.5, colors.black),
+                ('ROWBACKGROUNDS', (0, primera), (-1, ultima), [colors.white, colors.lightgrey]),
+            ]
+            if con_total:
+                comandos += [
+                    # Totales del contrato (última fila)
+                    ('BACKGROUND', (0, -1), (-1, -1), colors.lightblue),
+                    ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+                    ('FONTSIZE', (0, -1), (-1, -1), 9),
+                    ('GRID', (0, -1), (-1, -1), 1, colors.black),
+                ]
+            return TableStyle(comandos)
+        
+        def contract_table(data, con_cabecera, con_total):
+            # Tabla del contrato (más compacta); anchos fijos para que los trozos queden alineados
+            table = Table(data, colWidths=[1*inch, 1.3*inch, 0.9*inch, 0.9*inch, 0.9*inch, 1.1*inch])
+            table.setStyle(contract_table_style(con_cabecera, con_total))
+            return table
+        
+        def contract_rows(facturas, totales):
+            """Filas de la tabla de un contrato; acumula sus totales mientras se leen."""
+            for factura in facturas:
+                totales['base_imponible'] += Dec(str(factura.subtotal or 0))
+                totales['importe_iva'] += Dec(str(factura.iva or 0))
+                totales['importe_irpf'] += Dec(str(factura.irpf or 0))
+                totales['total'] += Dec(str(factura.total or 0))
+                totales['facturas'] += 1
+                yield [
                     factura.fecha_emision.strftime('%d/%m/%Y') if factura.fecha_emision else '-',
                     factura.numero_factura or '-',
                     f"{float(factura.subtotal or 0):.2f} €",
                     f"{float(factura.iva or 0):.2f} €", 
                     f"{float(factura.irpf or 0):.2f} €",
                     f"{float(factura.total or 0):.2f} €"
-                ])
+                ]
+        
+        def _story():
+            """Flowables del listado, contrato a contrato: doc.build los va pidiendo según maqueta."""
+            # Título
+            yield Paragraph("LISTADO DE FACTURACIÓN", title_style)
+            yield Spacer(1, 6)
             
-            # Totales del contrato
-            data.append([
-                'TOTAL',
-                '',
-                f"{float(contrato_data['totales']['base_imponible']):.2f} €",
-                f"{float(contrato_data['totales']['importe_iva']):.2f} €",
-                f"{float(contrato_data['totales']['importe_irpf']):.2f} €",
-                f"{float(contrato_data['totales']['total']):.2f} €"
-            ])
+            # Información del propietario (separada en dos líneas)
+            propietario_info = f"<b>Propietario:</b> {propietario.nombre} | <b>NIF:</b> {propietario.nif}"
+            periodo_info = f"<b>Período:</b> {fecha_desde_dt.strftime('%d/%m/%Y')} - {fecha_hasta_dt.strftime('%d/%m/%Y')}"
+            yield Paragraph(propietario_info, subtitle_style)
+            yield Paragraph(periodo_info, subtitle_style)
+            yield Spacer(1, 10)
             
-            # Crear tabla del contrato (más compacta)
-            table = Table(data, colWidths=[1*inch, 1.3*inch, 0.9*inch, 0.9*inch, 0.9*inch, 1.1*inch])
-            table.setStyle(TableStyle([
-                # Header
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 9),
-                ('ROWBACKGROUNDS', (0, 0), (-1, 0), [colors.grey]),
+            # Totales generales acumulados mientras se recorren los contratos
+            total_subtotal = total_iva = total_irpf = total_general = Dec('0')
+            contratos_count = facturas_count = 0
+            
+            # Generar tablas por contrato
+            for contrato_id, facturas_contrato in _facturas_por_contrato(query):
+                try:
+                    contrato = db.session.get(Contrato, contrato_id) if contrato_id else None
+                except Exception as e:
+                    current_app.logger.warning(f"Error obteniendo contrato {contrato_id}: {e}")
+                    continue
                 
-                # Datos
-                ('FONTNAME', (0, 1), (-1, -2), 'Helvetica'),
-                ('FONTSIZE', (0, 1), (-1, -2), 8),
-                ('GRID', (0, 0), (-1, -2), 0.5, colors.black),
-                ('ROWBACKGROUNDS', (0, 1), (-1, -2), [colors.white, colors.lightgrey]),
+                # Título del contrato con información completa
+                yield Spacer(1, 12)
+                contract_title = f"<b>CONTRATO: {contrato.numero_contrato if contrato else contrato_id}</b>"
+                yield Paragraph(contract_title, subtitle_style)
                 
-                # Totales del contrato (última fila)
-                ('BACKGROUND', (0, -1), (-1, -1), colors.lightblue),
+                # Información detallada del contrato
+                if contrato:
+                    # Información de la propiedad
+                    if contrato.propiedad_ref:
+                        direccion = contrato.propiedad_ref.direccion or "Sin dirección"
+                        ref_catastral = contrato.propiedad_ref.referencia_catastral or "Sin ref. catastral"
+                        propiedad_info = f"🏠 <b>Propiedad:</b> {direccion} | <b>Ref. Catastral:</b> {ref_catastral}"
+                        yield Paragraph(propiedad_info, contract_info_style)
+                    
+                    # Información del inquilino
+                    if contrato.inquilino_ref:
+                        inquilino_nombre = contrato.inquilino_ref.nombre or "Sin nombre"
+                        inquilino_nif = contrato.inquilino_ref.nif or "Sin NIF"
+                        inquilino_info = f"👤 <b>Inquilino:</b> {inquilino_nombre} | <b>DNI/NIF:</b> {inquilino_nif}"
+                        yield Paragraph(inquilino_info, contract_info_style)
+                
+                yield Spacer(1, 6)
+                
+                # Tabla del contrato, por trozos a medida que se leen sus facturas
+                totales = {'base_imponible': Dec('0'), 'importe_iva': Dec('0'), 'importe_irpf': Dec('0'), 'total': Dec('0'), 'facturas': 0}
+                fila_total = lambda: [
+                    'TOTAL',
+                    '',
+                    f"{float(totales['base_imponible']):.2f} €",
+                    f"{float(totales['importe_iva']):.2f} €",
+                    f"{float(totales['importe_irpf']):.2f} €",
+                    f"{float(totales['total']):.2f} €"
+                ]
+                yield from _tablas_por_trozos(['Fecha', 'Nº Factura', 'Subtotal', 'IVA', 'IRPF', 'Total'],
+                                              contract_rows(facturas_contrato, totales), fila_total, contract_table)
+                
+                total_subtotal += totales['base_imponible']; total_iva += totales['importe_iva']
+                total_irpf += totales['importe_irpf']; total_general += totales['total']
+                contratos_count += 1; facturas_count += totales['facturas']
+            
+            # Tabla de totales generales (más compacta)
+            yield Spacer(1, 15)
+            yield Paragraph("<b>TOTALES GENERALES DEL PROPIETARIO</b>", subtitle_style)
+            
+            totales_data = [
+                ['Concepto', 'Importe'],
+                ['Subtotal', f"{float(total_subtotal):.2f} €"],
+                ['IVA', f"{float(total_iva):.2f} €"],
+                ['IRPF', f"{float(total_irpf):.2f} €"],
+                ['TOTAL GENERAL', f"{float(total_general):.2f} €"]
+            ]
+            
+            totales_table = Table(totales_data, colWidths=[2.2*inch, 1.8*inch])
+            totales_table.setStyle(TableStyle([
+                ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
+                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
+                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
                 ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, -1), (-1, -1), 9),
-                ('GRID', (0, -1), (-1, -1), 1, colors.black),
+                ('FONTSIZE', (0, 0), (-1, 0), 10),
+                ('FONTSIZE', (0, 1), (-1, -2), 9),
+                ('FONTSIZE', (0, -1), (-1, -1), 11),
+                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+                ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+                ('ROWBACKGROUNDS', (0, 1), (-1, -2), [colors.white]),
             ]))
             
-            story.append(table)
-        
-        # Tabla de totales generales (más compacta)
-        story.append(Spacer(1, 15))
-        story.append(Paragraph("<b>TOTALES GENERALES DEL PROPIETARIO</b>", subtitle_style))
-        
-        totales_data = [
-            ['Concepto', 'Importe'],
-            ['Subtotal', f"{float(total_subtotal):.2f} €"],
-            ['IVA', f"{float(total_iva):.2f} €"],
-            ['IRPF', f"{float(total_irpf):.2f} €"],
-            ['TOTAL GENERAL', f"{float(total_general):.2f} €"]
-        ]
+            yield totales_table
+            yield Spacer(1, 8)
+            
+            # Resumen compacto en una línea
+            resumen_info = f"<b>Contratos:</b> {contratos_count} | <b>Facturas:</b> {facturas_count} | <b>Importe Total:</b> {float(total_general):.2f} €"
+            yield Paragraph(resumen_info, contract_info_style)
         
-        totales_table = Table(totales_data, colWidths=[2.2*inch, 1.8*inch])
-        totales_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('FONTSIZE', (0, 1), (-1, -2), 9),
-            ('FONTSIZE', (0, -1), (-1, -1), 11),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
-            ('ROWBACKGROUNDS', (0, 1), (-1, -2), [colors.white]),
-        ]))
-        
-        story.append(totales_table)
-        story.append(Spacer(1, 8))
-        
-        # Resumen compacto en una línea
-        total_facturas_count = sum(len(data['facturas']) for data in facturas_por_contrato.values())
-        resumen_info = f"<b>Contratos:</b> {len(facturas_por_contrato)} | <b>Facturas:</b> {total_facturas_count} | <b>Importe Total:</b> {float(total_general):.2f} €"
-        story.append(Paragraph(resumen_info, contract_info_style))
-        
-        # Generar PDF
-        doc.build(story)
-        
-        # Preparar respuesta
-        buffer.seek(0)
         filename = f"listado_facturacion_{propietario.nombre.replace(' ', '_')}_{fecha_desde}_{fecha_hasta}.pdf"
-        
+        # Generar PDF en un fichero temporal, leyendo las facturas por lotes
+        response = _send_report_pdf(_story(), filename, topMargin=0.7*inch, bottomMargin=0.5*inch)
         current_app.logger.info(f"PDF generado: {filename}")
-        
-        return send_file(
-            buffer,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/pdf'
-        )
+        return response
         
     except ImportError as e:
         current_app.logger.error(f"ERROR de import en PDF: {e}", exc_info=True)
@@ -1125,8 +1259,12 @@ def generar_pdf_facturacion():
             flash("Propietario no encontrado", "error")
             return redirect(url_for('reports_bp.index'))
         
-        # Construir consulta de facturas (igual que en listado_facturacion)
-        query = get_filtered_facturas(include_relations=True)
+        # Construir consulta de facturas (igual que en listado_facturacion). selectinload en lugar de
+        # joinedload: es compatible con yield_per (carga las relaciones de cada lote con un IN)
+        query = get_filtered_facturas(include_relations=False).options(
+            selectinload(Factura.contrato_ref).selectinload(Contrato.inquilino_ref),
+            selectinload(Factura.contrato_ref).selectinload(Contrato.propiedad_ref)
+        )
         
         filtros = [
             Factura.fecha_emision >= fecha_desde_dt,
@@ -1147,49 +1285,11 @@ def generar_pdf_facturacion():
                 pass
         
         query = query.filter(and_(*filtros))
-        facturas = query.order_by(Factura.fecha_emision.asc(), Factura.numero_factura.asc()).all()
         
-        if not facturas:
+        if not query.order_by(None).count():
             flash("No se encontraron facturas para generar el PDF", "warning")
             return redirect(url_for('reports_bp.index'))
         
-        # Agrupar facturas por contrato (igual que en listado_facturacion)
-        facturas_por_contrato = {}
-        for factura in facturas:
-            contrato_id = factura.contrato_id
-            if contrato_id not in facturas_por_contrato:
-                facturas_por_contrato[contrato_id] = {
-                    'contrato': factura.contrato,
-                    'facturas': [],
-                    'totales': {
-                        'base_imponible': Decimal('0'),
-                        'importe_iva': Decimal('0'),
-                        'importe_irpf': Decimal('0'),
-                        'total': Decimal('0')
-                    }
-                }
-            
-            facturas_por_contrato[contrato_id]['facturas'].append(factura)
-            
-            # Sumar totales
-            facturas_por_contrato[contrato_id]['totales']['base_imponible'] += factura.subtotal or Decimal('0')
-            facturas_por_contrato[contrato_id]['totales']['importe_iva'] += factura.iva or Decimal('0')
-            facturas_por_contrato[contrato_id]['totales']['importe_irpf'] += factura.irpf or Decimal('0')
-            facturas_por_contrato[contrato_id]['totales']['total'] += factura.total or Decimal('0')
-        
-        # Calcular totales generales
-        totales_generales = {
-            'base_imponible': sum(grupo['totales']['base_imponible'] for grupo in facturas_por_contrato.values()),
-            'importe_iva': sum(grupo['totales']['importe_iva'] for grupo in facturas_por_contrato.values()),
-            'importe_irpf': sum(grupo['totales']['importe_irpf'] for grupo in facturas_por_contrato.values()),
-            'total': sum(grupo['totales']['total'] for grupo in facturas_por_contrato.values())
-        }
-        
-        # Crear PDF
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        story = []
-        
         # Estilos
         styles = getSampleStyleSheet()
         title_style = ParagraphStyle(
@@ -1211,128 +1311,160 @@ def generar_pdf_facturacion():
         
         normal_style = styles['Normal']
         
-        # Título principal
-        story.append(Paragraph("LISTADO DE FACTURACIÓN", title_style))
-        story.append(Spacer(1, 12))
-        
-        # Información del propietario
-        propietario_info = f"""
-        <b>Propietario:</b> {propietario.nombre}<br/>
-        <b>NIF:</b> {propietario.nif}<br/>
-        <b>Email:</b> {propietario.email or 'No especificado'}<br/>
-        <b>Teléfono:</b> {propietario.telefono or 'No especificado'}<br/>
-        <b>Período:</b> {fecha_desde_dt.strftime('%d/%m/%Y')} - {fecha_hasta_dt.strftime('%d/%m/%Y')}
-        """
-        story.append(Paragraph(propietario_info, normal_style))
-        story.append(Spacer(1, 20))
-        
-        # Tabla por cada contrato
-        for contrato_id, datos in facturas_por_contrato.items():
-            # Header del contrato
-            contrato_header = f"Contrato {datos['contrato'].numero_contrato or contrato_id}"
-            if datos['contrato'].inquilino_ref:
-                contrato_header += f" - {datos['contrato'].inquilino_ref.nombre}"
-            if datos['contrato'].propiedad_ref:
-                contrato_header += f" - {datos['contrato'].propiedad_ref.direccion}"
+        def _tabla_contrato(data, con_cabecera, con_total):
+            """Trozo de la tabla de un contrato (ver _tablas_por_trozos), con anchos fijos para que queden alineados."""
+            primera = 1 if con_cabecera else 0
+            comandos = [('ALIGN', (0, 0), (-1, -1), 'CENTER')]
+            if con_cabecera:
+                comandos += [
+                    ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
+                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                    ('FONTSIZE', (0, 0), (-1, 0), 10),
+                    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+                ]
+            comandos += [
+                ('ALIGN', (3, primera), (3, -1), 'LEFT'),  # Nombres alineados a la izquierda
+                ('ALIGN', (4, primera), (-1, -1), 'RIGHT'),  # Importes alineados a la derecha
+                ('FONTSIZE', (0, primera), (-1, -1), 8),
+                ('GRID', (0, 0), (-1, -1), 1, colors.black)
+            ]
+            if con_total:
+                comandos += [
+                    ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),  # Fila de totales
+                    ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+                ]
+            table = Table(data, colWidths=[0.7*inch, 0.95*inch, 0.75*inch, 1.25*inch, 0.7*inch, 0.6*inch, 0.6*inch, 0.7*inch])
+            table.setStyle(TableStyle(comandos))
+            return table
+        
+        def _story():
+            """Flowables del listado; las facturas se leen por lotes, un contrato cada vez."""
+            # Título principal
+            yield Paragraph("LISTADO DE FACTURACIÓN", title_style)
+            yield Spacer(1, 12)
             
-            story.append(Paragraph(contrato_header, header_style))
+            # Información del propietario
+            propietario_info = f"""
+            <b>Propietario:</b> {propietario.nombre}<br/>
+            <b>NIF:</b> {propietario.nif}<br/>
+            <b>Email:</b> {propietario.email or 'No especificado'}<br/>
+            <b>Teléfono:</b> {propietario.telefono or 'No especificado'}<br/>
+            <b>Período:</b> {fecha_desde_dt.strftime('%d/%m/%Y')} - {fecha_hasta_dt.strftime('%d/%m/%Y')}
+            """
+            yield Paragraph(propietario_info, normal_style)
+            yield Spacer(1, 20)
             
-            # Datos para la tabla
-            table_data = [
-                ['Fecha', 'Nº Factura', 'NIF', 'Nombre', 'Base Imp.', 'IVA', 'IRPF', 'Total']
-            ]
+            totales_generales = {
+                'base_imponible': Decimal('0'),
+                'importe_iva': Decimal('0'),
+                'importe_irpf': Decimal('0'),
+                'total': Decimal('0')
+            }
+            contratos_count = facturas_count = 0
             
-            for factura in datos['facturas']:
-                inquilino = factura.contrato_ref.inquilino_ref if factura.contrato_ref else None
-                table_data.append([
-                    factura.fecha_emision.strftime('%d/%m/%Y') if factura.fecha_emision else '-',
-                    factura.numero_factura or '-',
-                    inquilino.nif if inquilino else '-',
-                    inquilino.nombre if inquilino else '-',
-                    f"{factura.subtotal or 0:.2f} €",
-                    f"{factura.iva or 0:.2f} €",
-                    f"{factura.irpf or 0:.2f} €",
-                    f"{factura.total or 0:.2f} €"
-                ])
+            # Tabla por cada contrato
+            for contrato_id, facturas_contrato in _facturas_por_contrato(query):
+                primera_factura = next(facturas_contrato)
+                contrato = primera_factura.contrato_ref
+                
+                # Header del contrato
+                contrato_header = f"Contrato {(contrato.numero_contrato if contrato else None) or contrato_id}"
+                if contrato and contrato.inquilino_ref:
+                    contrato_header += f" - {contrato.inquilino_ref.nombre}"
+                if contrato and contrato.propiedad_ref:
+                    contrato_header += f" - {contrato.propiedad_ref.direccion}"
+                
+                yield Paragraph(contrato_header, header_style)
+                
+                # Tabla por trozos a medida que se leen las facturas
+                totales = {
+                    'base_imponible': Decimal('0'),
+                    'importe_iva': Decimal('0'),
+                    'importe_irpf': Decimal('0'),
+                    'total': Decimal('0')
+                }
+                contador = {'facturas': 0}
+                
+                def _filas(facturas):
+                    for factura in facturas:
+                        inquilino = factura.contrato_ref.inquilino_ref if factura.contrato_ref else None
+                        # Sumar totales
+                        totales['base_imponible'] += factura.subtotal or Decimal('0')
+                        totales['importe_iva'] += factura.iva or Decimal('0')
+                        totales['importe_irpf'] += factura.irpf or Decimal('0')
+                        totales['total'] += factura.total or Decimal('0')
+                        contador['facturas'] += 1
+                        yield [
+                            factura.fecha_emision.strftime('%d/%m/%Y') if factura.fecha_emision else '-',
+                            factura.numero_factura or '-',
+                            inquilino.nif if inquilino else '-',
+                            inquilino.nombre if inquilino else '-',
+                            f"{factura.subtotal or 0:.2f} €",
+                            f"{factura.iva or 0:.2f} €",
+                            f"{factura.irpf or 0:.2f} €",
+                            f"{factura.total or 0:.2f} €"
+                        ]
+                
+                # Fila de totales del contrato
+                fila_total = lambda: [
+                    '', '', '', 'TOTAL:',
+                    f"{totales['base_imponible']:.2f} €",
+                    f"{totales['importe_iva']:.2f} €",
+                    f"{totales['importe_irpf']:.2f} €",
+                    f"{totales['total']:.2f} €"
+                ]
+                
+                yield from _tablas_por_trozos(['Fecha', 'Nº Factura', 'NIF', 'Nombre', 'Base Imp.', 'IVA', 'IRPF', 'Total'],
+                                              _filas(chain([primera_factura], facturas_contrato)), fila_total, _tabla_contrato)
+                
+                for clave, importe in totales.items():
+                    totales_generales[clave] += importe
+                contratos_count += 1
+                facturas_count += contador['facturas']
+                yield Spacer(1, 20)
             
-            # Fila de totales del contrato
-            table_data.append([
-                '', '', '', 'TOTAL:',
-                f"{datos['totales']['base_imponible']:.2f} €",
-                f"{datos['totales']['importe_iva']:.2f} €",
-                f"{datos['totales']['importe_irpf']:.2f} €",
-                f"{datos['totales']['total']:.2f} €"
-            ])
+            # Totales generales
+            yield Paragraph("TOTALES GENERALES", header_style)
+            totales_data = [
+                ['Concepto', 'Importe'],
+                ['Base Imponible', f"{totales_generales['base_imponible']:.2f} €"],
+                ['Importe IVA', f"{totales_generales['importe_iva']:.2f} €"],
+                ['Importe IRPF', f"{totales_generales['importe_irpf']:.2f} €"],
+                ['TOTAL GENERAL', f"{totales_generales['total']:.2f} €"]
+            ]
             
-            # Crear tabla
-            table = Table(table_data)
-            table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
+            totales_table = Table(totales_data, colWidths=[3*inch, 2*inch])
+            totales_table.setStyle(TableStyle([
+                ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
                 ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('ALIGN', (3, 1), (3, -1), 'LEFT'),  # Nombres alineados a la izquierda
-                ('ALIGN', (4, 1), (-1, -1), 'RIGHT'),  # Importes alineados a la derecha
+                ('BACKGROUND', (0, -1), (-1, -1), colors.lightblue),
                 ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 10),
-                ('FONTSIZE', (0, 1), (-1, -1), 8),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),  # Fila de totales
                 ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+                ('FONTSIZE', (0, 0), (-1, -1), 12),
+                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+                ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
                 ('GRID', (0, 0), (-1, -1), 1, colors.black)
             ]))
             
-            story.append(table)
-            story.append(Spacer(1, 20))
-        
-        # Totales generales
-        story.append(Paragraph("TOTALES GENERALES", header_style))
-        totales_data = [
-            ['Concepto', 'Importe'],
-            ['Base Imponible', f"{totales_generales['base_imponible']:.2f} €"],
-            ['Importe IVA', f"{totales_generales['importe_iva']:.2f} €"],
-            ['Importe IRPF', f"{totales_generales['importe_irpf']:.2f} €"],
-            ['TOTAL GENERAL', f"{totales_generales['total']:.2f} €"]
-        ]
-        
-        totales_table = Table(totales_data, colWidths=[3*inch, 2*inch])
-        totales_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('BACKGROUND', (0, -1), (-1, -1), colors.lightblue),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 12),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        
-        story.append(totales_table)
-        
-        # Información adicional
-        story.append(Spacer(1, 30))
-        info_adicional = f"""
-        <b>Listado generado:</b> {datetime.now().strftime('%d/%m/%Y a las %H:%M')}<br/>
-        <b>Contratos:</b> {len(facturas_por_contrato)}<br/>
-        <b>Facturas:</b> {len(facturas)}
-        """
-        story.append(Paragraph(info_adicional, normal_style))
-        
-        # Generar PDF
-        doc.build(story)
-        buffer.seek(0)
+            yield totales_table
+            
+            # Información adicional
+            yield Spacer(1, 30)
+            info_adicional = f"""
+            <b>Listado generado:</b> {datetime.now().strftime('%d/%m/%Y a las %H:%M')}<br/>
+            <b>Contratos:</b> {contratos_count}<br/>
+            <b>Facturas:</b> {facturas_count}
+            """
+            yield Paragraph(info_adicional, normal_style)
         
         # Generar nombre de archivo
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         sanitized_name = "".join(c if c.isalnum() else "_" for c in propietario.nombre)
         filename = f"listado_facturacion_{sanitized_name}_{timestamp}.pdf"
         
-        return send_file(
-            buffer,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/pdf'
-        )
+        # Generar PDF en un fichero temporal
+        return _send_report_pdf(_story(), filename)
         
     except Exception as e:
         current_app.logger.error(f"Error generando PDF de facturación: {e}", exc_info=True)
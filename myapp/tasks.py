@@ -1,10 +1,14 @@
 # myapp/tasks.py
 from datetime import date, timedelta
 from flask import current_app, url_for # Importar url_for aquí
-from .models import db, Contrato, Factura, Notification, User, Propiedad # Ajusta según tus modelos
+from .models import db, Contrato, Factura, Notification, User, Propiedad, user_propietario_association # Ajusta según tus modelos
 from . import mail # Si vas a enviar emails
 from flask_mail import Message
 from sqlalchemy import extract, func, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import selectinload
+
+NOTIFICATION_INSERT_CHUNK = 500
 
 def send_reminder_email(recipient_email, subject, html_body):
     """Función auxiliar para enviar emails."""
@@ -28,6 +32,69 @@ def send_reminder_email(recipient_email, subject, html_body):
     except Exception as e:
         current_app.logger.error(f"Error enviando email de recordatorio a {recipient_email}: {e}", exc_info=True)
 
+# --- Notificaciones sin duplicados ---
+# Cada aviso lleva una dedupe_key (tipo:contrato:periodo:usuario) con índice único: el INSERT ... ON CONFLICT
+# DO NOTHING descarta los ya avisados sin buscar en el histórico de notificaciones.
+def _week_bucket(day):
+    """'2025-W07': con la semana en la clave, el mismo aviso se repite como mucho una vez por semana."""
+    iso_year, iso_week, _ = day.isocalendar()
+    return f"{iso_year}-W{iso_week:02d}"
+
+def _gestores_por_propietario(propietario_ids):
+    """{propietario_id: [gestores asignados]} en una sola consulta (usuarios_asignados es dinámica: una consulta por contrato)."""
+    gestores = {}
+    if not propietario_ids:
+        return gestores
+    filas = db.session.query(user_propietario_association.c.propietario_id, User).join(
+        User, User.id == user_propietario_association.c.user_id
+    ).filter(user_propietario_association.c.propietario_id.in_(propietario_ids), User.role == 'gestor')
+    for propietario_id, gestor in filas:
+        gestores.setdefault(propietario_id, []).append(gestor)
+    return gestores
+
+def _insert_notifications(filas):
+    """
+    Inserta en bloque las notificaciones cuya dedupe_key aún no existe (INSERT ... ON CONFLICT DO NOTHING).
+    Devuelve las dedupe_key insertadas; las demás ya se habían notificado.
+    """
+    insertadas = set()
+    for inicio in range(0, len(filas), NOTIFICATION_INSERT_CHUNK):
+        stmt = sqlite_insert(Notification).values(filas[inicio:inicio + NOTIFICATION_INSERT_CHUNK]) \
+            .on_conflict_do_nothing(index_elements=['dedupe_key']).returning(Notification.dedupe_key)
+        insertadas.update(db.session.scalars(stmt))
+    return insertadas
+
+def _notify(filas, emails, descripcion):
+    """
+    Guarda las notificaciones nuevas y, tras el commit, envía los emails de las que se acaban de crear.
+    emails: {dedupe_key: (destinatario, asunto, html)}. Devuelve cuántas notificaciones se crearon.
+    """
+    try:
+        insertadas = _insert_notifications(filas) if filas else set()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error haciendo commit de notificaciones de {descripcion}: {e}")
+        return 0
+    for dedupe_key in insertadas:
+        if dedupe_key in emails:
+            send_reminder_email(*emails[dedupe_key])
+    return len(insertadas)
+
+def _contract_query():
+    """Contratos con propiedad, propietario e inquilino precargados (para los mensajes y los destinatarios)."""
+    return Contrato.query.options(
+        selectinload(Contrato.propiedad_ref).selectinload(Propiedad.propietario_ref),
+        selectinload(Contrato.inquilino_ref)
+    )
+
+def _recipients(contract, admin_users, gestores_por_propietario):
+    """(usuario, es_gestor) a notificar por un contrato: administradores y gestores asignados a su propietario."""
+    destinatarios = [(admin, False) for admin in admin_users]
+    if contract.propiedad_ref and contract.propiedad_ref.propietario_ref:
+        destinatarios.extend((gestor, True) for gestor in gestores_por_propietario.get(contract.propiedad_ref.propietario_id, []))
+    return destinatarios
+
 # --- Tarea: Contratos por Vencer ---
 def check_expiring_contracts(app_context):
     with app_context.app_context(): # Necesitas el contexto de la aplicación
@@ -35,7 +102,7 @@ def check_expiring_contracts(app_context):
         today = date.today()
         ninety_days_later = today + timedelta(days=90)
         
-        expiring_contracts = Contrato.query.filter(
+        expiring_contracts = _contract_query().filter(
             Contrato.estado == 'activo',
             Contrato.fecha_fin.isnot(None),
             Contrato.fecha_fin >= today, # Que aún no haya vencido
@@ -43,6 +110,8 @@ def check_expiring_contracts(app_context):
         ).all()
 
         admin_users = User.query.filter_by(role='admin').all()
+        gestores = _gestores_por_propietario({c.propiedad_ref.propietario_id for c in expiring_contracts if c.propiedad_ref})
+        filas, emails = [], {}
 
         for contract in expiring_contracts:
             days_to_expiry = (contract.fecha_fin - today).days
@@ -53,47 +122,26 @@ def check_expiring_contracts(app_context):
             
             related_url = url_for('contratos_bp.ver_contrato', id=contract.id, _external=True)
 
-            # Notificación para administradores
-            for admin in admin_users:
-                # Evitar duplicados si ya existe una notificación similar reciente (opcional)
-                existing_notif = Notification.query.filter(
-                    Notification.message.like(f"%contrato '{contract.numero_contrato}'%vence%"),
-                    Notification.user_id == admin.id,
-                    Notification.timestamp > today - timedelta(days=7) # No notificar si ya se hizo en la última semana
-                ).first()
-                if not existing_notif:
-                    notif = Notification(message=message, level='warning', related_url=related_url, user_id=admin.id)
-                    db.session.add(notif)
-
-            # Notificación y email para gestores asignados
-            if contract.propiedad_ref and contract.propiedad_ref.propietario_ref:
-                for gestor in contract.propiedad_ref.propietario_ref.usuarios_asignados:
-                    if gestor.role == 'gestor':
-                        existing_notif_gestor = Notification.query.filter(
-                            Notification.message.like(f"%contrato '{contract.numero_contrato}'%vence%"),
-                            Notification.user_id == gestor.id,
-                            Notification.timestamp > today - timedelta(days=7)
-                        ).first()
-                        if not existing_notif_gestor:
-                            notif_gestor = Notification(message=message, level='warning', related_url=related_url, user_id=gestor.id)
-                            db.session.add(notif_gestor)
-                            # Enviar email al gestor
-                            if gestor.email:
-                                subject_email = f"Recordatorio: Contrato {contract.numero_contrato} próximo a vencer"
-                                html_body = f"<p>{message}</p><p>Puedes ver los detalles aquí: <a href='{related_url}'>{related_url}</a></p>"
-                                send_reminder_email(gestor.email, subject_email, html_body)
-        try:
-            db.session.commit()
-            current_app.logger.info(f"Notificaciones de contratos por vencer procesadas: {len(expiring_contracts)} contratos revisados.")
-        except Exception as e:
-            db.session.rollback()
-            current_app.logger.error(f"Error haciendo commit de notificaciones de contratos: {e}")
+            # Notificación para administradores y gestores asignados (como mucho una por semana); email a los gestores
+            for user, es_gestor in _recipients(contract, admin_users, gestores):
+                dedupe_key = f"expiring:{contract.id}:{_week_bucket(today)}:{user.id}"
+                filas.append(dict(message=message, level='warning', related_url=related_url, user_id=user.id, dedupe_key=dedupe_key))
+                if es_gestor and user.email:
+                    subject_email = f"Recordatorio: Contrato {contract.numero_contrato} próximo a vencer"
+                    html_body = f"<p>{message}</p><p>Puedes ver los detalles aquí: <a href='{related_url}'>{related_url}</a></p>"
+                    emails[dedupe_key] = (user.email, subject_email, html_body)
+
+        creadas = _notify(filas, emails, "contratos por vencer")
+        current_app.logger.info(f"Notificaciones de contratos por vencer procesadas: {len(expiring_contracts)} contratos revisados, {creadas} notificaciones nuevas.")
 
 # --- Tarea: Facturas Pendientes de Generar ---
 def check_pending_invoices(app_context):
     with app_context.app_context():
         current_app.logger.info("Tarea Programada: Verificando facturas pendientes de generar...")
         today = date.today()
+        # Mes actual como rango semiabierto sobre fecha_emision (usa el índice contrato_id + fecha_emision)
+        inicio_mes = today.replace(day=1)
+        inicio_mes_siguiente = (inicio_mes + timedelta(days=32)).replace(day=1)
         
         # Contratos activos cuyo día de pago ya pasó hace más de X días en el mes actual
         # y para los que no existe factura este mes.
@@ -101,8 +149,15 @@ def check_pending_invoices(app_context):
         # Si el día de pago es 5, pasaron 20 días.
         
         # Obtener todos los contratos activos
-        active_contracts = Contrato.query.filter(Contrato.estado == 'activo').all()
+        active_contracts = _contract_query().filter(Contrato.estado == 'activo').all()
         admin_users = User.query.filter_by(role='admin').all()
+        # Contratos con factura este mes, en una sola consulta
+        facturados_este_mes = {contrato_id for (contrato_id,) in db.session.query(Factura.contrato_id).filter(
+            Factura.fecha_emision >= inicio_mes,
+            Factura.fecha_emision < inicio_mes_siguiente
+        ).distinct()}
+        gestores = _gestores_por_propietario({c.propiedad_ref.propietario_id for c in active_contracts if c.propiedad_ref})
+        filas, emails = [], {}
 
         for contract in active_contracts:
             dia_pago_contrato = contract.dia_pago if 1 <= contract.dia_pago <= 28 else 1 # Limitar a un día válido
@@ -117,55 +172,26 @@ def check_pending_invoices(app_context):
 
             # Si la fecha de facturación esperada ya pasó hace más de, por ejemplo, 20 días
             # Y aún no se ha generado la factura para ESTE MES
-            if today >= fecha_facturacion_esperada_este_mes + timedelta(days=20):
-                factura_existente_este_mes = Factura.query.filter(
-                    Factura.contrato_id == contract.id,
-                    extract('year', Factura.fecha_emision) == today.year,
-                    extract('month', Factura.fecha_emision) == today.month
-                ).first()
-
-                if not factura_existente_este_mes:
-                    message = (f"La factura para el contrato '{contract.numero_contrato}' "
-                               f"(Prop.: {contract.propiedad_ref.direccion if contract.propiedad_ref else 'N/A'}, "
-                               f"Inq.: {contract.inquilino_ref.nombre if contract.inquilino_ref else 'N/A'}) "
-                               f"del periodo {today.month}/{today.year} parece no haberse generado. "
-                               f"Han pasado más de 20 días desde el día de facturación ({dia_pago_contrato}).")
-                    
-                    related_url = url_for('facturas_bp.generar_facturas_mes', _external=True) # Enlace a la pág de generar
-
-                    # Notificación para administradores
-                    for admin in admin_users:
-                        existing_notif = Notification.query.filter(
-                            Notification.message.like(f"%factura para el contrato '{contract.numero_contrato}'%periodo {today.month}/{today.year}%no haberse generado%"),
-                            Notification.user_id == admin.id,
-                            Notification.timestamp > today - timedelta(days=7) 
-                        ).first()
-                        if not existing_notif:
-                            notif = Notification(message=message, level='danger', related_url=related_url, user_id=admin.id)
-                            db.session.add(notif)
-
-                    # Notificación y email para gestores asignados
-                    if contract.propiedad_ref and contract.propiedad_ref.propietario_ref:
-                        for gestor in contract.propiedad_ref.propietario_ref.usuarios_asignados:
-                            if gestor.role == 'gestor':
-                                existing_notif_gestor = Notification.query.filter(
-                                    Notification.message.like(f"%factura para el contrato '{contract.numero_contrato}'%periodo {today.month}/{today.year}%no haberse generado%"),
-                                    Notification.user_id == gestor.id,
-                                    Notification.timestamp > today - timedelta(days=7)
-                                ).first()
-                                if not existing_notif_gestor:
-                                    notif_gestor = Notification(message=message, level='danger', related_url=related_url, user_id=gestor.id)
-                                    db.session.add(notif_gestor)
-                                    if gestor.email:
-                                        subject_email = f"Alerta: Factura pendiente de generar ({contract.numero_contrato})"
-                                        html_body = f"<p>{message}</p><p>Puedes generarla aquí: <a href='{related_url}'>{related_url}</a></p>"
-                                        send_reminder_email(gestor.email, subject_email, html_body)
-        try:
-            db.session.commit()
-            current_app.logger.info("Notificaciones de facturas pendientes procesadas.")
-        except Exception as e:
-            db.session.rollback()
-            current_app.logger.error(f"Error haciendo commit de notificaciones de facturas pendientes: {e}")
+            if today >= fecha_facturacion_esperada_este_mes + timedelta(days=20) and contract.id not in facturados_este_mes:
+                message = (f"La factura para el contrato '{contract.numero_contrato}' "
+                           f"(Prop.: {contract.propiedad_ref.direccion if contract.propiedad_ref else 'N/A'}, "
+                           f"Inq.: {contract.inquilino_ref.nombre if contract.inquilino_ref else 'N/A'}) "
+                           f"del periodo {today.month}/{today.year} parece no haberse generado. "
+                           f"Han pasado más de 20 días desde el día de facturación ({dia_pago_contrato}).")
+                
+                related_url = url_for('facturas_bp.generar_facturas_mes', _external=True) # Enlace a la pág de generar
+
+                # Notificación para administradores y gestores asignados (como mucho una por semana); email a los gestores
+                for user, es_gestor in _recipients(contract, admin_users, gestores):
+                    dedupe_key = f"pending_invoice:{contract.id}:{today:%Y-%m}:{_week_bucket(today)}:{user.id}"
+                    filas.append(dict(message=message, level='danger', related_url=related_url, user_id=user.id, dedupe_key=dedupe_key))
+                    if es_gestor and user.email:
+                        subject_email = f"Alerta: Factura pendiente de generar ({contract.numero_contrato})"
+                        html_body = f"<p>{message}</p><p>Puedes generarla aquí: <a href='{related_url}'>{related_url}</a></p>"
+                        emails[dedupe_key] = (user.email, subject_email, html_body)
+
+        creadas = _notify(filas, emails, "facturas pendientes")
+        current_app.logger.info(f"Notificaciones de facturas pendientes procesadas: {creadas} notificaciones nuevas.")
 
 # --- Tarea: Revisiones de IPC/IRAV Próximas ---
 def check_ipc_reviews(app_context):
@@ -177,7 +203,7 @@ def check_ipc_reviews(app_context):
         
         # Contratos cuya fecha de inicio (mes) coincide con el mes actual o el siguiente
         # y que tienen actualiza_ipc o actualiza_irav activado.
-        contracts_for_review = Contrato.query.filter(
+        contracts_for_review = _contract_query().filter(
             Contrato.estado == 'activo',
             or_(Contrato.actualiza_ipc == True, Contrato.actualiza_irav == True),
             Contrato.fecha_inicio.isnot(None),
@@ -188,6 +214,8 @@ def check_ipc_reviews(app_context):
         ).all()
 
         admin_users = User.query.filter_by(role='admin').all()
+        gestores = _gestores_por_propietario({c.propiedad_ref.propietario_id for c in contracts_for_review if c.propiedad_ref})
+        filas, emails = [], {}
 
         for contract in contracts_for_review:
             # Determinar si la revisión es este mes o el siguiente
@@ -211,36 +239,14 @@ def check_ipc_reviews(app_context):
             
             related_url = url_for('ipc_bp.listar_indices', _external=True) # Enlace a la gestión de índices
 
-            # Notificación para administradores
-            for admin in admin_users:
-                existing_notif = Notification.query.filter(
-                    Notification.message.like(f"%revisión de renta por {index_type} para el contrato '{contract.numero_contrato}'%Aniversario en {app_context.config['MESES_STR'][review_month]}/{review_year}%"),
-                    Notification.user_id == admin.id,
-                    Notification.timestamp > today - timedelta(days=25) # No notificar muy seguido para el mismo evento
-                ).first()
-                if not existing_notif:
-                    notif = Notification(message=message, level='info', related_url=related_url, user_id=admin.id)
-                    db.session.add(notif)
-
-            # Notificación y email para gestores asignados
-            if contract.propiedad_ref and contract.propiedad_ref.propietario_ref:
-                for gestor in contract.propiedad_ref.propietario_ref.usuarios_asignados:
-                    if gestor.role == 'gestor':
-                        existing_notif_gestor = Notification.query.filter(
-                            Notification.message.like(f"%revisión de renta por {index_type} para el contrato '{contract.numero_contrato}'%Aniversario en {app_context.config['MESES_STR'][review_month]}/{review_year}%"),
-                            Notification.user_id == gestor.id,
-                            Notification.timestamp > today - timedelta(days=25)
-                        ).first()
-                        if not existing_notif_gestor:
-                            notif_gestor = Notification(message=message, level='info', related_url=related_url, user_id=gestor.id)
-                            db.session.add(notif_gestor)
-                            if gestor.email:
-                                subject_email = f"Recordatorio: Revisión {index_type} para contrato {contract.numero_contrato}"
-                                html_body = f"<p>{message}</p><p>Revisa los índices aquí: <a href='{related_url}'>{related_url}</a></p>"
-                                send_reminder_email(gestor.email, subject_email, html_body)
-        try:
-            db.session.commit()
-            current_app.logger.info(f"Notificaciones de revisiones IPC/IRAV procesadas: {len(contracts_for_review)} contratos revisados.")
-        except Exception as e:
-            db.session.rollback()
-            current_app.logger.error(f"Error haciendo commit de notificaciones de IPC/IRAV: {e}")
\ No newline at end of file
+            # Notificación para administradores y gestores asignados (como mucho una al mes por aniversario); email a los gestores
+            for user, es_gestor in _recipients(contract, admin_users, gestores):
+                dedupe_key = f"index_review:{contract.id}:{index_type}:{review_year}-{review_month:02d}:{today:%Y-%m}:{user.id}"
+                filas.append(dict(message=message, level='info', related_url=related_url, user_id=user.id, dedupe_key=dedupe_key))
+                if es_gestor and user.email:
+                    subject_email = f"Recordatorio: Revisión {index_type} para contrato {contract.numero_contrato}"
+                    html_body = f"<p>{message}</p><p>Revisa los índices aquí: <a href='{related_url}'>{related_url}</a></p>"
+                    emails[dedupe_key] = (user.email, subject_email, html_body)
+
+        creadas = _notify(filas, emails, "IPC/IRAV")
+        current_app.logger.info(f"Notificaciones de revisiones IPC/IRAV procesadas: {len(contracts_for_review)} contratos revisados, {creadas} notificaciones nuevas.")
\ No newline at end of file
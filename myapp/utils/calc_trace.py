@@ -0,0 +1,43 @@
+# myapp/utils/calc_trace.py
+"""
+Trazas opcionales del cálculo de facturas (config INVOICE_TRACE_LEVEL).
+
+- 'off': nada.
+- 'summary': una línea de log con el resumen de cada ejecución de generación.
+- 'full': además, la traza de decisiones de cada contrato y mes como JSON en la tabla
+  invoice_calculation_trace, enlazada al trabajo de generación (InvoiceGenerationJob).
+
+El motor de rentas solo recibe un CalcTrace en nivel full; con None no construye ningún mensaje.
+"""
+from datetime import date
+from decimal import Decimal
+
+from flask import current_app
+
+TRACE_LEVELS = ('off', 'summary', 'full')
+DEFAULT_TRACE_LEVEL = 'summary'
+
+
+def get_trace_level():
+    """Nivel configurado; un valor desconocido cuenta como el nivel por defecto."""
+    level = (current_app.config.get('INVOICE_TRACE_LEVEL') or DEFAULT_TRACE_LEVEL).lower()
+    return level if level in TRACE_LEVELS else DEFAULT_TRACE_LEVEL
+
+
+def _jsonable(value):
+    if isinstance(value, Decimal): return str(value)
+    if isinstance(value, date): return value.isoformat()
+    if isinstance(value, dict): return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)): return [_jsonable(v) for v in value]
+    return value
+
+
+class CalcTrace:
+    """Pasos de decisión de un contrato/mes: [{'step': ..., datos}], listos para guardar como JSON."""
+    __slots__ = ('events',)
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, step, **data):
+        self.events.append({'step': step, **{clave: _jsonable(valor) for clave, valor in data.items()}})
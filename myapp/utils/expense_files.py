@@ -0,0 +1,129 @@
+# myapp/utils/expense_files.py
+"""
+Ficheros de los gastos (facturas de suministros, etc.) que se adjuntan al email de la factura.
+
+Desde que se guardan file_path y mime_type al subir el gasto, adjuntarlo no toca el sistema de
+ficheros más que para leerlo (y no siempre: ver ExpenseFileCache). Los gastos subidos antes no tienen
+file_path; su ruta se reconstruye como antes (carpeta "Facturas Gastos" del propietario, año y
+"fecha - concepto.ext"), pero sin crear carpetas.
+
+Los ficheros de gasto no se modifican una vez subidos (el nombre lleva la fecha y hora de subida),
+así que la caché se direcciona solo por ruta: la comparten los hilos de la bandeja de salida, y un
+reenvío o un reintento no vuelve a leer del disco, que a menudo es una unidad de red
+(Propietario.documentos_ruta_base).
+"""
+import mimetypes
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+from .file_helpers import get_owner_document_path
+
+EXPENSE_SUBFOLDER = "Facturas Gastos"
+EXPENSE_ATTACHMENT_CACHE_MAX_MB = 64
+
+
+def expense_disk_filename(concepto, original_filename, fecha_subida):
+    """Nombre con el que se guarda el fichero en disco: "YYYYMMDD-HHMMSS - Concepto saneado.ext"."""
+    concepto_saneado = "".join(c if c.isalnum() or c in (' ', '-') else '_' for c in concepto.strip()[:50])
+    ext = original_filename.rsplit('.', 1)[1].lower() if original_filename and '.' in original_filename else ''
+    nombre = f"{fecha_subida.strftime('%Y%m%d-%H%M%S')} - {concepto_saneado}"
+    return f"{nombre}.{ext}" if ext else nombre
+
+
+def guess_expense_mime_type(filename):
+    """Tipo MIME por la extensión del fichero (application/octet-stream si no se reconoce)."""
+    return mimetypes.guess_type(filename or '')[0] or 'application/octet-stream'
+
+
+def expense_file_path(gasto):
+    """
+    Ruta absoluta del fichero del gasto, o None si no se puede determinar.
+    Gastos antiguos (sin file_path): se reconstruye con upload_date, que puede no coincidir con la hora
+    local con la que se nombró el fichero.
+    """
+    if gasto.file_path:
+        return gasto.file_path
+    propietario = gasto.contrato.propiedad_ref.propietario_ref if gasto.contrato and gasto.contrato.propiedad_ref else None
+    if not propietario or not gasto.upload_date:
+        return None
+    return get_owner_document_path(
+        propietario=propietario,
+        subfolder_type=EXPENSE_SUBFOLDER,
+        year=gasto.year or gasto.upload_date.year,
+        filename_to_secure=expense_disk_filename(gasto.concepto, gasto.original_filename, gasto.upload_date),
+        create_dirs=False,
+    )
+
+
+def expense_mime_type(gasto):
+    return gasto.mime_type or guess_expense_mime_type(gasto.original_filename or gasto.file_path)
+
+
+class ExpenseFileCache:
+    """Bytes de ficheros de gasto por ruta, con expulsión LRU por tamaño total (max_bytes)."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def read(self, path):
+        """Contenido del fichero; lo lee del disco solo si no está en caché. Propaga OSError."""
+        with self._lock:
+            data = self._entries.get(path)
+            if data is not None:
+                self._entries.move_to_end(path)
+                return data
+        with open(path, 'rb') as f_gasto:
+            data = f_gasto.read()
+        if len(data) <= self.max_bytes:
+            with self._lock:
+                if path not in self._entries:
+                    self._entries[path] = data
+                    self._size += len(data)
+                while self._size > self.max_bytes:
+                    _, expulsado = self._entries.popitem(last=False)
+                    self._size -= len(expulsado)
+        return data
+
+    def discard(self, path):
+        with self._lock:
+            data = self._entries.pop(path, None)
+            if data is not None:
+                self._size -= len(data)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_expense_file_cache():
+    """Caché del proceso (EXPENSE_ATTACHMENT_CACHE_MAX_MB; None si es 0)."""
+    global _cache
+    max_bytes = current_app.config.get('EXPENSE_ATTACHMENT_CACHE_MAX_MB', EXPENSE_ATTACHMENT_CACHE_MAX_MB) * 1024 * 1024
+    if max_bytes <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache.max_bytes != max_bytes:
+            _cache = ExpenseFileCache(max_bytes)
+        return _cache
+
+
+def read_expense_file(gasto):
+    """(ruta, bytes) del fichero del gasto; bytes None si no existe o no se puede leer."""
+    path = expense_file_path(gasto)
+    if not path:
+        current_app.logger.warning(f"No se pudo determinar la ruta del archivo del gasto {gasto.id}.")
+        return None, None
+    cache = get_expense_file_cache()
+    try:
+        if cache:
+            return path, cache.read(path)
+        with open(path, 'rb') as f_gasto:
+            return path, f_gasto.read()
+    except OSError as e:
+        current_app.logger.warning(f"Archivo de gasto {gasto.id} no legible en '{path}': {e}")
+        return path, None
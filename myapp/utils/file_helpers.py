@@ -3,7 +3,7 @@ import os
 from flask import current_app
 from werkzeug.utils import secure_filename # Ya la usas
 
-def get_owner_document_path(propietario, subfolder_type, year=None, filename_to_secure=None):
+def get_owner_document_path(propietario, subfolder_type, year=None, filename_to_secure=None, create_dirs=True):
     """
     Construye la ruta completa para un documento de un propietario.
     Crea las carpetas necesarias si no existen.
@@ -13,6 +13,7 @@ def get_owner_document_path(propietario, subfolder_type, year=None, filename_to_
         subfolder_type (str): "Facturas", "Gastos", "Contratos".
         year (int, optional): El año para subcarpetas anuales (Facturas, Gastos).
         filename_to_secure (str, optional): El nombre de archivo original para asegurar.
+        create_dirs (bool): Crear las carpetas si no existen (False para solo calcular la ruta de un fichero existente).
 
     Returns:
         str: La ruta completa a la carpeta de destino, o None si hay error.
@@ -47,7 +48,8 @@ def get_owner_document_path(propietario, subfolder_type, year=None, filename_to_
     
     # Crear carpetas si no existen
     try:
-        os.makedirs(final_folder_path, exist_ok=True)
+        if create_dirs:
+            os.makedirs(final_folder_path, exist_ok=True)
     except OSError as e:
         current_app.logger.error(f"Error creando directorio '{final_folder_path}': {e}")
         # Podrías querer usar un fallback a la instancia aquí si la ruta del usuario falla
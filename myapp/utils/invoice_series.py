@@ -0,0 +1,104 @@
+# myapp/utils/invoice_series.py
+"""
+Numeración de facturas con contadores por (serie, año) en la tabla invoice_series_counter.
+
+Cada reserva de números es una sola sentencia (INSERT ... ON CONFLICT DO UPDATE ... RETURNING): no hay
+que buscar el último número con MAX()/LIKE ni reintentar si dos usuarios crean una factura a la vez.
+Los campos serie_facturacion_ultimo_numero/ano_actual del contrato se siguen actualizando como reflejo
+para la interfaz; si la serie de un año aún no tiene contador, se parte de ellos.
+"""
+from sqlalchemy import and_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from ..models import db, InvoiceSeriesCounter
+
+
+def contract_series_key(contrato_id):
+    """Clave de la serie de un contrato (los números en BD ya llevan el prefijo C<id>-)."""
+    return f"C{contrato_id}"
+
+
+def allocate_series_numbers(series_key, year, count=1, seed=0):
+    """
+    Reserva `count` números consecutivos de la serie y devuelve el primero.
+
+    seed: último número ya usado, solo si la serie aún no tiene contador para ese año.
+    Se ejecuta en la transacción de la sesión: si se hace rollback, la reserva se deshace.
+    """
+    stmt = sqlite_insert(InvoiceSeriesCounter).values(series_key=series_key, year=year, last_number=seed + count)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['series_key', 'year'],
+        set_={'last_number': InvoiceSeriesCounter.last_number + count}
+    ).returning(InvoiceSeriesCounter.last_number)
+    last_number = db.session.execute(stmt).scalar_one()
+    return last_number - count + 1
+
+
+def set_series_last_number(series_key, year, last_number):
+    """Fija el último número usado (edición manual de la serie o borrado de facturas)."""
+    stmt = sqlite_insert(InvoiceSeriesCounter).values(series_key=series_key, year=year, last_number=last_number)
+    db.session.execute(stmt.on_conflict_do_update(index_elements=['series_key', 'year'], set_={'last_number': last_number}))
+
+
+def delete_series_counters(series_key):
+    """Borra los contadores de la serie en todos los años (serie reiniciada o contrato eliminado)."""
+    db.session.query(InvoiceSeriesCounter).filter_by(series_key=series_key).delete(synchronize_session=False)
+
+
+def sync_contract_series_counter(contrato):
+    """Lleva al contador la serie guardada en el contrato. Sin año de serie, la serie se reinicia."""
+    series_key = contract_series_key(contrato.id)
+    if contrato.serie_facturacion_ano_actual is None:
+        delete_series_counters(series_key)
+    else:
+        set_series_last_number(series_key, contrato.serie_facturacion_ano_actual, contrato.serie_facturacion_ultimo_numero or 0)
+
+
+class SeriesReservation:
+    """
+    Bloques de números reservados de una sola vez para una generación de facturas.
+
+    reserve() reserva, para cada (serie, año), tantos números como facturas se van a crear; take() los
+    reparte en orden y undo() devuelve el último entregado (por cada factura que no llega a crearse o cuyo
+    lote no se confirma), de modo que las facturas siguientes de la serie lo reutilizan y no quedan huecos.
+    release() devuelve al contador los que sobren al final.
+    En modo vista previa solo se leen los contadores: no se escribe nada.
+    """
+
+    def __init__(self, preview=False):
+        self.preview = preview
+        self._next = {}      # (serie, año) -> próximo número a entregar
+        self._reserved = {}  # (serie, año) -> último número reservado
+
+    def reserve(self, needed):
+        """needed: {(serie, año): (número de facturas, último número del reflejo en el contrato)}."""
+        if self.preview:
+            keys = {series_key for series_key, _ in needed}
+            actuales = {(c.series_key, c.year): c.last_number for c in
+                        InvoiceSeriesCounter.query.filter(InvoiceSeriesCounter.series_key.in_(keys))} if keys else {}
+            for (series_key, year), (count, seed) in needed.items():
+                self._next[(series_key, year)] = actuales.get((series_key, year), seed) + 1
+            return
+        for (series_key, year), (count, seed) in needed.items():
+            first = allocate_series_numbers(series_key, year, count, seed)
+            self._next[(series_key, year)] = first
+            self._reserved[(series_key, year)] = first + count - 1
+
+    def take(self, series_key, year):
+        numero = self._next[(series_key, year)]
+        self._next[(series_key, year)] = numero + 1
+        return numero
+
+    def undo(self, series_key, year):
+        self._next[(series_key, year)] -= 1
+
+    def release(self):
+        """Devuelve los números no usados, salvo que otra operación haya movido ya el contador."""
+        for (series_key, year), reserved_last in self._reserved.items():
+            used_last = self._next[(series_key, year)] - 1
+            if used_last < reserved_last:
+                db.session.query(InvoiceSeriesCounter).filter(and_(
+                    InvoiceSeriesCounter.series_key == series_key, InvoiceSeriesCounter.year == year,
+                    InvoiceSeriesCounter.last_number == reserved_last
+                )).update({'last_number': used_last}, synchronize_session=False)
+        self._reserved.clear()
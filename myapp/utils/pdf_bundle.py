@@ -0,0 +1,189 @@
+# myapp/utils/pdf_bundle.py
+"""
+Descarga de muchas facturas en un solo fichero, generado por trozos.
+
+- stream_invoice_zip: ZIP con un PDF por factura. zipfile escribe sobre un destino no posicionable
+  (descriptores de datos tras cada entrada), así que cada PDF sale en cuanto se ha comprimido.
+- stream_merged_pdf: un único PDF con todas las páginas. Los PDF de factura los genera ReportLab
+  (xref clásica, un árbol de páginas plano), así que basta con renumerar sus objetos y volver a
+  colgar las páginas de un /Pages común; el /Pages, el catálogo y la xref finales se escriben al acabar.
+
+En memoria solo queda el PDF que se está copiando y la tabla de offsets, por muchas facturas que haya.
+"""
+import logging
+import re
+import shutil
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+ZIP_COPY_CHUNK = 64 * 1024
+
+_REF_RE = re.compile(rb'(?<![\w.])(\d+) 0 R(?!\w)')
+_OBJ_RE = re.compile(rb'(\d+) 0 obj\s*')
+_STREAM_RE = re.compile(rb'\bstream\r?\n')
+_LENGTH_RE = re.compile(rb'/Length (\d+)(\s+\d+\s+R)?')
+
+
+class PdfMergeError(ValueError):
+    """El PDF no tiene la estructura esperada (xref clásica y árbol de páginas) y no se puede combinar."""
+
+
+class _ChunkSink:
+    """Destino de escritura no posicionable para zipfile: guarda lo escrito hasta que el generador lo recoge."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_invoice_zip(entries):
+    """
+    entries: iterable de (nombre_fichero, CachedPdf). Genera los bytes del ZIP; cada PDF se lee
+    del disco por bloques (o de memoria, si la caché está desactivada).
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for nombre, pdf in entries:
+            with zf.open(nombre, 'w') as destino:
+                if pdf.path:
+                    with open(pdf.path, 'rb') as origen:
+                        shutil.copyfileobj(origen, destino, ZIP_COPY_CHUNK)
+                else:
+                    destino.write(pdf.data)
+            yield sink.drain()
+    yield sink.drain() # Directorio central
+
+
+def _read_xref(data):
+    """{num_objeto: offset} de la xref clásica del PDF, y el trailer."""
+    inicio = data.rfind(b'startxref')
+    if inicio < 0:
+        raise PdfMergeError("sin startxref")
+    pos = int(data[inicio + 9:].split()[0])
+    if not data.startswith(b'xref', pos):
+        raise PdfMergeError("xref comprimida o no encontrada")
+    lineas = data[pos + 4:data.index(b'trailer', pos)].split(b'\n')
+    offsets, num = {}, 0
+    for linea in lineas:
+        partes = linea.split()
+        if len(partes) == 2: # Cabecera de subsección: primer objeto y número de entradas
+            num = int(partes[0])
+        elif len(partes) == 3:
+            if partes[2] == b'n':
+                offsets[num] = int(partes[0])
+            num += 1
+    return offsets, data[data.index(b'trailer', pos):]
+
+
+def _read_objects(data):
+    """
+    Objetos del PDF como {num: (diccionario, stream o None)} y los números de página en orden.
+    El catálogo, /Info y los nodos /Pages no se copian: la salida tiene los suyos.
+    """
+    offsets, trailer = _read_xref(data)
+    objetos = {}
+    for num, offset in offsets.items():
+        cabecera = _OBJ_RE.match(data, offset)
+        if not cabecera or int(cabecera.group(1)) != num:
+            raise PdfMergeError(f"objeto {num} no está en su offset")
+        inicio = cabecera.end()
+        fin_obj = data.index(b'endobj', inicio)
+        stream = _STREAM_RE.search(data, inicio, fin_obj)
+        if stream:
+            # El contenido del stream se copia tal cual (por /Length): puede contener cualquier byte
+            diccionario = data[inicio:stream.start()]
+            longitud = _LENGTH_RE.search(diccionario)
+            if not longitud or longitud.group(2):
+                raise PdfMergeError(f"stream sin /Length directo en el objeto {num}")
+            objetos[num] = (diccionario, data[stream.end():stream.end() + int(longitud.group(1))])
+        else:
+            objetos[num] = (data[inicio:fin_obj], None)
+
+    def _ref(diccionario, clave):
+        encontrado = re.search(rb'/' + clave + rb' (\d+) 0 R', diccionario)
+        if not encontrado:
+            raise PdfMergeError(f"sin /{clave.decode()}")
+        return int(encontrado.group(1))
+
+    raiz = _ref(trailer, b'Root')
+    nodos_paginas, paginas = set(), []
+
+    def _recorrer(num):
+        diccionario = objetos[num][0]
+        if b'/Type /Pages' in diccionario:
+            nodos_paginas.add(num)
+            kids = re.search(rb'/Kids \[([^\]]*)\]', diccionario)
+            for kid in _REF_RE.findall(kids.group(1) if kids else b''):
+                _recorrer(int(kid))
+        else:
+            paginas.append(num)
+
+    _recorrer(_ref(objetos[raiz][0], b'Pages'))
+    omitidos = nodos_paginas | {raiz}
+    info = re.search(rb'/Info (\d+) 0 R', trailer)
+    if info:
+        omitidos.add(int(info.group(1)))
+    return {num: obj for num, obj in objetos.items() if num not in omitidos}, paginas, nodos_paginas
+
+
+def stream_merged_pdf(pdfs):
+    """
+    pdfs: iterable de bytes de PDF de factura. Genera los bytes de un único PDF con todas sus páginas
+    en orden. Un PDF que no se puede leer se omite (y se registra) sin cortar la descarga.
+    """
+    PAGES, CATALOG = 1, 2
+    cabecera = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+    offset, siguiente = len(cabecera), CATALOG + 1
+    offsets, kids = {}, []
+    yield cabecera
+
+    for indice, data in enumerate(pdfs):
+        # Todo el PDF se renumera antes de escribir nada: uno con referencias rotas se omite entero
+        try:
+            objetos, paginas, nodos_paginas = _read_objects(data)
+            nuevos = {num: siguiente + i for i, num in enumerate(sorted(objetos))}
+
+            def _renumerar(m):
+                num = int(m.group(1))
+                if num in nodos_paginas: return b'%d 0 R' % PAGES # /Parent de cada página
+                return b'%d 0 R' % nuevos[num]
+
+            trozos = []
+            for num, (diccionario, stream) in sorted(objetos.items()):
+                obj = b'%d 0 obj\n' % nuevos[num] + _REF_RE.sub(_renumerar, diccionario)
+                if stream is not None:
+                    obj += b'stream\n' + stream + b'\nendstream\n'
+                trozos.append((nuevos[num], obj + b'endobj\n'))
+        except (PdfMergeError, ValueError, IndexError, KeyError) as e_pdf:
+            logger.warning(f"PDF {indice} omitido al combinar: {e_pdf}")
+            continue
+        for num, obj in trozos:
+            offsets[num] = offset
+            offset += len(obj)
+        kids.extend(nuevos[num] for num in paginas)
+        siguiente += len(nuevos)
+        yield b''.join(obj for _, obj in trozos)
+
+    final = []
+    for num, obj in ((PAGES, b'<<\n/Count %d /Kids [ %s ] /Type /Pages\n>>\n' % (len(kids), b' '.join(b'%d 0 R' % k for k in kids))),
+                     (CATALOG, b'<<\n/PageMode /UseNone /Pages %d 0 R /Type /Catalog\n>>\n' % PAGES)):
+        obj = b'%d 0 obj\n' % num + obj + b'endobj\n'
+        offsets[num] = offset
+        offset += len(obj)
+        final.append(obj)
+    final.append(b'xref\n0 %d\n0000000000 65535 f \n' % siguiente)
+    final.extend(b'%010d 00000 n \n' % offsets[num] for num in range(1, siguiente))
+    final.append(b'trailer\n<<\n/Root %d 0 R /Size %d\n>>\nstartxref\n%d\n%%%%EOF\n' % (CATALOG, siguiente, offset))
+    yield b''.join(final)
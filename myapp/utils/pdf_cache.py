@@ -0,0 +1,197 @@
+# myapp/utils/pdf_cache.py
+"""
+Caché en disco de los PDF de factura, direccionada por contenido.
+
+La clave es el SHA-256 de todo lo que se pinta en el PDF: la instantánea de render de la factura
+(conceptos, totales, notas, emisor, inquilino, propiedad, pie y notas por defecto), el logo (ruta y
+mtime) y INVOICE_PDF_TEMPLATE_VERSION. Si cambia cualquiera de ellos cambia la clave, así que una
+entrada nunca queda desfasada: como mucho deja de usarse y la expulsa el LRU.
+
+Los ficheros viven en <instance>/pdf_cache/<2 primeros caracteres>/<clave>.pdf. El mtime de cada
+fichero hace de "último uso" y, si el total supera INVOICE_PDF_CACHE_MAX_MB, se borran los más antiguos.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from flask import current_app
+
+from .pdf_generator import INVOICE_PDF_TEMPLATE_VERSION, _build_invoice_pdf, snapshot_invoice_for_render
+
+
+def invoice_pdf_key(snapshot):
+    """Clave de caché (hex) de una instantánea de snapshot_invoice_for_render."""
+    logo_path = getattr(snapshot.settings, 'logo_path', None) if snapshot.settings else None
+    try:
+        logo_mtime = os.path.getmtime(logo_path) if logo_path else None
+    except OSError:
+        logo_mtime = None
+    entradas = {
+        'template': INVOICE_PDF_TEMPLATE_VERSION,
+        'invoice': vars(snapshot.invoice) if snapshot.invoice else None,
+        'inquilino': vars(snapshot.inquilino) if snapshot.inquilino else None,
+        'propiedad': vars(snapshot.propiedad) if snapshot.propiedad else None,
+        'emisor': vars(snapshot.emisor) if snapshot.emisor else None,
+        'settings': vars(snapshot.settings) if snapshot.settings else None,
+        'logo_mtime': logo_mtime,
+    }
+    canonico = json.dumps(entradas, sort_keys=True, ensure_ascii=False, default=lambda v: vars(v) if hasattr(v, '__dict__') else str(v))
+    return hashlib.sha256(canonico.encode('utf-8')).hexdigest()
+
+
+@dataclass
+class CachedPdf:
+    """PDF de una factura: en disco (path) si la caché está activa; si no, en memoria (data)."""
+    etag: str
+    path: Optional[str] = None
+    data: Optional[bytes] = None
+
+    def read_bytes(self):
+        if self.data is not None:
+            return self.data
+        with open(self.path, 'rb') as f_pdf:
+            return f_pdf.read()
+
+
+class InvoicePdfCache:
+    """Directorio de PDFs por clave con expulsión LRU por tamaño total (max_bytes)."""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None  # Bytes ocupados según este proceso; None = aún sin calcular
+
+    def path_for(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.pdf")
+
+    def get(self, key):
+        """Ruta del PDF en caché (y lo marca como recién usado), o None."""
+        path = self.path_for(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, data):
+        """Guarda el PDF (escritura atómica: nunca se sirve un fichero a medias) y devuelve su ruta."""
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f_tmp:
+                f_tmp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+        self._added(len(data))
+        return path
+
+    def put_file(self, key, source_path):
+        """Copia a la caché un PDF ya renderizado (p. ej. el guardado en la carpeta del propietario)."""
+        with open(source_path, 'rb') as f_src:
+            return self.put(key, f_src.read())
+
+    def discard(self, key):
+        try:
+            os.remove(self.path_for(key))
+        except OSError:
+            pass
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.pdf'):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield st.st_mtime, st.st_size, path
+
+    def _added(self, nbytes):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += nbytes
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Recalcula desde disco (otros procesos también escriben) y deja la caché al 90% del máximo
+        entradas = sorted(self._entries())
+        total = sum(size for _, size, _ in entradas)
+        objetivo = int(self.max_bytes * 0.9)
+        for _, size, path in entradas:
+            if total <= objetivo: break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._size = total
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_invoice_pdf_cache():
+    """Caché configurada en la app (INVOICE_PDF_CACHE_DIR / INVOICE_PDF_CACHE_MAX_MB), o None si está desactivada."""
+    max_mb = current_app.config.get('INVOICE_PDF_CACHE_MAX_MB', 0)
+    root = current_app.config.get('INVOICE_PDF_CACHE_DIR')
+    if not max_mb or not root:
+        return None
+    with _caches_lock:
+        cache = _caches.get(root)
+        if cache is None or cache.max_bytes != max_mb * 1024 * 1024:
+            cache = _caches[root] = InvoicePdfCache(root, max_mb * 1024 * 1024)
+    return cache
+
+
+def get_invoice_pdf(invoice, settings):
+    """
+    PDF de una factura ORM (con inquilino, propiedad, emisor y contrato cargados): de la caché si ya
+    existe para estos mismos datos; si no, se renderiza y se guarda. Devuelve None si no se pudo renderizar.
+    """
+    propiedad = invoice.propiedad_ref
+    if not invoice.inquilino_ref or not propiedad or not propiedad.propietario_ref:
+        current_app.logger.error(f"get_invoice_pdf: Datos incompletos para factura ID {invoice.id}")
+        return None
+    snapshot = snapshot_invoice_for_render(invoice, settings)
+    key = invoice_pdf_key(snapshot)
+    cache = get_invoice_pdf_cache()
+    if cache is not None:
+        path = cache.get(key)
+        if path:
+            return CachedPdf(etag=key, path=path)
+
+    pdf_buffer = _build_invoice_pdf(snapshot.invoice, snapshot.inquilino, snapshot.propiedad, snapshot.emisor, snapshot.settings)
+    if pdf_buffer is None:
+        return None
+    data = pdf_buffer.getvalue()
+    if cache is not None:
+        try:
+            return CachedPdf(etag=key, path=cache.put(key, data))
+        except OSError as e_cache:
+            current_app.logger.warning(f"No se pudo guardar en caché el PDF de la factura {invoice.id}: {e_cache}")
+    return CachedPdf(etag=key, data=data)
+
+
+def invoice_pdf_cache_key(invoice, settings):
+    """Clave actual de una factura ORM (para descartar su entrada al editarla o borrarla)."""
+    return invoice_pdf_key(snapshot_invoice_for_render(invoice, settings))
+
+
+def discard_invoice_pdf(key):
+    """Borra de la caché el PDF con esa clave, si la caché está activa."""
+    cache = get_invoice_pdf_cache()
+    if cache is not None and key:
+        cache.discard(key)
@@ -3,15 +3,24 @@
 import io
 import os
 import json
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
 
 from flask import current_app, g, abort
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image, KeepInFrame
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image, KeepInFrame, Flowable
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT
 from reportlab.lib.units import cm
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfmetrics
 
 # --- Importar db y modelos ---
 try:
@@ -53,6 +62,8 @@ except ImportError:
 PAGE_WIDTH, PAGE_HEIGHT = A4
 styles = getSampleStyleSheet()
 TWO_PLACES = Decimal('0.01')
+# Súbelo al cambiar el diseño de la factura: invalida los PDFs cacheados (ver utils/pdf_cache.py)
+INVOICE_PDF_TEMPLATE_VERSION = 1
 
 # Color principal para acentos (azul profesional)
 PRIMARY_COLOR = colors.HexColor('#1e3a5f')
@@ -283,20 +294,254 @@ def calculate_due_date(emission_date, days=30):
     except:
         return ""
 
+# --- Renderer de facturas (uno por proceso) ---
+LOGO_MAX_WIDTH, LOGO_MAX_HEIGHT = 5*cm, 2*cm
+
+class _LogoFlowable(Flowable):
+    """Logo ya decodificado (ImageReader compartido por el proceso), escalado para caber en max_width x max_height."""
+    def __init__(self, reader, max_width, max_height):
+        super().__init__()
+        self._reader = reader
+        image_width, image_height = reader.getSize()
+        factor = min(max_width / image_width, max_height / image_height, 1)
+        self.width, self.height = image_width * factor, image_height * factor
+        self.hAlign = 'LEFT'
+
+    def wrap(self, availWidth, availHeight):
+        return self.width, self.height
+
+    def draw(self):
+        self.canv.drawImage(self._reader, 0, 0, self.width, self.height, mask='auto')
+
+class _ChromeParagraph(Flowable):
+    """
+    Párrafo fijo de la factura (rótulos, datos del emisor, pie): se maqueta una vez por (texto, estilo, ancho)
+    y las demás facturas dibujan ese mismo Paragraph ya maquetado (drawOn), sin volver a partir líneas.
+    Con as_form (el pie de las páginas siguientes) se dibuja una vez por documento en un form XObject
+    (canvas.beginForm/endForm) y cada página lo referencia con doForm.
+    """
+    def __init__(self, renderer, text, style_name, as_form=False):
+        super().__init__()
+        self._renderer, self._text, self._style_name, self._as_form = renderer, text, style_name, as_form
+        self.style = renderer.styles[style_name] # getSpaceBefore/After como en Paragraph
+        self._paragraph = None
+
+    def wrap(self, availWidth, availHeight):
+        self._paragraph = self._renderer._chrome_paragraph(self._text, self._style_name, availWidth)
+        self.width, self.height = self._paragraph.width, self._paragraph.height
+        return self.width, self.height
+
+    def minWidth(self):
+        return self._paragraph.minWidth() if self._paragraph else self._renderer.paragraph(self._text, self._style_name).minWidth()
+
+    def draw(self):
+        canvas = self.canv
+        if not self._as_form:
+            self._paragraph.drawOn(canvas, 0, 0)
+            return
+        form_name = 'Chrome' + hashlib.sha1(repr((self._text, self._style_name, self.width)).encode('utf-8')).hexdigest()[:16]
+        if not canvas.hasForm(form_name):
+            # BBox de toda la página alrededor del origen: el form no recorta nada de lo que dibuje el párrafo
+            canvas.beginForm(form_name, lowerx=-PAGE_WIDTH, lowery=-PAGE_HEIGHT, upperx=PAGE_WIDTH, uppery=PAGE_HEIGHT)
+            self._paragraph.drawOn(canvas, 0, 0)
+            canvas.endForm()
+        canvas.doForm(form_name)
+
+class InvoicePdfRenderer:
+    """
+    Recursos de maquetación compartidos por todas las facturas de un proceso (ver get_invoice_renderer):
+    estilos, métricas de las fuentes, estilos de tabla fijos, párrafos ya analizados y logos decodificados.
+    Cada factura solo crea sus propios flowables.
+
+    Los párrafos se cachean como fragmentos del parser de ReportLab por (texto, estilo): las etiquetas fijas,
+    los datos del emisor o el pie se repiten en casi todas las facturas. Los logos, por (ruta, mtime):
+    un logo nuevo con el mismo nombre se vuelve a leer.
+
+    Lo que apenas cambia entre facturas (rótulos, datos del emisor, pie) va además como chrome(): se maqueta
+    una sola vez y se reutiliza ya maquetado (una caché por hilo: un Paragraph no se puede dibujar a la vez
+    en dos documentos). prerender_chrome=False lo desactiva (benchmarks).
+    """
+    PARAGRAPH_CACHE_SIZE = 4096
+    CHROME_CACHE_SIZE = 1024
+
+    def __init__(self, prerender_chrome=True):
+        self.styles = styles
+        self.fonts = self._load_fonts()
+        self.table_styles = self._build_table_styles()
+        self.prerender_chrome = prerender_chrome
+        self._parse = lru_cache(maxsize=self.PARAGRAPH_CACHE_SIZE)(self._parse_uncached)
+        self._local = threading.local() # Párrafos fijos ya maquetados, por hilo (ver _chrome_paragraph)
+        self._logos = {}  # ruta -> (mtime, ImageReader o None si no se puede leer)
+        self._logos_lock = threading.Lock()
+
+    def _load_fonts(self):
+        """Fuentes de los estilos (estándar de ReportLab): sus métricas se cargan una vez por proceso."""
+        font_names = {style.fontName for style in self.styles.byName.values() if isinstance(style, ParagraphStyle)}
+        return {name: pdfmetrics.getFont(name) for name in sorted(font_names)}
+
+    @staticmethod
+    def _build_table_styles():
+        return {
+            'header': TableStyle([
+                ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+                ('LEFTPADDING', (0,0), (0,0), 0),
+                ('RIGHTPADDING', (1,0), (1,0), 0),
+            ]),
+            'line': TableStyle([
+                ('LINEBELOW', (0, 0), (-1, -1), 2, PRIMARY_COLOR)
+            ]),
+            'client_ref': TableStyle([
+                ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+                ('LEFTPADDING', (0,0), (0,0), 0),
+                ('RIGHTPADDING', (1,0), (1,0), 0),
+                ('ALIGN', (1,0), (1,0), 'RIGHT'),
+            ]),
+            'concepts': TableStyle([
+                # Estilo del header
+                ('BACKGROUND', (0, 0), (-1, 0), PRIMARY_COLOR),
+                ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+                ('TOPPADDING', (0, 0), (-1, 0), 10),
+                ('BOTTOMPADDING', (0, 0), (-1, 0), 10),
+                ('LEFTPADDING', (0, 0), (-1, -1), 15),
+                ('RIGHTPADDING', (0, 0), (-1, -1), 15),
+
+                # Estilo del contenido
+                ('TOPPADDING', (0, 1), (-1, -1), 8),
+                ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
+
+                # Alternar colores de fila
+                ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, ACCENT_COLOR]),
+
+                # Bordes
+                ('LINEBELOW', (0, 0), (-1, 0), 1, PRIMARY_COLOR),
+                ('LINEBELOW', (0, -1), (-1, -1), 1, colors.HexColor('#E0E0E0')),
+
+                # Alineación
+                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ]),
+            'totals': TableStyle([
+                ('BACKGROUND', (0, 0), (-1, -1), SECONDARY_COLOR),
+                ('LEFTPADDING', (0, 0), (-1, -1), 12),
+                ('RIGHTPADDING', (0, 0), (-1, -1), 12),
+                ('TOPPADDING', (0, 0), (-1, -1), 6),
+                ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+                ('LINEABOVE', (0, -1), (-1, -1), 2, PRIMARY_COLOR),
+                ('TOPPADDING', (0, -1), (-1, -1), 10),
+                ('BOTTOMPADDING', (0, -1), (-1, -1), 10),
+            ]),
+            'totals_container': TableStyle([
+                ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
+                ('VALIGN', (1, 0), (1, 0), 'TOP'),
+            ]),
+            'payment_notes': TableStyle([
+                ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+                ('LEFTPADDING', (0,0), (0,0), 0),
+                ('RIGHTPADDING', (1,0), (1,0), 0),
+                ('TOPPADDING', (0,0), (-1,0), 0),
+                ('BOTTOMPADDING', (0,0), (-1,0), 0),
+            ]),
+        }
+
+    def _parse_uncached(self, text, style_name):
+        parsed = Paragraph(text, self.styles[style_name])
+        return parsed.style, parsed.frags, parsed.bulletText
+
+    def paragraph(self, text, style_name):
+        """Paragraph nuevo (cada documento maqueta el suyo) con los fragmentos ya analizados."""
+        style, frags, bullet_text = self._parse(text, style_name)
+        return Paragraph(text, style, bulletText=bullet_text, frags=frags)
+
+    def chrome(self, text, style_name, as_form=False):
+        """
+        Como paragraph(), para texto que se repite en muchas facturas: se reutiliza ya maquetado.
+        as_form: para lo que se repite en cada página (el pie): un form XObject por documento.
+        """
+        if not self.prerender_chrome:
+            return self.paragraph(text, style_name)
+        return _ChromeParagraph(self, text, style_name, as_form)
+
+    def _chrome_cache(self):
+        cache = getattr(self._local, 'chrome', None)
+        if cache is None:
+            cache = self._local.chrome = lru_cache(maxsize=self.CHROME_CACHE_SIZE)(self._layout_chrome)
+        return cache
+
+    def _chrome_paragraph(self, text, style_name, availWidth):
+        """Paragraph maquetado a availWidth, compartido por las facturas que dibuja este hilo."""
+        return self._chrome_cache()(text, style_name, availWidth)
+
+    def _layout_chrome(self, text, style_name, availWidth):
+        paragraph = self.paragraph(text, style_name)
+        paragraph.wrap(availWidth, PAGE_HEIGHT) # La altura disponible no cambia la maquetación
+        return paragraph
+
+    def logo(self, path, max_width=LOGO_MAX_WIDTH, max_height=LOGO_MAX_HEIGHT):
+        """Flowable del logo en `path`, o None si no existe o no es una imagen legible (p. ej. SVG)."""
+        if not path:
+            return None
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        with self._logos_lock:
+            cached = self._logos.get(path)
+        if cached is None or cached[0] != mtime:
+            try:
+                reader = ImageReader(path)
+                reader.getRGBData()  # Decodificar ahora, una sola vez
+            except Exception as e_logo:
+                _get_logger().warning(f"No se pudo cargar el logo '{path}' para las facturas: {e_logo}")
+                reader = None
+            cached = (mtime, reader)
+            with self._logos_lock:
+                self._logos[path] = cached
+        return _LogoFlowable(cached[1], max_width, max_height) if cached[1] is not None else None
+
+    def cache_info(self):
+        """Estado de las cachés (para diagnóstico y benchmarks)."""
+        info, chrome = self._parse.cache_info(), self._chrome_cache().cache_info() # chrome: del hilo actual
+        return {'paragraphs_cached': info.currsize, 'paragraph_hits': info.hits, 'paragraph_misses': info.misses,
+                'chrome_cached': chrome.currsize, 'chrome_hits': chrome.hits, 'chrome_misses': chrome.misses,
+                'logos_cached': len(self._logos), 'fonts': list(self.fonts)}
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+def get_invoice_renderer():
+    """Renderer del proceso, creado en el primer uso (también en cada proceso del pool de render)."""
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                _renderer = InvoicePdfRenderer()
+    return _renderer
+
+def resolve_company_logo_path(settings):
+    """
+    Ruta del logo de la empresa (SystemSettings.company_logo_filename en UPLOAD_FOLDER_LOGOS), o None.
+    La factura solo lleva logo si se activa INVOICE_PDF_SHOW_LOGO: por defecto se mantiene el diseño sin logo.
+    """
+    logo_path = getattr(settings, 'logo_path', None) # Snapshot para el pool de render: ya resuelta
+    if logo_path or not getattr(settings, 'company_logo_filename', None):
+        return logo_path
+    try:
+        if not current_app.config.get('INVOICE_PDF_SHOW_LOGO'):
+            return None
+        logo_folder = current_app.config.get('UPLOAD_FOLDER_LOGOS')
+    except RuntimeError:
+        return None
+    return os.path.join(logo_folder, settings.company_logo_filename) if logo_folder else None
+
 # --- Función Principal de Generación ---
-def generate_invoice_pdf(invoice_id):
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4,
-                            leftMargin=2*cm, rightMargin=2*cm,
-                            topMargin=1.5*cm, bottomMargin=2*cm)
-    story = []
-    current_page_width = PAGE_WIDTH - doc.leftMargin - doc.rightMargin
-    
-    # Define logger
-    logger_func = print
-    if 'current_app' in globals() and hasattr(current_app, 'logger'):
-        logger_func = current_app.logger
+def _get_logger():
+    """Logger de la app si hay contexto Flask; si no (procesos de render), el logger del módulo."""
+    try:
+        return current_app.logger
+    except RuntimeError:
+        return logging.getLogger(__name__)
 
+def _load_invoice_pdf_data(invoice_id, logger_func):
+    """Carga factura, inquilino, propiedad, emisor y settings. Devuelve None si faltan datos."""
     try:
         invoice = None
         if db:
@@ -332,12 +577,89 @@ def generate_invoice_pdf(invoice_id):
         logger_func.error(f"Error obteniendo datos para PDF factura {invoice_id}: {e_data}")
         return None
 
+    return invoice, inquilino, propiedad, emisor, settings
+
+def generate_invoice_pdf(invoice_id):
+    logger_func = _get_logger()
+    data = _load_invoice_pdf_data(invoice_id, logger_func)
+    if data is None:
+        return None
+    return _build_invoice_pdf(*data, logger_func=logger_func)
+
+# --- Render por lotes ---
+_PDF_BATCH_CHUNK = 500 # Ids por consulta (muy por debajo del límite de parámetros de SQLite)
+
+def get_invoice_pdf_settings():
+    """SystemSettings con los que se pinta el PDF (pie, notas por defecto y logo): los de la request o los de BD."""
+    return getattr(g, 'settings', None) or db.session.get(SystemSettings, 1) or SystemSettings()
+
+def load_invoices_for_pdf(invoice_ids, *extra_options):
+    """
+    Carga las facturas con todo lo que pinta el PDF (inquilino, propiedad, propietario y contrato).
+    Con selectinload son unas pocas consultas por lote, sin importar cuántas facturas haya.
+    extra_options: opciones de carga adicionales (p. ej. selectinload(Factura.gastos_incluidos) para el email).
+
+    Returns:
+        list[Factura]: en el orden de invoice_ids; los ids inexistentes se omiten.
+    """
+    ids = list(dict.fromkeys(invoice_ids))
+    por_id = {}
+    for inicio in range(0, len(ids), _PDF_BATCH_CHUNK):
+        facturas = Factura.query.options(
+            db.selectinload(Factura.inquilino_ref),
+            db.selectinload(Factura.propiedad_ref).selectinload(Propiedad.propietario_ref),
+            db.selectinload(Factura.contrato_ref),
+            *extra_options
+        ).filter(Factura.id.in_(ids[inicio:inicio + _PDF_BATCH_CHUNK])).all()
+        por_id.update((f.id, f) for f in facturas)
+    return [por_id[invoice_id] for invoice_id in ids if invoice_id in por_id]
+
+def generate_invoice_pdfs(invoice_ids, settings=None):
+    """
+    Versión por lotes de generate_invoice_pdf: carga todas las facturas con load_invoices_for_pdf,
+    los settings una sola vez, y las pinta con el renderer compartido del proceso.
+
+    Returns:
+        dict: {invoice_id: BytesIO, o None si no existe, faltan datos o falló el render}, en el orden de invoice_ids.
+    """
+    logger_func = _get_logger()
+    resultado = dict.fromkeys(invoice_ids)
+    settings = settings or get_invoice_pdf_settings()
+    renderer = get_invoice_renderer()
+    for invoice in load_invoices_for_pdf(resultado):
+        propiedad = invoice.propiedad_ref
+        emisor = propiedad.propietario_ref if propiedad else None
+        if not invoice.inquilino_ref or not emisor:
+            logger_func.error(f"generate_invoice_pdfs: Datos incompletos para factura ID {invoice.id}")
+            continue
+        resultado[invoice.id] = _build_invoice_pdf(invoice, invoice.inquilino_ref, propiedad, emisor, settings,
+                                                   logger_func=logger_func, renderer=renderer)
+    faltan = [invoice_id for invoice_id, pdf in resultado.items() if pdf is None]
+    if faltan:
+        logger_func.warning(f"generate_invoice_pdfs: {len(faltan)} de {len(resultado)} facturas sin PDF (ids {faltan[:20]})")
+    return resultado
+
+def _build_invoice_pdf(invoice, inquilino, propiedad, emisor, settings, logger_func=None, renderer=None):
+    """Maqueta el PDF de la factura a partir de objetos ya cargados (ORM o snapshot). renderer: por defecto el del proceso."""
+    logger_func = logger_func or _get_logger()
+    renderer = renderer or get_invoice_renderer()
+    invoice_id = getattr(invoice, 'id', None)
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4,
+                            leftMargin=2*cm, rightMargin=2*cm,
+                            topMargin=1.5*cm, bottomMargin=2*cm)
+    story = []
+    current_page_width = PAGE_WIDTH - doc.leftMargin - doc.rightMargin
+
     # 1. Cabecera con título FACTURA y datos de la empresa
     header_left = [
-        Paragraph("FACTURA", styles['InvoiceTitle']),
-        Paragraph(f"Número: <b>{getattr(invoice, 'numero_factura_mostrado_al_cliente', 'SIN NÚMERO')}</b>", styles['InvoiceDetails']),
-        Paragraph(f"Fecha: <b>{format_date(getattr(invoice, 'fecha_emision', None))}</b>", styles['InvoiceDetails'])
+        renderer.chrome("FACTURA", 'InvoiceTitle'),
+        renderer.paragraph(f"Número: <b>{getattr(invoice, 'numero_factura_mostrado_al_cliente', 'SIN NÚMERO')}</b>", 'InvoiceDetails'),
+        renderer.paragraph(f"Fecha: <b>{format_date(getattr(invoice, 'fecha_emision', None))}</b>", 'InvoiceDetails')
     ]
+    logo = renderer.logo(resolve_company_logo_path(settings))
+    if logo is not None:
+        header_left.insert(0, logo)
 
     # Datos de la empresa (lado derecho)
     emisor_nombre = getattr(emisor, 'nombre', "Nombre Emisor No Disponible")
@@ -357,35 +679,29 @@ def generate_invoice_pdf(invoice_id):
         emisor_info_parts.append(f"Tel: {emisor.telefono}")
 
     header_right = [
-        Paragraph(emisor_nombre, styles['CompanyName']),
-        Paragraph("<br/>".join(emisor_info_parts), styles['CompanyDetails'])
+        renderer.chrome(emisor_nombre, 'CompanyName'),
+        renderer.chrome("<br/>".join(emisor_info_parts), 'CompanyDetails')
     ]
 
     header_data = [[header_left, header_right]]
     header_table = Table(header_data, colWidths=[current_page_width * 0.45, current_page_width * 0.55])
-    header_table.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('LEFTPADDING', (0,0), (0,0), 0),
-        ('RIGHTPADDING', (1,0), (1,0), 0),
-    ]))
+    header_table.setStyle(renderer.table_styles['header'])
     story.append(header_table)
     story.append(Spacer(1, 0.3*cm))
 
     # 2. Línea separadora elegante
     line_table = Table([['']], colWidths=[current_page_width])
-    line_table.setStyle(TableStyle([
-        ('LINEBELOW', (0, 0), (-1, -1), 2, PRIMARY_COLOR)
-    ]))
+    line_table.setStyle(renderer.table_styles['line'])
     story.append(line_table)
     story.append(Spacer(1, 0.5*cm))
 
     # 3. Información del cliente y referencia de propiedad
     # Cliente (lado izquierdo)
     client_block = []
-    client_block.append(Paragraph("FACTURAR A:", styles['SectionTitle']))
+    client_block.append(renderer.chrome("FACTURAR A:", 'SectionTitle'))
     
     client_name = getattr(inquilino, 'nombre', "Cliente N/A")
-    client_block.append(Paragraph(client_name, styles['ClientName']))
+    client_block.append(renderer.paragraph(client_name, 'ClientName'))
     
     client_info_parts = []
     if hasattr(inquilino, 'direccion') and inquilino.direccion:
@@ -399,11 +715,11 @@ def generate_invoice_pdf(invoice_id):
         client_info_parts.append(f"NIF/CIF: {inquilino.nif}")
     
     if client_info_parts:
-        client_block.append(Paragraph("<br/>".join(client_info_parts), styles['ClientDetails']))
+        client_block.append(renderer.paragraph("<br/>".join(client_info_parts), 'ClientDetails'))
     
     # Referencia (lado derecho)
     ref_block = []
-    ref_block.append(Paragraph("REFERENTE A:", styles['SectionTitleRight']))
+    ref_block.append(renderer.chrome("REFERENTE A:", 'SectionTitleRight'))
     
     ref_info_parts = []
     propiedad_dir = getattr(propiedad, 'direccion', "Dirección N/A")
@@ -419,24 +735,19 @@ def generate_invoice_pdf(invoice_id):
     if hasattr(propiedad, 'descripcion') and propiedad.descripcion:
         ref_info_parts.append(propiedad.descripcion)
     
-    ref_block.append(Paragraph("<br/>".join(ref_info_parts), styles['ClientDetailsRight']))
+    ref_block.append(renderer.paragraph("<br/>".join(ref_info_parts), 'ClientDetailsRight'))
     
     # Tabla con cliente y referencia lado a lado
     client_ref_data = [[client_block, ref_block]]
     client_ref_table = Table(client_ref_data, colWidths=[current_page_width * 0.55, current_page_width * 0.45])
-    client_ref_table.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('LEFTPADDING', (0,0), (0,0), 0),
-        ('RIGHTPADDING', (1,0), (1,0), 0),
-        ('ALIGN', (1,0), (1,0), 'RIGHT'),
-    ]))
+    client_ref_table.setStyle(renderer.table_styles['client_ref'])
     story.append(client_ref_table)
     story.append(Spacer(1, 0.8*cm))
 
     # 4. Tabla de conceptos con diseño mejorado
     concept_header = [
-        [Paragraph("DESCRIPCIÓN", styles['TableHeader']), 
-         Paragraph("IMPORTE", styles['TableHeaderRight'])]
+        [renderer.chrome("DESCRIPCIÓN", 'TableHeader'), 
+         renderer.chrome("IMPORTE", 'TableHeaderRight')]
     ]
 
     items_list = getattr(invoice, 'items', [])
@@ -452,42 +763,20 @@ def generate_invoice_pdf(invoice_id):
                 total_item = format_currency(item.get('total', 0.0))
                 
                 concept_data.append([
-                    Paragraph(desc, styles['TableCell']),
-                    Paragraph(total_item, styles['TableCellRight'])
+                    renderer.paragraph(desc, 'TableCell'),
+                    renderer.paragraph(total_item, 'TableCellRight')
                 ])
     else:
         concept_data.append([
-            Paragraph('(Sin conceptos)', styles['TableCell']), 
-            Paragraph('0,00 €', styles['TableCellRight'])
+            renderer.paragraph('(Sin conceptos)', 'TableCell'), 
+            renderer.paragraph('0,00 €', 'TableCellRight')
         ])
 
     # Combinar header y data
     all_table_data = concept_header + concept_data
     
     concept_table = Table(all_table_data, colWidths=[current_page_width * 0.72, current_page_width * 0.28])
-    concept_table.setStyle(TableStyle([
-        # Estilo del header
-        ('BACKGROUND', (0, 0), (-1, 0), PRIMARY_COLOR),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('TOPPADDING', (0, 0), (-1, 0), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 10),
-        ('LEFTPADDING', (0, 0), (-1, -1), 15),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 15),
-        
-        # Estilo del contenido
-        ('TOPPADDING', (0, 1), (-1, -1), 8),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
-        
-        # Alternar colores de fila
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, ACCENT_COLOR]),
-        
-        # Bordes
-        ('LINEBELOW', (0, 0), (-1, 0), 1, PRIMARY_COLOR),
-        ('LINEBELOW', (0, -1), (-1, -1), 1, colors.HexColor('#E0E0E0')),
-        
-        # Alineación
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-    ]))
+    concept_table.setStyle(renderer.table_styles['concepts'])
     story.append(concept_table)
     story.append(Spacer(1, 0.8*cm))
 
@@ -502,46 +791,34 @@ def generate_invoice_pdf(invoice_id):
     irpf_rate = (irpf_val / subtotal_val * 100) if subtotal_val and irpf_val is not None and subtotal_val != Decimal('0.00') else Decimal('0.0')
 
     totals_data = [
-        [Paragraph('Base Imponible:', styles['TotalLabel']), 
-         Paragraph(format_currency(subtotal_val), styles['TotalValue'])],
-        [Paragraph(f'IVA ({iva_rate:.0f}%):'.replace('.', ','), styles['TotalLabel']), 
-         Paragraph(format_currency(iva_val), styles['TotalValue'])]
+        [renderer.chrome('Base Imponible:', 'TotalLabel'), 
+         renderer.paragraph(format_currency(subtotal_val), 'TotalValue')],
+        [renderer.paragraph(f'IVA ({iva_rate:.0f}%):'.replace('.', ','), 'TotalLabel'), 
+         renderer.paragraph(format_currency(iva_val), 'TotalValue')]
     ]
 
     if irpf_val and irpf_val > 0:
         totals_data.append([
-            Paragraph(f'Retención IRPF ({irpf_rate:.0f}%):'.replace('.', ','), styles['IRPFText']), 
-            Paragraph(f"-{format_currency(irpf_val)}", styles['IRPFValue'])
+            renderer.paragraph(f'Retención IRPF ({irpf_rate:.0f}%):'.replace('.', ','), 'IRPFText'), 
+            renderer.paragraph(f"-{format_currency(irpf_val)}", 'IRPFValue')
         ])
 
     # Separador antes del total
-    totals_data.append([Paragraph('', styles['TotalLabel']), Paragraph('', styles['TotalValue'])])
+    totals_data.append([renderer.paragraph('', 'TotalLabel'), renderer.paragraph('', 'TotalValue')])
     
     totals_data.append([
-        Paragraph('TOTAL A PAGAR:', styles['GrandTotalLabel']), 
-        Paragraph(format_currency(total_val), styles['GrandTotalValue'])
+        renderer.chrome('TOTAL A PAGAR:', 'GrandTotalLabel'), 
+        renderer.paragraph(format_currency(total_val), 'GrandTotalValue')
     ])
 
     # Crear tabla de totales con fondo
     totals_table = Table(totals_data, colWidths=[4.5*cm, 3*cm])
-    totals_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -1), SECONDARY_COLOR),
-        ('LEFTPADDING', (0, 0), (-1, -1), 12),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 12),
-        ('TOPPADDING', (0, 0), (-1, -1), 6),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
-        ('LINEABOVE', (0, -1), (-1, -1), 2, PRIMARY_COLOR),
-        ('TOPPADDING', (0, -1), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, -1), (-1, -1), 10),
-    ]))
+    totals_table.setStyle(renderer.table_styles['totals'])
 
     # Alinear tabla de totales a la derecha
     totals_container = Table([[None, totals_table]], 
                            colWidths=[current_page_width - 6.5*cm, 6.5*cm])
-    totals_container.setStyle(TableStyle([
-        ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
-        ('VALIGN', (1, 0), (1, 0), 'TOP'),
-    ]))
+    totals_container.setStyle(renderer.table_styles['totals_container'])
     
     story.append(totals_container)
     story.append(Spacer(1, 1*cm))
@@ -549,7 +826,7 @@ def generate_invoice_pdf(invoice_id):
     # 6. Sección de pago y notas en columnas
     # Datos de pago (izquierda)
     payment_block = []
-    payment_block.append(Paragraph("DATOS DE PAGO:", styles['PaymentTitle']))
+    payment_block.append(renderer.chrome("DATOS DE PAGO:", 'PaymentTitle'))
     
     payment_info = []
     if hasattr(emisor, 'banco') and emisor.banco:
@@ -567,11 +844,11 @@ def generate_invoice_pdf(invoice_id):
     if hasattr(emisor, 'swift') and emisor.swift:
         payment_info.append(f"SWIFT/BIC: {emisor.swift}")
 
-    payment_block.append(Paragraph("<br/>".join(payment_info), styles['PaymentDetails']))
+    payment_block.append(renderer.chrome("<br/>".join(payment_info), 'PaymentDetails'))
 
     # Notas (derecha)
     notes_block = []
-    notes_block.append(Paragraph("NOTAS:", styles['NotesTitle']))
+    notes_block.append(renderer.chrome("NOTAS:", 'NotesTitle'))
     notas_text = "Forma de pago: Transferencia bancaria.<br/>Gracias por su negocio."
     
     if hasattr(invoice, 'notas') and invoice.notas:
@@ -579,25 +856,19 @@ def generate_invoice_pdf(invoice_id):
     elif settings and hasattr(settings, 'notas_factura') and settings.notas_factura:
         notas_text = settings.notas_factura
     
-    notes_block.append(Paragraph(notas_text, styles['NotesText']))
+    notes_block.append(renderer.paragraph(notas_text, 'NotesText'))
 
     # Tabla con pago y notas lado a lado
     payment_notes_data = [[payment_block, notes_block]]
     payment_notes_table = Table(payment_notes_data, colWidths=[current_page_width * 0.5, current_page_width * 0.5])
-    payment_notes_table.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('LEFTPADDING', (0,0), (0,0), 0),
-        ('RIGHTPADDING', (1,0), (1,0), 0),
-        ('TOPPADDING', (0,0), (-1,0), 0),
-        ('BOTTOMPADDING', (0,0), (-1,0), 0),
-    ]))
+    payment_notes_table.setStyle(renderer.table_styles['payment_notes'])
     story.append(payment_notes_table)
 
     # 8. Construir el PDF
     try:
         logger_func.info(f"Construyendo PDF para factura ID {invoice_id}...")
-        doc.build(story, onFirstPage=lambda c, d: _draw_footer(c, d, settings),
-                         onLaterPages=lambda c, d: _draw_footer(c, d, settings))
+        doc.build(story, onFirstPage=lambda c, d: _draw_footer(c, d, settings, renderer),
+                         onLaterPages=lambda c, d: _draw_footer(c, d, settings, renderer))
         buffer.seek(0)
         logger_func.info(f"PDF generado exitosamente para factura {invoice_id}")
         return buffer
@@ -605,7 +876,79 @@ def generate_invoice_pdf(invoice_id):
         logger_func.error(f"Error construyendo PDF para factura {invoice_id}: {e_build}")
         return None
 
-def _draw_footer(canvas, doc, system_settings):
+
+# --- Render en paralelo (fuera de la transacción de generación) ---
+_INVOICE_SNAPSHOT_FIELDS = ('id', 'numero_factura', 'numero_factura_mostrado_al_cliente', 'fecha_emision', 'items',
+                            'subtotal', 'iva', 'irpf', 'total', 'notas')
+_PARTY_SNAPSHOT_FIELDS = ('id', 'nombre', 'nif', 'direccion', 'codigo_postal', 'ciudad', 'telefono',
+                          'cuenta_bancaria', 'banco', 'iban', 'swift')
+_PROPERTY_SNAPSHOT_FIELDS = ('id', 'direccion', 'referencia_catastral', 'descripcion')
+_SETTINGS_SNAPSHOT_FIELDS = ('notas_factura', 'pie_factura', 'company_logo_filename')
+
+def _snapshot(obj, fields):
+    return SimpleNamespace(**{name: getattr(obj, name, None) for name in fields}) if obj is not None else None
+
+def snapshot_invoice_for_render(invoice, settings=None):
+    """
+    Copia en objetos planos (serializables con pickle) todo lo que necesita _build_invoice_pdf,
+    para poder renderizar en otro proceso sin sesión de BD ni contexto Flask.
+    """
+    propiedad = invoice.propiedad_ref
+    contrato = getattr(invoice, 'contrato_ref', None)
+    snap = _snapshot(invoice, _INVOICE_SNAPSHOT_FIELDS)
+    snap.contrato_ref = SimpleNamespace(numero_contrato=contrato.numero_contrato) if contrato else None
+    settings_snap = _snapshot(settings, _SETTINGS_SNAPSHOT_FIELDS)
+    if settings_snap is not None:
+        settings_snap.logo_path = resolve_company_logo_path(settings) # Los procesos del pool no tienen current_app
+    return SimpleNamespace(
+        invoice=snap,
+        inquilino=_snapshot(invoice.inquilino_ref, _PARTY_SNAPSHOT_FIELDS),
+        propiedad=_snapshot(propiedad, _PROPERTY_SNAPSHOT_FIELDS),
+        emisor=_snapshot(propiedad.propietario_ref if propiedad else None, _PARTY_SNAPSHOT_FIELDS),
+        settings=settings_snap,
+    )
+
+def render_invoice_pdf_to_file(snapshot, output_path):
+    """
+    Renderiza un snapshot y lo escribe en output_path.
+    Se ejecuta en los procesos del pool: no usa BD ni contexto Flask.
+
+    Returns:
+        tuple: (invoice_id, None) si todo fue bien, (invoice_id, mensaje_error) si falló.
+    """
+    invoice_id = snapshot.invoice.id
+    try:
+        pdf_buffer = _build_invoice_pdf(snapshot.invoice, snapshot.inquilino, snapshot.propiedad,
+                                        snapshot.emisor, snapshot.settings, logger_func=logging.getLogger(__name__))
+        if pdf_buffer is None:
+            return invoice_id, "el generador PDF no devolvió contenido"
+        with open(output_path, 'wb') as f_pdf:
+            f_pdf.write(pdf_buffer.getbuffer())
+        return invoice_id, None
+    except Exception as e_render:
+        return invoice_id, str(e_render)
+
+def render_invoice_pdfs_parallel(jobs, max_workers=None):
+    """
+    Renderiza una lista de (snapshot, output_path) usando un pool de procesos
+    (por defecto uno por CPU). Los fallos se devuelven por factura, nunca se propagan.
+
+    Returns:
+        list[tuple]: (invoice_id, error_o_None) por cada trabajo.
+    """
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+    if workers > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                return list(pool.map(render_invoice_pdf_to_file, *zip(*jobs)))
+        except (OSError, NotImplementedError, BrokenProcessPool) as e_pool:
+            _get_logger().warning(f"Pool de procesos PDF no disponible ({e_pool}). Renderizando en serie.")
+    return [render_invoice_pdf_to_file(snapshot, output_path) for snapshot, output_path in jobs]
+
+def _draw_footer(canvas, doc, system_settings, renderer=None):
     """Dibuja el pie de página con diseño mejorado"""
     canvas.saveState()
     
@@ -619,7 +962,9 @@ def _draw_footer(canvas, doc, system_settings):
     if system_settings and hasattr(system_settings, 'pie_factura') and system_settings.pie_factura:
         footer_text = system_settings.pie_factura
     
-    p = Paragraph(footer_text, styles['FooterStyle'])
+    # Igual en todas las páginas y facturas; desde la segunda página, un form XObject que reutilizan las siguientes
+    # (en una factura de una sola página el form solo añadiría un objeto más al PDF)
+    p = (renderer or get_invoice_renderer()).chrome(footer_text, 'FooterStyle', as_form=canvas.getPageNumber() > 1)
     w, h = p.wrapOn(canvas, doc.width, doc.bottomMargin)
     p.drawOn(canvas, doc.leftMargin, 1.2*cm)
     
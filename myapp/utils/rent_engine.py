@@ -0,0 +1,373 @@
+# myapp/utils/rent_engine.py
+"""
+Motor de cálculo de rentas (actualizaciones por IPC/IRAV, importe fijo e índices pendientes).
+
+Trabaja sobre una instantánea inmutable del contrato (ContractSnapshot) y una tabla de índices en
+memoria (IndexLookup); no lee la sesión ni `g` y no modifica objetos del ORM. El resultado
+(RentCalculation) describe los cambios que el llamador debe aplicar al contrato. Así lo pueden usar
+la generación de facturas, la vista previa, las previsiones y las pruebas, también desde otros
+procesos (instantánea e índices se pueden serializar con pickle).
+"""
+from dataclasses import dataclass, field, fields, replace
+from datetime import date
+from decimal import Decimal, ROUND_HALF_UP
+from types import SimpleNamespace
+from typing import Optional
+
+from ..models import db, IPCData, IRAVData
+from .calc_trace import CalcTrace
+
+TWO_PLACES = Decimal('0.01')
+MESES_STR = ["", "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
+
+# Campos del contrato que el cálculo puede cambiar (índice pendiente de publicar)
+PENDING_INDEX_FIELDS = (
+    'renta_base_pre_actualizacion_pendiente', 'indice_pendiente_mes', 'indice_pendiente_ano', 'indice_pendiente_tipo',
+    'indice_pendiente_mes_original_aplicacion', 'indice_pendiente_ano_original_aplicacion',
+)
+
+
+@dataclass(frozen=True, slots=True)
+class ContractSnapshot:
+    """Copia inmutable de las columnas de un Contrato que usan el cálculo de renta y la numeración de facturas."""
+    id: int
+    numero_contrato: str
+    fecha_inicio: date
+    precio_mensual: Decimal
+    dia_pago: Optional[int] = 1
+    inquilino_id: Optional[int] = None
+    propiedad_id: Optional[int] = None
+    aplicar_iva: bool = True
+    aplicar_irpf: bool = True
+    tipo_actualizacion_renta: str = 'indice'
+    actualiza_ipc: bool = False
+    actualiza_irav: bool = False
+    ipc_ano_inicio: Optional[int] = None
+    ipc_mes_inicio: Optional[int] = None
+    importe_actualizacion_fija: Optional[Decimal] = None
+    mes_aplicacion_fija: Optional[int] = None
+    aplicar_indice_retroactivo: bool = False
+    renta_base_pre_actualizacion_pendiente: Optional[Decimal] = None
+    indice_pendiente_mes: Optional[int] = None
+    indice_pendiente_ano: Optional[int] = None
+    indice_pendiente_tipo: Optional[str] = None
+    indice_pendiente_mes_original_aplicacion: Optional[int] = None
+    indice_pendiente_ano_original_aplicacion: Optional[int] = None
+    serie_facturacion_prefijo: Optional[str] = None
+    serie_facturacion_ultimo_numero: Optional[int] = 0
+    serie_facturacion_ano_actual: Optional[int] = None
+    serie_facturacion_formato_digitos: Optional[int] = 4
+
+    @classmethod
+    def from_contract(cls, contrato):
+        """Instantánea de un Contrato (o de cualquier objeto con esos atributos)."""
+        return cls(**{f.name: getattr(contrato, f.name) for f in fields(cls)})
+
+    def with_changes(self, **changes):
+        """Nueva instantánea con los cambios aplicados (p. ej. RentCalculation.changes)."""
+        return replace(self, **changes) if changes else self
+
+
+@dataclass(slots=True)
+class RentCalculation:
+    """Resultado de calculate_rent."""
+    renta_linea_principal: Decimal          # Importe de la línea "Alquiler <mes>"
+    conceptos_adicionales: list             # Líneas de actualización/atrasos (formato items_json)
+    nueva_renta: Optional[Decimal]          # Nueva renta base del contrato; None si no cambia
+    avisos: list                            # Advertencias para el usuario (índice pendiente, sin publicar...)
+    indice_aplicado: Optional[dict]         # {'type', 'month', 'year', 'percentage'} para Factura.indice_aplicado_info
+    changes: dict = field(default_factory=dict)  # Campos de PENDING_INDEX_FIELDS que cambian
+
+
+class IndexLookup:
+    """
+    Series IPC/IRAV precargadas en memoria para una ejecución de generación.
+    Evita una consulta por contrato: se leen ambas tablas una sola vez y se
+    consultan por (tipo, año, mes). Lleva la cuenta de aciertos y fallos.
+    """
+
+    MODELS = {'IPC': IPCData, 'IRAV': IRAVData}
+
+    def __init__(self, values=None):
+        self.values = values or {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls):
+        """Carga IPCData e IRAVData completas (una consulta por tabla)."""
+        values = {}
+        for index_type, model in cls.MODELS.items():
+            for year, month, pct in db.session.query(model.year, model.month, model.percentage_change).all():
+                values[(index_type, year, month)] = pct
+        return cls(values)
+
+    def get(self, index_type, year, month):
+        """Devuelve el porcentaje del índice o None si aún no está publicado."""
+        value = self.values.get((index_type, year, month))
+        if value is None: self.misses += 1
+        else: self.hits += 1
+        return value
+
+    def stats(self):
+        return {'index_cache_hits': self.hits, 'index_cache_misses': self.misses}
+
+
+def calculate_rent(contract: ContractSnapshot, target_year: int, target_month: int, current_base_rent: Decimal,
+                   index_lookup: IndexLookup, allow_missing_index: bool = False,
+                   trace: Optional[CalcTrace] = None) -> RentCalculation:
+    """
+    Renta a facturar en target_month/target_year y cambios de estado del contrato.
+    Función pura: no lee la base de datos ni g, y no modifica `contract`; los cambios de índice
+    pendiente se devuelven en RentCalculation.changes.
+
+    allow_missing_index: SystemSettings.generate_invoice_if_index_missing (facturar sin el
+    incremento si el índice periódico no está publicado y el contrato no es retroactivo).
+    Lanza ValueError si falta el índice y no se permite ninguna de las dos alternativas.
+    trace: solo con INVOICE_TRACE_LEVEL='full'; recibe los pasos del cálculo como datos estructurados.
+    """
+    pend = SimpleNamespace(**{campo: getattr(contract, campo) for campo in PENDING_INDEX_FIELDS}) # Estado de trabajo
+    avisos = []
+    conceptos_adicionales = []
+    info_indice_aplicado_para_factura = None 
+    
+    renta_para_linea_principal_alquiler = current_base_rent
+    nueva_renta_contrato_a_persistir_calculada = current_base_rent 
+    indice_pendiente_valor_raw = None 
+    incremento_del_fijo_pendiente_una_vez = Decimal('0.00')
+
+    # --- 1. MANEJO DE ÍNDICES PENDIENTES (SI `aplicar_indice_retroactivo` ES TRUE) ---
+    if contract.aplicar_indice_retroactivo and \
+       pend.indice_pendiente_mes and pend.indice_pendiente_ano and pend.indice_pendiente_tipo and \
+       pend.renta_base_pre_actualizacion_pendiente is not None:
+
+        if trace is not None: trace.add('pendiente_intento', tipo=pend.indice_pendiente_tipo, mes=pend.indice_pendiente_mes, ano=pend.indice_pendiente_ano, base=pend.renta_base_pre_actualizacion_pendiente)
+        if pend.indice_pendiente_tipo in IndexLookup.MODELS:
+            indice_pendiente_valor_raw = index_lookup.get(pend.indice_pendiente_tipo, pend.indice_pendiente_ano, pend.indice_pendiente_mes)
+            if indice_pendiente_valor_raw is not None:
+                avisos.append(f"Se aplica el índice pendiente {pend.indice_pendiente_tipo} ({pend.indice_pendiente_mes}/{pend.indice_pendiente_ano}): {indice_pendiente_valor_raw}%.")
+                if trace is not None: trace.add('pendiente_resuelto', tipo=pend.indice_pendiente_tipo, mes=pend.indice_pendiente_mes, ano=pend.indice_pendiente_ano, porcentaje=indice_pendiente_valor_raw)
+                renta_base_del_periodo_pendiente = pend.renta_base_pre_actualizacion_pendiente
+                pct_pendiente = (Decimal(str(indice_pendiente_valor_raw)) / Decimal('100')).quantize(Decimal('0.000001'), rounding=ROUND_HALF_UP)
+                incremento_del_indice_pendiente_mensual = (renta_base_del_periodo_pendiente * pct_pendiente).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+                incremento_del_fijo_pendiente_una_vez = Decimal('0.00')
+                
+                info_indice_aplicado_para_factura = {
+                    'type': pend.indice_pendiente_tipo,
+                    'month': pend.indice_pendiente_mes,
+                    'year': pend.indice_pendiente_ano, # Año del índice
+                    'percentage': float(indice_pendiente_valor_raw)
+                }
+
+                if incremento_del_indice_pendiente_mensual != Decimal('0.00'):
+                    conceptos_adicionales.append({
+                        "description": f"Aplic. Act. Pendiente ({pend.indice_pendiente_mes}/{pend.indice_pendiente_ano}): {pend.indice_pendiente_tipo} s/ {renta_base_del_periodo_pendiente:.2f}",
+                        "quantity": 1, "unitPrice": float(incremento_del_indice_pendiente_mensual), "total": float(incremento_del_indice_pendiente_mensual)
+                    })
+                    if trace is not None: trace.add('concepto_indice_pendiente', importe=incremento_del_indice_pendiente_mensual)
+
+                if contract.tipo_actualizacion_renta == 'indice_mas_fijo' and contract.importe_actualizacion_fija is not None:
+                    incremento_del_fijo_pendiente_una_vez = contract.importe_actualizacion_fija.quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+                    if incremento_del_fijo_pendiente_una_vez != Decimal('0.00'):
+                        conceptos_adicionales.append({
+                            "description": f"Aplic. Act. Fija Pendiente ({contract.importe_actualizacion_fija:.2f})",
+                            "quantity": 1, "unitPrice": float(incremento_del_fijo_pendiente_una_vez), "total": float(incremento_del_fijo_pendiente_una_vez)
+                        })
+                        if trace is not None: trace.add('concepto_fijo_pendiente', importe=incremento_del_fijo_pendiente_una_vez)
+                
+                nueva_renta_contrato_a_persistir_calculada = (renta_base_del_periodo_pendiente + incremento_del_indice_pendiente_mensual + incremento_del_fijo_pendiente_una_vez).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+                renta_para_linea_principal_alquiler = renta_base_del_periodo_pendiente
+                if trace is not None: trace.add('base_tras_pendiente', nueva_base=nueva_renta_contrato_a_persistir_calculada, renta_linea=renta_para_linea_principal_alquiler)
+
+                if pend.indice_pendiente_ano_original_aplicacion and pend.indice_pendiente_mes_original_aplicacion:
+                    fecha_inicio_efectiva_actualizacion = date(pend.indice_pendiente_ano_original_aplicacion, pend.indice_pendiente_mes_original_aplicacion, 1)
+                    fecha_factura_actual_obj = date(target_year, target_month, 1)
+                    meses_atraso = 0
+                    temp_date_atraso = fecha_inicio_efectiva_actualizacion
+                    while temp_date_atraso < fecha_factura_actual_obj:
+                        meses_atraso += 1
+                        m_temp, y_temp = (temp_date_atraso.month + 1, temp_date_atraso.year) if temp_date_atraso.month < 12 else (1, temp_date_atraso.year + 1)
+                        temp_date_atraso = date(y_temp, m_temp, 1)
+
+                    if meses_atraso > 0 and incremento_del_indice_pendiente_mensual != Decimal('0.00'):
+                        total_atrasos_indice = (incremento_del_indice_pendiente_mensual * meses_atraso).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+                        conceptos_adicionales.append({
+                            "description": f"Atrasos act. {pend.indice_pendiente_tipo} ({incremento_del_indice_pendiente_mensual:.2f}/mes) - {meses_atraso} mes(es)",
+                            "quantity": 1, "unitPrice": float(total_atrasos_indice), "total": float(total_atrasos_indice)
+                        })
+                        if trace is not None: trace.add('atrasos', meses=meses_atraso, total=total_atrasos_indice)
+                else:
+                    avisos.append("ADVERTENCIA: No se pudieron calcular atrasos (faltan fechas originales de aplic. del índice pendiente).")
+
+                pend.indice_pendiente_mes = None; pend.indice_pendiente_ano = None; pend.indice_pendiente_tipo = None
+                pend.renta_base_pre_actualizacion_pendiente = None
+                pend.indice_pendiente_mes_original_aplicacion = None; pend.indice_pendiente_ano_original_aplicacion = None
+            else: # El índice pendiente SIGUE sin estar disponible
+                renta_para_linea_principal_alquiler = pend.renta_base_pre_actualizacion_pendiente 
+                nueva_renta_contrato_a_persistir_calculada = pend.renta_base_pre_actualizacion_pendiente
+                avisos.append(f"Índice {pend.indice_pendiente_tipo} ({pend.indice_pendiente_mes}/{pend.indice_pendiente_ano}) PENDIENTE y AÚN NO disponible. Facturando con renta guardada: {renta_para_linea_principal_alquiler}.")
+        else: # Tipo de índice pendiente desconocido
+            avisos.append(f"ADVERTENCIA: Tipo de índice pendiente '{pend.indice_pendiente_tipo}' no reconocido. No se puede resolver pendiente.")
+            if pend.renta_base_pre_actualizacion_pendiente is not None:
+                 renta_para_linea_principal_alquiler = pend.renta_base_pre_actualizacion_pendiente
+                 nueva_renta_contrato_a_persistir_calculada = pend.renta_base_pre_actualizacion_pendiente
+    
+    # --- 2. LÓGICA DE ACTUALIZACIÓN PERIÓDICA (ANUAL, etc., para ESTE mes) ---
+    renta_base_para_actualizacion_periodica = nueva_renta_contrato_a_persistir_calculada
+    
+    es_mes_aniversario_contrato = (target_month == contract.fecha_inicio.month)
+    
+    # Condición final para aplicar actualización periódica de índice:
+    # 1. Es el mes de aniversario del contrato.
+    # 2. Ha pasado al menos un año desde el inicio del contrato (target_year > inicio.year O (mismo año Y target_month > inicio.month))
+    # 3. El año de la factura actual (target_year) es igual o mayor que el año de inicio de IPC configurado en el contrato.
+    debe_intentar_actualizacion_periodica_indice = \
+        es_mes_aniversario_contrato and \
+        (target_year > contract.fecha_inicio.year or \
+         (target_year == contract.fecha_inicio.year and target_month > contract.fecha_inicio.month)) and \
+        (contract.ipc_ano_inicio is not None and target_year >= contract.ipc_ano_inicio)
+
+    if trace is not None:
+        trace.add('chequeo_periodico', mes_aniversario=es_mes_aniversario_contrato, ipc_ano_inicio=contract.ipc_ano_inicio,
+                  aplica=debe_intentar_actualizacion_periodica_indice)
+
+    incremento_indice_periodico_este_mes = Decimal('0.00')
+    incremento_fijo_periodico_este_mes = Decimal('0.00')
+    descripcion_indice_periodico_este_mes = ""
+
+    # Solo procesar actualización periódica si NO hay un índice pendiente activo
+    if not (pend.indice_pendiente_mes and pend.indice_pendiente_ano): 
+        if debe_intentar_actualizacion_periodica_indice:
+            # A. Actualización Periódica por ÍNDICE
+            if contract.tipo_actualizacion_renta in ['indice', 'indice_mas_fijo'] and \
+               (contract.actualiza_ipc or contract.actualiza_irav) and \
+               contract.ipc_mes_inicio: # Ya no necesitamos contract.ipc_ano_inicio aquí porque se usó arriba
+                
+                index_name_periodico = "IPC" if contract.actualiza_ipc else "IRAV"
+                mes_indice_referencia_contrato = contract.ipc_mes_inicio 
+                
+                # Corrección Lógica del Año del Índice a Consultar
+                ano_indice_a_consultar = target_year
+                if mes_indice_referencia_contrato > target_month:
+                    ano_indice_a_consultar = target_year - 1
+                elif mes_indice_referencia_contrato == target_month: # Si el índice es del mismo mes que la factura, se usa el del año anterior
+                    ano_indice_a_consultar = target_year - 1
+                
+                if trace is not None: trace.add('indice_referencia', tipo=index_name_periodico, mes=mes_indice_referencia_contrato, ano=ano_indice_a_consultar)
+
+                if not (1 <= mes_indice_referencia_contrato <= 12):
+                    if trace is not None: trace.add('mes_referencia_invalido', mes=mes_indice_referencia_contrato)
+                else:
+                    indice_periodico_valor_raw = index_lookup.get(index_name_periodico, ano_indice_a_consultar, mes_indice_referencia_contrato)
+
+                    if indice_periodico_valor_raw is not None:
+                        pct_periodico = (Decimal(str(indice_periodico_valor_raw)) / Decimal('100')).quantize(Decimal('0.000001'), rounding=ROUND_HALF_UP)
+                        incremento_indice_periodico_este_mes = (renta_base_para_actualizacion_periodica * pct_periodico).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+                        descripcion_indice_periodico_este_mes = f"Actualización {index_name_periodico} ({mes_indice_referencia_contrato}/{ano_indice_a_consultar})"
+                        if trace is not None:
+                            trace.add('actualizacion_indice', tipo=index_name_periodico, mes=mes_indice_referencia_contrato, ano=ano_indice_a_consultar,
+                                      porcentaje=indice_periodico_valor_raw, base=renta_base_para_actualizacion_periodica, incremento=incremento_indice_periodico_este_mes)
+                        
+                        if info_indice_aplicado_para_factura is None: # Solo si no se resolvió uno pendiente antes
+                            info_indice_aplicado_para_factura = {
+                                'type': index_name_periodico,
+                                'month': mes_indice_referencia_contrato,
+                                'year': ano_indice_a_consultar, 
+                                'percentage': float(indice_periodico_valor_raw)
+                            }
+                    else: 
+                        if contract.aplicar_indice_retroactivo:
+                            if not (pend.indice_pendiente_tipo and pend.indice_pendiente_mes and pend.indice_pendiente_ano):
+                                pend.renta_base_pre_actualizacion_pendiente = renta_base_para_actualizacion_periodica
+                                pend.indice_pendiente_mes = mes_indice_referencia_contrato 
+                                pend.indice_pendiente_ano = ano_indice_a_consultar       
+                                pend.indice_pendiente_tipo = index_name_periodico
+                                pend.indice_pendiente_mes_original_aplicacion = target_month 
+                                pend.indice_pendiente_ano_original_aplicacion = target_year  
+                                avisos.append(f"ACT. PERIÓDICA ÍNDICE: {index_name_periodico} ({mes_indice_referencia_contrato}/{ano_indice_a_consultar}) NO disponible. MARCADO COMO PENDIENTE.")
+                            else:
+                                avisos.append(f"ACT. PERIÓDICA ÍNDICE: {index_name_periodico} ({mes_indice_referencia_contrato}/{ano_indice_a_consultar}) NO disponible, pero YA EXISTE OTRO ÍNDICE PENDIENTE.")
+                        
+                        elif allow_missing_index:
+                            avisos.append(f"ADVERTENCIA (ACT. PERIÓDICA): {index_name_periodico} ({mes_indice_referencia_contrato}/{ano_indice_a_consultar}) no encontrado. Factura sin este incremento (config lo permite).")
+                        else: 
+                            raise ValueError(f"Índice periódico {index_name_periodico} ({mes_indice_referencia_contrato}/{ano_indice_a_consultar}) no encontrado y config no permite generar factura ni aplicar retroactivamente.")
+            
+            # B. Actualización Periódica por IMPORTE FIJO
+            es_aniversario_real_posterior_al_inicio_para_fijo = (target_month == contract.fecha_inicio.month) and \
+                                                               (target_year > contract.fecha_inicio.year or \
+                                                               (target_year == contract.fecha_inicio.year and target_month > contract.fecha_inicio.month))
+            
+            es_mes_aplicacion_fija_valida = (es_aniversario_real_posterior_al_inicio_para_fijo or \
+                                     (contract.mes_aplicacion_fija is not None and \
+                                      target_month == contract.mes_aplicacion_fija and \
+                                      (target_year > contract.fecha_inicio.year or \
+                                       (target_year == contract.fecha_inicio.year and target_month >= contract.fecha_inicio.month))
+                                     )
+                                    )
+
+            if contract.tipo_actualizacion_renta in ['fijo', 'indice_mas_fijo'] and \
+               contract.importe_actualizacion_fija is not None and es_mes_aplicacion_fija_valida:
+                
+                aplicar_fijo_periodico_ahora = not (contract.tipo_actualizacion_renta == 'indice_mas_fijo' and contract.aplicar_indice_retroactivo and indice_pendiente_valor_raw is not None and incremento_del_fijo_pendiente_una_vez != Decimal('0.00'))
+                
+                if aplicar_fijo_periodico_ahora:
+                    incremento_fijo_periodico_este_mes = contract.importe_actualizacion_fija.quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+                    if trace is not None: trace.add('actualizacion_fija', incremento=incremento_fijo_periodico_este_mes, base=renta_base_para_actualizacion_periodica)
+
+    # --- Añadir conceptos de actualización periódica de ESTE MES (si los hubo y no hay pendiente activo) ---
+    if not (pend.indice_pendiente_mes and pend.indice_pendiente_ano and \
+            pend.renta_base_pre_actualizacion_pendiente == renta_base_para_actualizacion_periodica and \
+            pend.indice_pendiente_mes_original_aplicacion == target_month and \
+            pend.indice_pendiente_ano_original_aplicacion == target_year): 
+
+        if incremento_indice_periodico_este_mes != Decimal('0.00'):
+            conceptos_adicionales.append({
+                "description": descripcion_indice_periodico_este_mes,
+                "quantity": 1, "unitPrice": float(incremento_indice_periodico_este_mes), "total": float(incremento_indice_periodico_este_mes)
+            })
+            nueva_renta_contrato_a_persistir_calculada = (nueva_renta_contrato_a_persistir_calculada + incremento_indice_periodico_este_mes).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+
+        if incremento_fijo_periodico_este_mes != Decimal('0.00'):
+            conceptos_adicionales.append({
+                "description": f"Actualización Renta Importe Fijo ({MESES_STR[target_month]}/{target_year})",
+                "quantity": 1, "unitPrice": float(incremento_fijo_periodico_este_mes), "total": float(incremento_fijo_periodico_este_mes)
+            })
+            nueva_renta_contrato_a_persistir_calculada = (nueva_renta_contrato_a_persistir_calculada + incremento_fijo_periodico_este_mes).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+
+    # Determinar si la renta del contrato realmente cambió para persistir
+    nueva_renta_contrato_a_persistir_final = None
+    if nueva_renta_contrato_a_persistir_calculada.compare(current_base_rent) != Decimal('0'):
+        nueva_renta_contrato_a_persistir_final = nueva_renta_contrato_a_persistir_calculada
+    
+    # Caso especial: Si se marcó un índice como pendiente EN ESTE CICLO
+    if contract.aplicar_indice_retroactivo and \
+       pend.indice_pendiente_mes and pend.indice_pendiente_ano and \
+       pend.renta_base_pre_actualizacion_pendiente is not None and \
+       pend.indice_pendiente_mes_original_aplicacion == target_month and \
+       pend.indice_pendiente_ano_original_aplicacion == target_year:
+        renta_para_linea_principal_alquiler = pend.renta_base_pre_actualizacion_pendiente
+        if nueva_renta_contrato_a_persistir_final is not None and \
+           nueva_renta_contrato_a_persistir_final.compare(pend.renta_base_pre_actualizacion_pendiente) != Decimal('0') and \
+           (incremento_indice_periodico_este_mes != Decimal('0.00') or incremento_fijo_periodico_este_mes != Decimal('0.00')):
+             if indice_pendiente_valor_raw is None:
+                 # Si el cambio en nueva_renta_contrato_a_persistir_final se debió SOLO a la actualización periódica
+                 # que AHORA está pendiente, entonces la renta del contrato NO debe cambiar.
+                 # Se revierte a la renta base original si esa era la renta antes de este intento de actualización periódica.
+                 if current_base_rent.compare(pend.renta_base_pre_actualizacion_pendiente) == Decimal('0'):
+                     nueva_renta_contrato_a_persistir_final = None # No cambiar la renta del contrato
+                 else: # Esto es un caso raro, la renta ya había cambiado por un pendiente anterior resuelto
+                     nueva_renta_contrato_a_persistir_final = pend.renta_base_pre_actualizacion_pendiente
+
+
+    if trace is not None:
+        trace.add('resultado', renta_linea=renta_para_linea_principal_alquiler, conceptos=len(conceptos_adicionales),
+                  nueva_renta=nueva_renta_contrato_a_persistir_final, indice=info_indice_aplicado_para_factura, avisos=avisos)
+    return RentCalculation(
+        renta_linea_principal=renta_para_linea_principal_alquiler,
+        conceptos_adicionales=conceptos_adicionales,
+        nueva_renta=nueva_renta_contrato_a_persistir_final,
+        avisos=avisos,
+        indice_aplicado=info_indice_aplicado_para_factura,
+        changes={campo: getattr(pend, campo) for campo in PENDING_INDEX_FIELDS if getattr(pend, campo) != getattr(contract, campo)},
+    )
@@ -0,0 +1,222 @@
+# myapp/utils/rent_forecast.py
+"""
+Previsión de rentas de la cartera: renta mensual proyectada e IVA/IRPF para los próximos años.
+
+Reproduce la actualización anual de calculate_rent (rent_engine.py) en el mes aniversario del
+contrato: índice IPC/IRAV del mes de referencia, importe fijo o ambos. Los índices publicados se
+toman de IPCData/IRAVData; los futuros, del escenario (porcentaje anual supuesto por índice). Es una
+estimación: no modela índices pendientes ni atrasos, y redondea cada incremento a céntimos con floats.
+
+Con NumPy el cálculo es vectorial sobre todos los contratos (un paso por mes); sin NumPy se usa
+el mismo algoritmo en Python puro, bastante más lento con miles de contratos.
+"""
+import math
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Optional
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+from ..models import db, Contrato, Propiedad
+from .rent_engine import IndexLookup
+
+INDEX_TYPES = ('IPC', 'IRAV')
+TIPOS_CON_INDICE = ('indice', 'indice_mas_fijo')
+TIPOS_CON_FIJO = ('fijo', 'indice_mas_fijo')
+
+FORECAST_COLUMNS = (
+    Contrato.id, Contrato.precio_mensual, Contrato.fecha_inicio, Contrato.fecha_fin, Contrato.tipo_actualizacion_renta,
+    Contrato.actualiza_ipc, Contrato.actualiza_irav, Contrato.ipc_ano_inicio, Contrato.ipc_mes_inicio,
+    Contrato.importe_actualizacion_fija, Contrato.aplicar_iva, Contrato.aplicar_irpf,
+)
+
+
+@dataclass(slots=True)
+class ForecastContract:
+    """Columnas de un Contrato que usa la previsión (una fila de FORECAST_COLUMNS)."""
+    id: int
+    precio_mensual: object
+    fecha_inicio: date
+    fecha_fin: Optional[date] = None
+    tipo_actualizacion_renta: str = 'indice'
+    actualiza_ipc: bool = False
+    actualiza_irav: bool = False
+    ipc_ano_inicio: Optional[int] = None
+    ipc_mes_inicio: Optional[int] = None
+    importe_actualizacion_fija: object = None
+    aplicar_iva: bool = True
+    aplicar_irpf: bool = True
+
+
+@dataclass(slots=True)
+class RentForecast:
+    """Resultado de project_rents: totales de la cartera por mes (listas alineadas con `months`)."""
+    months: list
+    rent: list
+    iva: list
+    irpf: list
+    total: list
+    contracts: int
+    engine: str
+    assumed_index: dict = field(default_factory=dict)
+
+    def by_year(self):
+        """Totales por año natural -> {año: {'rent', 'iva', 'irpf', 'total'}}."""
+        years = {}
+        for (year, _), *values in zip(self.months, self.rent, self.iva, self.irpf, self.total):
+            acumulado = years.setdefault(year, {'rent': 0.0, 'iva': 0.0, 'irpf': 0.0, 'total': 0.0})
+            for clave, valor in zip(('rent', 'iva', 'irpf', 'total'), values):
+                acumulado[clave] += valor
+        return {year: {clave: round(valor, 2) for clave, valor in totales.items()} for year, totales in years.items()}
+
+    def to_dict(self):
+        return {
+            'contracts': self.contracts, 'engine': self.engine, 'assumed_index': self.assumed_index,
+            'months': [{'year': y, 'month': m, 'rent': r, 'iva': i, 'irpf': p, 'total': t}
+                       for (y, m), r, i, p, t in zip(self.months, self.rent, self.iva, self.irpf, self.total)],
+            'years': [{'year': year, **totales} for year, totales in sorted(self.by_year().items())],
+        }
+
+
+def load_forecast_contracts(owner_ids=None):
+    """Contratos activos como ForecastContract (una sola consulta de columnas, sin objetos del ORM)."""
+    query = db.session.query(*FORECAST_COLUMNS).filter(Contrato.estado == 'activo')
+    if owner_ids is not None:
+        query = query.join(Propiedad, Contrato.propiedad_id == Propiedad.id).filter(Propiedad.propietario_id.in_(owner_ids))
+    return [ForecastContract(*fila) for fila in query.order_by(Contrato.id)]
+
+
+def default_assumed_index(index_lookup: IndexLookup):
+    """Escenario por defecto: para cada índice, el último porcentaje publicado (0 si no hay datos)."""
+    supuestos = {}
+    for index_type in INDEX_TYPES:
+        publicados = [(year, month) for (tipo, year, month) in index_lookup.values if tipo == index_type]
+        supuestos[index_type] = float(index_lookup.values[(index_type, *max(publicados))]) if publicados else 0.0
+    return supuestos
+
+
+def _assumed_pct(assumed_index, index_type, year):
+    """Porcentaje supuesto para un índice y año: número fijo o {año: porcentaje} (último año conocido en adelante)."""
+    supuesto = assumed_index.get(index_type, 0.0)
+    if isinstance(supuesto, dict):
+        if not supuesto: return 0.0
+        anos = [a for a in supuesto if int(a) <= year]
+        return float(supuesto[max(anos, key=int)] if anos else supuesto[min(supuesto, key=int)])
+    return float(supuesto)
+
+
+def _round2(valor):
+    """Redondeo a céntimos ROUND_HALF_UP (como Decimal en la facturación) para floats."""
+    return math.copysign(math.floor(abs(valor) * 100 + 0.5) / 100, valor)
+
+
+def project_rents(contracts, index_lookup: IndexLookup, from_year: int, from_month: int, months: int,
+                  assumed_index=None, iva_rate=0.0, irpf_rate=0.0, use_numpy=None):
+    """
+    Proyecta la renta de `contracts` durante `months` meses a partir de from_month/from_year.
+
+    assumed_index: {'IPC': pct, 'IRAV': pct} o {'IPC': {año: pct}, ...} para los meses de índice
+    aún no publicados; por defecto, el último valor publicado de cada índice.
+    use_numpy: None = NumPy si está instalado.
+    """
+    supuestos = default_assumed_index(index_lookup)
+    supuestos.update(assumed_index or {})
+    meses = []
+    year, month = from_year, from_month
+    for _ in range(months):
+        meses.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    usar_numpy = NUMPY_AVAILABLE if use_numpy is None else (use_numpy and NUMPY_AVAILABLE)
+    proyectar = _project_numpy if usar_numpy else _project_python
+    rent, iva, irpf = proyectar(contracts, index_lookup, meses, supuestos, float(iva_rate), float(irpf_rate))
+    return RentForecast(
+        months=meses, rent=[round(v, 2) for v in rent], iva=[round(v, 2) for v in iva], irpf=[round(v, 2) for v in irpf],
+        total=[round(r + i - p, 2) for r, i, p in zip(rent, iva, irpf)], contracts=len(contracts),
+        engine='numpy' if usar_numpy else 'python', assumed_index=supuestos,
+    )
+
+
+def _reference(contrato, year, month):
+    """(tipo de índice, año, mes) de la actualización de ese mes, o None si el contrato no actualiza por índice."""
+    if contrato.tipo_actualizacion_renta not in TIPOS_CON_INDICE or not (contrato.actualiza_ipc or contrato.actualiza_irav):
+        return None
+    mes_ref = contrato.ipc_mes_inicio
+    if not mes_ref or not 1 <= mes_ref <= 12:
+        return None
+    return ('IPC' if contrato.actualiza_ipc else 'IRAV', year - 1 if mes_ref >= month else year, mes_ref)
+
+
+def _index_pct(index_lookup, assumed_index, index_type, year, month):
+    publicado = index_lookup.values.get((index_type, year, month))
+    return float(publicado) if publicado is not None else _assumed_pct(assumed_index, index_type, year)
+
+
+def _project_python(contracts, index_lookup, meses, assumed_index, iva_rate, irpf_rate):
+    rent_tot, iva_tot, irpf_tot = [0.0] * len(meses), [0.0] * len(meses), [0.0] * len(meses)
+    for contrato in contracts:
+        renta = float(contrato.precio_mensual or 0)
+        fijo = float(contrato.importe_actualizacion_fija or 0) if contrato.tipo_actualizacion_renta in TIPOS_CON_FIJO else 0.0
+        inicio = contrato.fecha_inicio
+        for t, (year, month) in enumerate(meses):
+            if (year, month) < (inicio.year, inicio.month): continue
+            if contrato.fecha_fin is not None and (year, month) > (contrato.fecha_fin.year, contrato.fecha_fin.month): break
+            if month == inicio.month and year > inicio.year and contrato.ipc_ano_inicio is not None and year >= contrato.ipc_ano_inicio:
+                referencia = _reference(contrato, year, month)
+                incremento = _round2(renta * _index_pct(index_lookup, assumed_index, *referencia) / 100) if referencia else 0.0
+                renta = _round2(renta + incremento + fijo)
+            rent_tot[t] += renta
+            if contrato.aplicar_iva: iva_tot[t] += _round2(renta * iva_rate)
+            if contrato.aplicar_irpf: irpf_tot[t] += _round2(renta * irpf_rate)
+    return rent_tot, iva_tot, irpf_tot
+
+
+def _round2_np(valores):
+    return np.copysign(np.floor(np.abs(valores) * 100 + 0.5) / 100, valores)
+
+
+def _project_numpy(contracts, index_lookup, meses, assumed_index, iva_rate, irpf_rate):
+    n = len(contracts)
+    if n == 0:
+        return [0.0] * len(meses), [0.0] * len(meses), [0.0] * len(meses)
+    sin_fin = 10 ** 9
+    renta = np.array([float(c.precio_mensual or 0) for c in contracts])
+    inicio_ord = np.array([c.fecha_inicio.year * 12 + c.fecha_inicio.month - 1 for c in contracts])
+    fin_ord = np.array([c.fecha_fin.year * 12 + c.fecha_fin.month - 1 if c.fecha_fin else sin_fin for c in contracts])
+    inicio_ano = np.array([c.fecha_inicio.year for c in contracts])
+    inicio_mes = np.array([c.fecha_inicio.month for c in contracts])
+    ano_indice = np.array([c.ipc_ano_inicio if c.ipc_ano_inicio is not None else sin_fin for c in contracts])
+    fijo = np.array([float(c.importe_actualizacion_fija or 0) if c.tipo_actualizacion_renta in TIPOS_CON_FIJO else 0.0 for c in contracts])
+    con_indice = np.array([_reference(c, 2000, 1) is not None for c in contracts])
+    tipo_indice = np.array([INDEX_TYPES.index('IPC' if c.actualiza_ipc else 'IRAV') for c in contracts])
+    mes_ref = np.array([c.ipc_mes_inicio if c.ipc_mes_inicio and 1 <= c.ipc_mes_inicio <= 12 else 1 for c in contracts])
+    aplicar_iva = np.array([bool(c.aplicar_iva) for c in contracts])
+    aplicar_irpf = np.array([bool(c.aplicar_irpf) for c in contracts])
+
+    # Tabla de porcentajes [tipo, año, mes] con los índices publicados y, donde falten, los supuestos
+    primer_ano, ultimo_ano = meses[0][0] - 1, meses[-1][0]
+    tabla = np.empty((len(INDEX_TYPES), ultimo_ano - primer_ano + 1, 12))
+    for i, index_type in enumerate(INDEX_TYPES):
+        for a in range(primer_ano, ultimo_ano + 1):
+            for m in range(1, 13):
+                tabla[i, a - primer_ano, m - 1] = _index_pct(index_lookup, assumed_index, index_type, a, m)
+
+    rent_tot, iva_tot, irpf_tot = [], [], []
+    for year, month in meses:
+        t_ord = year * 12 + month - 1
+        activo = (inicio_ord <= t_ord) & (t_ord <= fin_ord)
+        actualiza = activo & (inicio_mes == month) & (inicio_ano < year) & (ano_indice <= year)
+        if actualiza.any():
+            ano_ref = np.where(mes_ref >= month, year - 1, year)
+            pct = tabla[tipo_indice, ano_ref - primer_ano, mes_ref - 1]
+            incremento = np.where(con_indice, _round2_np(renta * pct / 100), 0.0)
+            renta = np.where(actualiza, _round2_np(renta + incremento + fijo), renta)
+        facturado = np.where(activo, renta, 0.0)
+        rent_tot.append(float(facturado.sum()))
+        iva_tot.append(float(_round2_np(facturado * iva_rate)[aplicar_iva].sum()))
+        irpf_tot.append(float(_round2_np(facturado * irpf_rate)[aplicar_irpf].sum()))
+    return rent_tot, iva_tot, irpf_tot
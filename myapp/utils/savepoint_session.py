@@ -0,0 +1,63 @@
+# myapp/utils/savepoint_session.py
+"""
+Sesión con SAVEPOINTs reales para la generación de facturas (un SAVEPOINT por contrato).
+
+pysqlite no emite BEGIN antes de un SAVEPOINT, con lo que begin_nested() confirmaría cada SAVEPOINT
+por separado. La solución de SQLAlchemy (desactivar la gestión de transacciones de pysqlite y emitir
+BEGIN a mano) se aplica solo a un motor propio de la generación, no al de toda la aplicación: el resto
+de conexiones mantiene el modo por defecto de pysqlite, en el que las lecturas no abren transacción.
+
+El motor emite BEGIN IMMEDIATE: la transacción toma el bloqueo de escritura al empezar, de modo que
+no puede fallar a mitad al pasar de leer a escribir; si otro hilo está escribiendo, espera (timeout de
+pysqlite) como cualquier otra escritura.
+"""
+from contextlib import contextmanager
+
+from flask import current_app
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+from ..models import db
+
+
+def _savepoint_engine():
+    """Motor SQLite con transacciones explícitas (BEGIN IMMEDIATE), uno por aplicación y base de datos."""
+    url = db.engine.url
+    engines = current_app.extensions.setdefault('savepoint_engines', {})
+    engine = engines.get(str(url))
+    if engine is None:
+        engine = create_engine(url)
+
+        @event.listens_for(engine, "connect")
+        def _disable_pysqlite_transactions(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def _emit_begin_immediate(conn):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+        engines[str(url)] = engine
+    return engine
+
+
+@contextmanager
+def savepoint_session(**session_options):
+    """
+    Dentro del bloque, db.session (en este contexto de aplicación) usa el motor de _savepoint_engine.
+    Al salir se cierra esa sesión (lo no confirmado se deshace) y se recupera la anterior.
+    session_options: opciones de la sesión (p. ej. expire_on_commit=False).
+    Con otras bases de datos begin_nested() ya funciona y la sesión usa el motor de siempre.
+    """
+    engine = _savepoint_engine() if db.engine.dialect.name == 'sqlite' else db.engine
+    registry = db.session.registry
+    previa = registry() if registry.has() else None
+    sesion = Session(bind=engine, **session_options)
+    registry.set(sesion)
+    try:
+        yield sesion
+    finally:
+        sesion.close()
+        if previa is not None:
+            registry.set(previa)
+        else:
+            registry.clear()
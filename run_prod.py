@@ -1,11 +1,17 @@
 # run_prod.py (en la raíz de tu proyecto, al mismo nivel que run.py)
 import os
+import multiprocessing
 from dotenv import load_dotenv
 from myapp import create_app
 import webbrowser
 import threading
 import time
 
+if __name__ == '__main__':
+    # Los PDFs de facturas se renderizan en un pool de procesos: en el .exe (Windows/spawn)
+    # los procesos hijo arrancan este mismo ejecutable y deben salir aquí.
+    multiprocessing.freeze_support()
+
 # Cargar variables de entorno desde .env en el directorio del script
 # Esto es importante para que el .exe encuentre el .env
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -24,7 +30,9 @@ PORT = 5000 # Puedes cambiarlo si quieres
 # No usar debug=True en un ejecutable distribuido
 # El modo debug de Werkzeug no es adecuado para algo que se va a ejecutar fuera de tu entorno de desarrollo.
 
-app = create_app()
+# Los procesos del pool (spawn) reimportan este módulo como '__mp_main__': no necesitan la app.
+# Se comprueba el proceso padre y no __name__ para que 'run_prod:app' siga siendo importable.
+app = create_app() if multiprocessing.parent_process() is None else None
 
 def open_browser():
     """Abre el navegador después de un breve retraso."""
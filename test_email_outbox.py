@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la bandeja de salida de emails de factura (myapp/email_outbox.py).
+Usan una app mínima con una base de datos SQLite temporal; el envío de cada email
+(_send_single_invoice_email) se sustituye por uno que devuelve el resultado indicado por factura.
+SmtpSession se prueba contra el servidor SMTP local de benchmarks/bench_email_throughput.py.
+"""
+
+import sys
+import os
+import math
+import socket
+import threading
+import time
+import inspect
+from argparse import Namespace
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask, g
+from flask_login import login_user
+from flask_mail import Message
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+
+import bench_email_throughput
+from bench_email_throughput import _SmtpSink, _SmtpSinkHandler
+from myapp import db, mail
+from myapp import email_outbox
+from myapp.models import EmailOutbox, Factura, Inquilino, SystemSettings, User
+from myapp.routes import facturas as facturas_routes
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'test.db'}",
+                      EMAIL_OUTBOX_MAX_ATTEMPTS=5, EMAIL_OUTBOX_RETRY_BASE_SECONDS=60, EMAIL_OUTBOX_RETRY_MAX_SECONDS=3600,
+                      EMAIL_OUTBOX_CLAIM_TIMEOUT_SECONDS=600)
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(SystemSettings(id=1))
+        db.session.commit()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def resultados(monkeypatch):
+    """{factura_id: resultado} de cada envío ('SENT' si no se indica); registra las facturas enviadas."""
+    resultados = {}
+    enviadas = resultados['enviadas'] = []
+
+    def _send_single_invoice_email(invoice_id, include_bcc_owner=True, invoice=None, connection=None):
+        enviadas.append(invoice_id)
+        resultado = resultados.get(invoice_id, 'SENT')
+        return resultado, None if resultado == 'SENT' else f"motivo de {resultado}"
+
+    monkeypatch.setattr(facturas_routes, '_send_single_invoice_email', _send_single_invoice_email)
+    monkeypatch.setattr(email_outbox, 'start_email_outbox_workers', lambda app: None)
+    return resultados
+
+
+class _SinkConFallos(_SmtpSink):
+    """_SmtpSink que, al aceptar el mensaje número en_mensaje, corta la conexión sin responder ('cortar') o responde 421."""
+
+    def __init__(self, fallo=None, en_mensaje=3):
+        super().__init__()
+        self.RequestHandlerClass = _SinkConFallosHandler
+        self.fallo, self.en_mensaje, self.aceptados = fallo, en_mensaje, 0
+
+
+class _SinkConFallosHandler(_SmtpSinkHandler):
+    _tras_datos = False
+
+    def _responder(self, linea):
+        sink = self.server
+        if self._tras_datos and linea == '250 OK': # Fin de DATA: el sink ya ha contado el mensaje
+            with sink.lock:
+                sink.aceptados += 1
+                fallar = sink.fallo and sink.aceptados == sink.en_mensaje
+                if fallar:
+                    sink.mensajes -= 1
+            if fallar:
+                if sink.fallo == '421':
+                    super()._responder('421 Servicio no disponible, cerrando el canal')
+                self.connection.shutdown(socket.SHUT_RDWR) # handle() lee EOF y termina
+                return
+        self._tras_datos = linea.startswith('354')
+        super()._responder(linea)
+
+
+def _mensaje(factura_id, **valores):
+    mensaje = EmailOutbox(factura_id=factura_id, **valores)
+    db.session.add(mensaje)
+    db.session.commit()
+    return mensaje.id
+
+
+def _fila(outbox_id):
+    db.session.expire_all()
+    return db.session.get(EmailOutbox, outbox_id)
+
+
+def _procesar(app):
+    return email_outbox._process_next(app, email_outbox.SmtpSession(app))
+
+
+def test_reintentos_con_espera_exponencial(app, resultados):
+    """Cada SEND_ERROR reprograma el mensaje a base * 2^(intento - 1) segundos, como mucho una hora."""
+    app.config['EMAIL_OUTBOX_MAX_ATTEMPTS'] = 10
+    resultados[1] = 'SEND_ERROR'
+    outbox_id = _mensaje(1)
+
+    for intento in range(1, 9):
+        antes = datetime.utcnow()
+        assert _procesar(app)
+        despues = datetime.utcnow()
+        mensaje = _fila(outbox_id)
+        assert (mensaje.status, mensaje.attempts, mensaje.claimed_at) == ('queued', intento, None)
+        assert mensaje.last_error == "SEND_ERROR: motivo de SEND_ERROR"
+        espera = timedelta(seconds=min(60 * 2 ** (intento - 1), 3600))
+        assert antes + espera <= mensaje.next_attempt_at <= despues + espera
+
+        assert not _procesar(app) # Hasta que pase la espera no se vuelve a tomar
+        mensaje.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+    assert resultados['enviadas'] == [1] * 8
+
+
+def test_envio_fallido_tras_max_intentos(app, resultados):
+    """Un SEND_ERROR en el intento EMAIL_OUTBOX_MAX_ATTEMPTS deja el mensaje en 'failed'."""
+    app.config['EMAIL_OUTBOX_MAX_ATTEMPTS'] = 3
+    resultados[1] = 'SEND_ERROR'
+    outbox_id = _mensaje(1)
+
+    for intento in range(1, 4):
+        _fila(outbox_id).next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        assert _procesar(app)
+        assert _fila(outbox_id).status == ('failed' if intento == 3 else 'queued')
+
+    assert _fila(outbox_id).attempts == 3
+    assert not _procesar(app)
+
+
+@pytest.mark.parametrize('resultado', ['NO_EMAIL', 'PDF_ERROR'])
+def test_fallo_permanente_sin_reintentos(app, resultados, resultado):
+    """Lo que no se arregla reintentando pasa a 'failed' en el primer intento."""
+    resultados[1] = resultado
+    outbox_id = _mensaje(1)
+
+    assert _procesar(app)
+    mensaje = _fila(outbox_id)
+    assert (mensaje.status, mensaje.attempts) == ('failed', 1)
+    assert mensaje.last_error == f"{resultado}: motivo de {resultado}"
+    assert not _procesar(app)
+
+
+def test_mensaje_en_envio_caducado_se_reclama(app, resultados):
+    """Un mensaje en 'sending' (el proceso murió enviándolo) se vuelve a tomar pasado el timeout, no antes."""
+    ahora = datetime.utcnow()
+    reciente = _mensaje(1, status='sending', attempts=1, claimed_at=ahora - timedelta(seconds=590))
+    caducado = _mensaje(2, status='sending', attempts=1, claimed_at=ahora - timedelta(seconds=610))
+
+    assert email_outbox._claim_next(app) == caducado
+    assert email_outbox._claim_next(app) is None
+    mensaje = _fila(caducado)
+    assert (mensaje.status, mensaje.attempts) == ('sending', 2)
+    assert mensaje.claimed_at >= ahora
+    assert _fila(reciente).attempts == 1
+
+
+def test_factura_en_cola_no_se_encola_dos_veces(app, resultados):
+    """Una factura con un email en cola o enviándose no se vuelve a encolar (doble clic, reenvíos)."""
+    _mensaje(3, status='sending', claimed_at=datetime.utcnow())
+    _mensaje(4, status='sent')
+
+    primeros = email_outbox.enqueue_invoice_emails([1, 2, 1, 3, 4])
+    assert [mensaje.factura_id for mensaje in primeros] == [1, 2, 4]
+    assert email_outbox.enqueue_invoice_emails([1, 2, 3]) == []
+
+    en_cola = db.session.scalars(db.select(EmailOutbox.factura_id).where(EmailOutbox.status == 'queued')).all()
+    assert sorted(en_cola) == [1, 2, 4]
+
+
+def test_hilo_vacia_la_cola(app, resultados, monkeypatch):
+    """_worker_loop envía todo lo pendiente con una sesión SMTP y después espera el aviso de nuevos mensajes."""
+    class _Parar(Exception):
+        pass
+
+    class _Aviso:
+        def clear(self):
+            pass
+
+        def wait(self, timeout=None):
+            raise _Parar() # Cola vacía: el hilo se quedaría esperando
+
+    monkeypatch.setattr(email_outbox, '_wakeup', _Aviso())
+    resultados[2] = 'NO_EMAIL'
+    ids = [_mensaje(factura_id) for factura_id in (1, 2, 3)]
+
+    with pytest.raises(_Parar):
+        email_outbox._worker_loop(app)
+
+    assert resultados['enviadas'] == [1, 2, 3]
+    assert [_fila(outbox_id).status for outbox_id in ids] == ['sent', 'failed', 'sent']
+
+
+def test_arranque_reanuda_la_cola(app, resultados, monkeypatch):
+    """resume_email_outbox arranca los hilos solo si quedaron mensajes en cola o enviándose."""
+    arrancados = []
+    monkeypatch.setattr(email_outbox, 'start_email_outbox_workers', arrancados.append)
+
+    _mensaje(1, status='sent')
+    _mensaje(2, status='failed')
+    email_outbox.resume_email_outbox(app)
+    assert arrancados == []
+
+    _mensaje(3, status='sending', claimed_at=datetime.utcnow())
+    email_outbox.resume_email_outbox(app)
+    assert arrancados == [app]
+
+
+@pytest.mark.parametrize('fallo', [None, 'cortar', '421'])
+def test_sesion_smtp_reutiliza_y_reconecta(app, fallo):
+    """
+    SmtpSession abre una conexión cada max_messages emails y, si el servidor corta la sesión o responde 421
+    a mitad del lote, reconecta y reenvía ese email: cada uno llega una sola vez.
+    """
+    emails, por_conexion = 11, 4
+    sink = _SinkConFallos(fallo, en_mensaje=3)
+    try:
+        app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=sink.server_address[1], MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+                          MAIL_DEFAULT_SENDER='facturas@test.invalid', EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION=por_conexion)
+        mail.init_app(app)
+        smtp = email_outbox.SmtpSession(app)
+        for i in range(emails):
+            smtp.send(Message(f"Factura {i}", recipients=[f"inquilino{i}@test.invalid"], body="Adjuntamos la factura."))
+        smtp.close()
+    finally:
+        sink.shutdown()
+        sink.server_close()
+
+    # Todos los send() volvieron sin error y el servidor aceptó exactamente ese número: ninguno repetido
+    assert sink.mensajes == smtp.sent == emails
+    if fallo is None:
+        conexiones = math.ceil(emails / por_conexion)
+    else:
+        # La primera conexión aceptó 2 antes del fallo; el resto va en conexiones nuevas de por_conexion emails
+        conexiones = 1 + math.ceil((emails - 2) / por_conexion)
+    assert sink.conexiones == smtp.connections == conexiones
+    assert smtp.reconnects == (0 if fallo is None else 1)
+
+
+def test_limite_de_ritmo_reparte_turnos():
+    """_RateLimiter da a cada envío, de cualquier hilo, un turno 60/por_minuto segundos después del anterior."""
+    limitador, por_minuto, marcas = email_outbox._RateLimiter(), 600, []
+
+    def _enviar():
+        limitador.wait(por_minuto)
+        marcas.append(time.monotonic())
+
+    inicio = time.monotonic()
+    hilos = [threading.Thread(target=_enviar) for _ in range(4)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    marcas.sort()
+    assert marcas[0] - inicio < 0.05
+    for turno, marca in enumerate(marcas):
+        assert marca - inicio >= turno * 60 / por_minuto
+    antes = time.monotonic()
+    limitador.wait(0) # Sin límite no espera
+    assert time.monotonic() - antes < 0.05
+
+
+def test_envio_masivo_por_lote(tmp_path, monkeypatch):
+    """
+    El envío masivo (vista real, app y datos de benchmarks/bench_email_throughput.py) encola su lote con las
+    facturas omitidas como 'skipped', get_batch_progress cuenta cada estado, y la bandeja lo envía al sink
+    respetando EMAIL_OUTBOX_RATE_PER_MINUTE.
+    """
+    monkeypatch.setattr(email_outbox, 'start_email_outbox_workers', lambda app: None) # La cola se vacía aquí
+    monkeypatch.setattr(email_outbox, '_rate_limiter', email_outbox._RateLimiter())
+    sink = _SmtpSink()
+    try:
+        por_minuto = 1200
+        app = bench_email_throughput._crear_app(str(tmp_path / 'envio.db'), sink.server_address[1],
+                                                Namespace(pdf_en_cache=False, hilos=1, por_minuto=por_minuto))
+        dir_gastos = tmp_path / 'gastos'
+        dir_gastos.mkdir()
+        with app.app_context():
+            usuario_id = bench_email_throughput._poblar(5, str(dir_gastos))
+            facturas = db.session.scalars(db.select(Factura).order_by(Factura.id)).all()
+            sin_email, en_cola = facturas[1].id, facturas[2].id
+            db.session.get(Inquilino, facturas[1].inquilino_id).email = None
+            db.session.add(EmailOutbox(factura_id=en_cola)) # Un envío anterior de esa factura sigue pendiente
+            db.session.commit()
+
+        vista = inspect.unwrap(app.view_functions['facturas_bp.enviar_facturas_masivo'])
+        datos = {'year': bench_email_throughput.ANO, 'month': bench_email_throughput.MES}
+        with app.test_request_context('/facturas/enviar_masivo', method='POST', data=datos, headers={'Accept': 'application/json'}):
+            g.settings = db.session.get(SystemSettings, 1)
+            login_user(db.session.get(User, usuario_id))
+            respuesta, status = vista()
+            lote = respuesta.get_json()['lote']
+        assert status == 202
+
+        with app.app_context():
+            progreso = email_outbox.get_batch_progress(lote)
+            omitidas = {mensaje.factura_id: mensaje.last_error for mensaje in
+                        db.session.scalars(db.select(EmailOutbox).where(EmailOutbox.lote == lote, EmailOutbox.status == 'skipped'))}
+            assert email_outbox.get_batch_progress('no-existe') is None
+        assert {clave: progreso[clave] for clave in ('total', 'queued', 'skipped', 'pending', 'sent', 'finished')} == \
+            {'total': 5, 'queued': 3, 'skipped': 2, 'pending': 3, 'sent': 0, 'finished': False}
+        assert progreso['user_id'] == usuario_id
+        assert omitidas[sin_email].startswith('NO_EMAIL') and omitidas[en_cola].startswith('YA_EN_COLA')
+
+        smtp, inicio = email_outbox.SmtpSession(app), time.monotonic()
+        while email_outbox._process_next(app, smtp):
+            pass
+        smtp.close()
+        segundos = time.monotonic() - inicio
+
+        with app.app_context():
+            progreso = email_outbox.get_batch_progress(lote)
+        assert {clave: progreso[clave] for clave in ('total', 'sent', 'failed', 'skipped', 'pending', 'finished')} == \
+            {'total': 5, 'sent': 3, 'failed': 0, 'skipped': 2, 'pending': 0, 'finished': True}
+        assert sink.mensajes == 4 # Los 3 del lote y el envío que ya estaba en cola
+        assert segundos >= (sink.mensajes - 1) * 60 / por_minuto
+    finally:
+        sink.shutdown()
+        sink.server_close()
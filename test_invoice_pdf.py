@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Pruebas del render de facturas PDF (myapp/utils/pdf_generator.py).
+No necesitan base de datos ni Flask: renderizan instantáneas como las del pool de render.
+"""
+
+import sys
+import os
+import re
+import zlib
+import base64
+import logging
+from datetime import date
+from decimal import Decimal
+from types import SimpleNamespace
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from myapp.utils.pdf_generator import InvoicePdfRenderer, _build_invoice_pdf
+
+PIE = 'Pie de prueba: registro mercantil 1234'
+
+
+def _factura(num_conceptos=1):
+    emisor = SimpleNamespace(id=1, nombre='Inversiones Test, S.L.', nif='B00000000', direccion='Calle Mayor, 1',
+                             codigo_postal='36400', ciudad='Vigo', telefono=None, banco='Banco Test',
+                             cuenta_bancaria='ES00 0000 0000 0000 0000 0000', iban=None, swift=None)
+    inquilino = SimpleNamespace(id=1, nombre='Inquilino Test', nif='00000000T', direccion='Calle 1', codigo_postal='36400',
+                                ciudad='Vigo', telefono=None, banco=None, cuenta_bancaria=None, iban=None, swift=None)
+    propiedad = SimpleNamespace(id=1, direccion='Calle 1, 2B', referencia_catastral='RC0000000001', descripcion=None)
+    items = [{'description': f'Concepto {i}', 'quantity': 1, 'unitPrice': 10.0, 'total': 10.0} for i in range(num_conceptos)]
+    subtotal = Decimal(10 * num_conceptos).quantize(Decimal('0.01'))
+    invoice = SimpleNamespace(id=1, numero_factura='C1-2025-0001', numero_factura_mostrado_al_cliente='2025-0001',
+                              fecha_emision=date(2025, 5, 1), items=items, subtotal=subtotal, iva=Decimal('0.00'),
+                              irpf=Decimal('0.00'), total=subtotal, notas=None, contrato_ref=SimpleNamespace(numero_contrato='CT-1'))
+    settings = SimpleNamespace(notas_factura=None, pie_factura=PIE, company_logo_filename=None, logo_path=None)
+    return invoice, inquilino, propiedad, emisor, settings
+
+
+def _contenido(pdf):
+    """Streams del PDF descomprimidos (ASCII85 + Flate, como los escribe ReportLab)."""
+    streams = []
+    for datos in re.findall(rb'stream\r?\n(.*?)endstream', pdf, re.S):
+        datos = datos.strip()
+        if datos.endswith(b'~>'):
+            datos = base64.a85decode(datos[:-2])
+        streams.append(zlib.decompress(datos))
+    return b'\n'.join(streams)
+
+
+def _render(num_conceptos, renderer):
+    return _build_invoice_pdf(*_factura(num_conceptos), logger_func=logging.getLogger(__name__), renderer=renderer).getvalue()
+
+
+def test_pie_en_la_factura():
+    """El pie (y los rótulos fijos) están en el PDF, con y sin párrafos reutilizados entre facturas."""
+    for renderer in (InvoicePdfRenderer(), InvoicePdfRenderer(prerender_chrome=False)):
+        for _ in range(2): # La segunda factura usa los párrafos ya maquetados
+            contenido = _contenido(_render(1, renderer))
+            assert PIE.encode('latin-1') in contenido
+            assert b'(FACTURA)' in contenido
+
+
+def test_pie_en_todas_las_paginas():
+    """En varias páginas, el pie se dibuja en la primera y las demás reutilizan su form XObject."""
+    pdf = _render(120, InvoicePdfRenderer())
+    paginas = len(re.findall(rb'/Type /Page\b', pdf))
+    assert paginas > 2
+    contenido = _contenido(pdf)
+    assert contenido.count(PIE.encode('latin-1')) == 2 # Página 1 y el form
+    assert len(re.findall(rb'/FormXob\.\w+ Do', contenido)) == paginas - 1
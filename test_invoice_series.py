@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la numeración de facturas en la generación por lotes (myapp/routes/facturas.py).
+Usan una app mínima con una base de datos SQLite temporal.
+"""
+
+import sys
+import os
+from datetime import date
+from decimal import Decimal
+
+import pytest
+from flask import Flask, g
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from myapp import db
+from myapp.models import (Contrato, Factura, Inquilino, InvoiceSeriesCounter, Propiedad, Propietario,
+                          SystemSettings)
+from myapp.routes.facturas import generate_invoices_range
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'test.db'}", INVOICE_GENERATION_BATCH_SIZE=2,
+                      INVOICE_PDF_WORKERS=1, INVOICE_PDF_CACHE_MAX_MB=0, INVOICE_TRACE_LEVEL='off')
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        propietario = Propietario(nombre='Propietario Test', nif='B00000000', documentos_ruta_base=str(tmp_path))
+        inquilino = Inquilino(nombre='Inquilino Test', nif='00000000T')
+        db.session.add_all([SystemSettings(id=1), propietario, inquilino])
+        db.session.flush()
+        propiedad = Propiedad(direccion='Calle Test, 1', propietario_id=propietario.id)
+        db.session.add(propiedad)
+        db.session.flush()
+        db.session.add(Contrato(numero_contrato='C-TEST', fecha_inicio=date(2024, 6, 1), precio_mensual=Decimal('500.00'),
+                                estado='activo', propiedad_id=propiedad.id, inquilino_id=inquilino.id, dia_pago=1,
+                                tipo_actualizacion_renta='manual'))
+        db.session.commit()
+        g.settings = db.session.get(SystemSettings, 1)
+        yield app
+        db.session.remove()
+
+
+def _numeros_secuenciales():
+    return [int(f.numero_factura.rsplit('-', 1)[1]) for f in Factura.query.order_by(Factura.fecha_emision)]
+
+
+def test_lote_fallido_no_deja_huecos(app):
+    """Si falla el commit de un lote, sus números los reutilizan las facturas siguientes."""
+    fallos = []
+
+    def _fallar_lote_de_marzo(session):
+        if session.in_nested_transaction():
+            return  # SAVEPOINT de un contrato, no el commit del lote
+        if not fallos and any(isinstance(obj, Factura) and obj.fecha_emision.month == 3 for obj in session.identity_map.values()):
+            fallos.append(True)
+            raise RuntimeError("commit fallido (simulado)")
+
+    # Lotes de 2 facturas: enero-febrero, marzo-abril (falla), mayo-junio
+    event.listen(Session, 'before_commit', _fallar_lote_de_marzo)
+    try:
+        nuevas, omitidas, errores, _, _, _ = generate_invoices_range(2025, 1, 2025, 6)
+    finally:
+        event.remove(Session, 'before_commit', _fallar_lote_de_marzo)
+
+    assert fallos
+    assert (nuevas, omitidas) == (4, 2)
+    assert any('commit lote' in error for error in errores)
+    assert _numeros_secuenciales() == [1, 2, 3, 4]
+    assert db.session.query(InvoiceSeriesCounter.last_number).scalar() == 4
+
+    generate_invoices_range(2025, 7, 2025, 7)
+    assert _numeros_secuenciales() == [1, 2, 3, 4, 5]
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Pruebas del estado de los trabajos de generación en segundo plano (myapp/jobs.py).
+Usan una app mínima con una base de datos SQLite temporal.
+"""
+
+import sys
+import os
+
+import pytest
+from flask import Flask
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from myapp import db
+from myapp import jobs
+from myapp.models import InvoiceGenerationJob
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'test.db'}")
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+def _job(status):
+    job = InvoiceGenerationJob(year=2025, month=5, status=status)
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+
+def test_arranque_marca_interrumpidos(app):
+    """Al arrancar, los trabajos en cola o en curso sin hilo que los ejecute pasan a 'failed'."""
+    en_cola, en_curso, terminado, vivo = _job('queued'), _job('running'), _job('done'), _job('running')
+    with jobs._live_lock:
+        jobs._live_progress[vivo] = {'contracts_processed': 1, 'contracts_total': 2}
+    try:
+        jobs.fail_interrupted_invoice_generation_jobs(app)
+    finally:
+        with jobs._live_lock:
+            jobs._live_progress.pop(vivo, None)
+
+    estados = {job.id: job.status for job in InvoiceGenerationJob.query}
+    assert estados == {en_cola: 'failed', en_curso: 'failed', terminado: 'done', vivo: 'running'}
+    assert 'reinicio' in db.session.get(InvoiceGenerationJob, en_curso).messages[0]['message']
+
+
+def test_consulta_no_pisa_trabajo_terminado(app):
+    """Una consulta que cargó el trabajo 'running' justo antes de que terminara devuelve el resultado real."""
+    job_id = _job('running')
+    job = db.session.get(InvoiceGenerationJob, job_id)  # La consulta ya lo tiene cargado en su sesión
+    assert job.status == 'running'
+
+    # El hilo del trabajo guarda el resultado (en su propia conexión) y quita el progreso en memoria
+    with db.engine.begin() as conn:
+        conn.execute(InvoiceGenerationJob.__table__.update()
+                     .where(InvoiceGenerationJob.id == job_id)
+                     .values(status='done', invoices_created=3, messages=[{"category": "success", "message": "ok"}]))
+
+    progreso = jobs.get_invoice_generation_progress(job_id)
+    assert progreso['status'] == 'done' and progreso['finished']
+    assert progreso['invoices_created'] == 3
+
+    db.session.expire_all()
+    job = db.session.get(InvoiceGenerationJob, job_id)
+    assert job.status == 'done'
+    assert job.messages == [{"category": "success", "message": "ok"}]
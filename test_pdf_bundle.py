@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la descarga por lotes de facturas (myapp/utils/pdf_bundle.py): ZIP y PDF combinado.
+Las facturas se renderizan como en test_invoice_pdf.py, sin base de datos ni Flask.
+"""
+
+import sys
+import os
+import io
+import re
+import logging
+import zipfile
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from myapp.utils.pdf_bundle import _REF_RE, _STREAM_RE, _read_xref, stream_invoice_zip, stream_merged_pdf
+from myapp.utils.pdf_cache import CachedPdf
+from myapp.utils.pdf_generator import InvoicePdfRenderer
+from test_invoice_pdf import _render
+
+
+def _paginas(pdf):
+    return len(re.findall(rb'/Type /Page\b', pdf))
+
+
+def _pdf_a_mano(objetos):
+    """PDF mínimo con su xref a partir de {num: cuerpo}, con números seguidos desde 1 (el catálogo)."""
+    data, offsets = b'%PDF-1.4\n', {}
+    for num, cuerpo in sorted(objetos.items()):
+        offsets[num] = len(data)
+        data += b'%d 0 obj\n' % num + cuerpo + b'\nendobj\n'
+    total, inicio_xref = max(objetos) + 1, len(data)
+    data += b'xref\n0 %d\n0000000000 65535 f \n' % total
+    data += b''.join(b'%010d 00000 n \n' % offsets[num] for num in range(1, total))
+    return data + b'trailer\n<< /Root 1 0 R /Size %d >>\nstartxref\n%d\n%%%%EOF\n' % (total, inicio_xref)
+
+
+def _pagina_a_mano(contents=b'4 0 R', longitud=b'18'):
+    return _pdf_a_mano({
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        2: b'<< /Type /Pages /Kids [ 3 0 R ] /Count 1 >>',
+        3: b'<< /Type /Page /Parent 2 0 R /MediaBox [ 0 0 595 842 ] /Contents %s >>' % contents,
+        4: b'<< /Length %s >>\nstream\nq 1 0 0 1 0 0 cm Q\nendstream' % longitud,
+        5: b'18',
+    })
+
+
+def _comprobar_pdf(pdf):
+    """La xref apunta a cada 'N 0 obj', no hay referencias colgantes y /Count coincide con las páginas. Devuelve /Count."""
+    assert pdf.startswith(b'%PDF-') and pdf.endswith(b'%%EOF\n')
+    offsets, trailer = _read_xref(pdf)
+    assert int(re.search(rb'/Size (\d+)', trailer).group(1)) == max(offsets) + 1
+    for num, offset in offsets.items():
+        assert pdf.startswith(b'%d 0 obj' % num, offset)
+        cuerpo = pdf[offset:pdf.index(b'endobj', offset)]
+        stream = _STREAM_RE.search(cuerpo)
+        diccionario = cuerpo[:stream.start()] if stream else cuerpo
+        assert {int(ref) for ref in _REF_RE.findall(diccionario)} <= set(offsets), f"referencia colgante en el objeto {num}"
+    paginas = int(re.search(rb'/Count (\d+) /Kids', pdf).group(1))
+    assert paginas == _paginas(pdf)
+    return paginas
+
+
+def test_pdf_combinado():
+    """Facturas de 1, 120 y 3 conceptos: un PDF válido con todas sus páginas, en orden."""
+    renderer = InvoicePdfRenderer()
+    pdfs = [_render(num_conceptos, renderer) for num_conceptos in (1, 120, 3)]
+    assert _paginas(pdfs[1]) > 1
+
+    trozos = list(stream_merged_pdf(iter(pdfs)))
+    assert len(trozos) == len(pdfs) + 2  # Cabecera, una factura por trozo y el cierre
+    combinado = b''.join(trozos)
+    assert _comprobar_pdf(combinado) == sum(_paginas(pdf) for pdf in pdfs)
+
+
+def test_pdf_combinado_omite_pdf_no_combinable(caplog):
+    """Un PDF con una referencia a un objeto libre o un /Length indirecto se omite sin cortar la descarga."""
+    factura = _render(1, InvoicePdfRenderer())
+    pdfs = [factura, _pagina_a_mano(), _pagina_a_mano(contents=b'9 0 R'), _pagina_a_mano(longitud=b'5 0 R'), factura]
+
+    with caplog.at_level(logging.WARNING, logger='myapp.utils.pdf_bundle'):
+        combinado = b''.join(stream_merged_pdf(pdfs))
+
+    assert _comprobar_pdf(combinado) == 2 * _paginas(factura) + 1
+    omitidos = [registro.getMessage() for registro in caplog.records]
+    assert len(omitidos) == 2
+    assert omitidos[0].startswith('PDF 2 omitido') and omitidos[1].startswith('PDF 3 omitido')
+    assert '/Length directo' in omitidos[1]
+
+
+def test_zip_de_facturas(tmp_path):
+    """El ZIP (PDFs en disco y en memoria) se lee de vuelta con zipfile."""
+    renderer = InvoicePdfRenderer()
+    en_memoria, en_disco = _render(1, renderer), _render(120, renderer)
+    ruta = tmp_path / 'factura.pdf'
+    ruta.write_bytes(en_disco)
+    entradas = [('Factura_1.pdf', CachedPdf(etag='1', data=en_memoria)), ('Factura_2.pdf', CachedPdf(etag='2', path=str(ruta)))]
+
+    trozos = list(stream_invoice_zip(entradas))
+    assert len(trozos) == len(entradas) + 1  # Un trozo por PDF y el directorio central
+    with zipfile.ZipFile(io.BytesIO(b''.join(trozos))) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ['Factura_1.pdf', 'Factura_2.pdf']
+        assert zf.read('Factura_1.pdf') == en_memoria
+        assert zf.read('Factura_2.pdf') == en_disco
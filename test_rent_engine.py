@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Pruebas del motor de cálculo de rentas (myapp/utils/rent_engine.py).
+No necesitan base de datos: trabajan con instantáneas de contrato e índices en memoria.
+"""
+
+import sys
+import os
+import pickle
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from myapp.utils.rent_engine import ContractSnapshot, IndexLookup, calculate_rent
+from myapp.utils.rent_forecast import ForecastContract, project_rents
+
+
+def _contrato(**cambios):
+    datos = dict(id=1, numero_contrato='C-TEST', fecha_inicio=date(2022, 3, 1), precio_mensual=Decimal('1000.00'),
+                 tipo_actualizacion_renta='indice', actualiza_ipc=True, ipc_ano_inicio=2022, ipc_mes_inicio=1)
+    datos.update(cambios)
+    return ContractSnapshot(**datos)
+
+
+def test_actualizacion_anual_ipc():
+    """En el mes aniversario se aplica el IPC de referencia del año anterior."""
+    contrato = _contrato()
+    resultado = calculate_rent(contrato, 2024, 3, contrato.precio_mensual, IndexLookup({('IPC', 2024, 1): Decimal('3.000')}))
+    assert resultado.nueva_renta == Decimal('1030.00')
+    assert resultado.indice_aplicado == {'type': 'IPC', 'month': 1, 'year': 2024, 'percentage': 3.0}
+    assert resultado.changes == {}
+
+
+def test_fuera_de_aniversario_no_cambia():
+    contrato = _contrato()
+    resultado = calculate_rent(contrato, 2024, 4, contrato.precio_mensual, IndexLookup({('IPC', 2024, 1): Decimal('3.000')}))
+    assert resultado.nueva_renta is None
+    assert resultado.conceptos_adicionales == []
+
+
+def test_indice_no_publicado():
+    """Sin índice: error, factura sin incremento si la configuración lo permite, o pendiente si es retroactivo."""
+    contrato = _contrato()
+    with pytest.raises(ValueError):
+        calculate_rent(contrato, 2024, 3, contrato.precio_mensual, IndexLookup())
+
+    resultado = calculate_rent(contrato, 2024, 3, contrato.precio_mensual, IndexLookup(), allow_missing_index=True)
+    assert resultado.nueva_renta is None
+
+    retroactivo = _contrato(aplicar_indice_retroactivo=True)
+    resultado = calculate_rent(retroactivo, 2024, 3, retroactivo.precio_mensual, IndexLookup())
+    assert resultado.nueva_renta is None
+    assert resultado.changes['indice_pendiente_tipo'] == 'IPC'
+    assert resultado.changes['indice_pendiente_mes_original_aplicacion'] == 3
+    assert retroactivo.indice_pendiente_tipo is None  # La instantánea no se modifica
+
+
+def test_indice_pendiente_resuelto_con_atrasos():
+    """Al publicarse el índice pendiente se actualiza la base y se cobran los meses de atraso."""
+    contrato = _contrato(aplicar_indice_retroactivo=True)
+    pendiente = calculate_rent(contrato, 2024, 3, contrato.precio_mensual, IndexLookup())
+    contrato = contrato.with_changes(**pendiente.changes)
+
+    resultado = calculate_rent(contrato, 2024, 5, contrato.precio_mensual, IndexLookup({('IPC', 2024, 1): Decimal('2.000')}))
+    assert resultado.nueva_renta == Decimal('1020.00')
+    assert resultado.renta_linea_principal == Decimal('1000.00')
+    atrasos = [c for c in resultado.conceptos_adicionales if c['description'].startswith('Atrasos')]
+    assert atrasos and atrasos[0]['total'] == 40.0  # marzo y abril
+    assert resultado.changes['indice_pendiente_tipo'] is None
+
+
+def test_instantanea_serializable():
+    """Instantánea e índices deben poder enviarse a otros procesos."""
+    contrato = _contrato()
+    indices = IndexLookup({('IPC', 2024, 1): Decimal('3.000')})
+    assert pickle.loads(pickle.dumps(contrato)) == contrato
+    assert pickle.loads(pickle.dumps(indices)).values == indices.values
+
+
+def _contratos_prevision():
+    return [
+        ForecastContract(1, Decimal('1000.00'), date(2022, 3, 1), None, 'indice', True, False, 2022, 1),
+        ForecastContract(2, Decimal('750.00'), date(2023, 6, 1), date(2025, 9, 30), 'indice_mas_fijo', False, True, 2023, 6,
+                         Decimal('20.00'), aplicar_irpf=False),
+        ForecastContract(3, Decimal('500.00'), date(2025, 2, 1), None, 'fijo', ipc_ano_inicio=2025, importe_actualizacion_fija=Decimal('10.00')),
+    ]
+
+
+def test_prevision_coincide_con_calculate_rent():
+    """Con todos los índices publicados, la previsión suma lo mismo que facturar mes a mes."""
+    indices = IndexLookup({(tipo, ano, mes): Decimal('2.345') for tipo in ('IPC', 'IRAV') for ano in range(2021, 2028) for mes in range(1, 13)})
+    prevision = project_rents(_contratos_prevision(), indices, 2024, 1, 36, use_numpy=False)
+    esperado = [Decimal('0.00')] * 36
+    for c in _contratos_prevision():
+        instantanea = ContractSnapshot(id=c.id, numero_contrato='C', fecha_inicio=c.fecha_inicio, precio_mensual=c.precio_mensual,
+                                       tipo_actualizacion_renta=c.tipo_actualizacion_renta, actualiza_ipc=c.actualiza_ipc,
+                                       actualiza_irav=c.actualiza_irav, ipc_ano_inicio=c.ipc_ano_inicio, ipc_mes_inicio=c.ipc_mes_inicio,
+                                       importe_actualizacion_fija=c.importe_actualizacion_fija)
+        renta = c.precio_mensual
+        for t, (ano, mes) in enumerate(prevision.months):
+            if (ano, mes) < (c.fecha_inicio.year, c.fecha_inicio.month): continue
+            if c.fecha_fin and (ano, mes) > (c.fecha_fin.year, c.fecha_fin.month): break
+            resultado = calculate_rent(instantanea, ano, mes, renta, indices)
+            esperado[t] += resultado.renta_linea_principal + sum(Decimal(str(x['total'])) for x in resultado.conceptos_adicionales)
+            renta = resultado.nueva_renta or renta
+    assert prevision.rent == [float(v) for v in esperado]
+
+
+def test_prevision_numpy_igual_que_python():
+    pytest.importorskip('numpy')
+    indices = IndexLookup({('IPC', 2024, 1): Decimal('3.100'), ('IRAV', 2024, 6): Decimal('1.900')})
+    argumentos = dict(assumed_index={'IPC': {2025: 2.5, 2026: 2.0}, 'IRAV': 2.2}, iva_rate=0.21, irpf_rate=0.19)
+    python = project_rents(_contratos_prevision(), indices, 2024, 1, 48, use_numpy=False, **argumentos)
+    vectorial = project_rents(_contratos_prevision(), indices, 2024, 1, 48, use_numpy=True, **argumentos)
+    assert vectorial.engine == 'numpy'
+    assert vectorial.rent == python.rent and vectorial.iva == python.iva and vectorial.irpf == python.irpf
+    assert set(python.by_year()) == {2024, 2025, 2026, 2027}
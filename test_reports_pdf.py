@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Pruebas del PDF del listado de facturación (myapp/routes/reports.py), maquetado por partes.
+Usan la app mínima y los datos sintéticos de benchmarks/bench_pdf_suite.py, en una BD temporal.
+"""
+
+import sys
+import os
+import inspect
+import tracemalloc
+
+import pytest
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+
+from bench_pdf_suite import ANO_FINAL, _crear_app, _poblar
+from myapp.routes import reports
+from test_pdf_bundle import _comprobar_pdf, _paginas
+
+CONTRATOS = 3
+
+
+@pytest.fixture(scope='module')
+def listado(tmp_path_factory):
+    """
+    Genera el listado de un propietario para los últimos `anos` años; devuelve los bytes del PDF o,
+    con leer=False, solo su tamaño (sin juntar la respuesta en memoria).
+    """
+    app = _crear_app(tmp_path_factory.mktemp('listado') / 'listado.db')
+    with app.app_context():
+        propietario_id, _ = _poblar(CONTRATOS)
+    vista = inspect.unwrap(app.view_functions['reports_bp.listado_facturacion_pdf'])
+
+    def _generar(anos, leer=True):
+        datos = {'propietario_id': propietario_id, 'fecha_desde': f'{ANO_FINAL - anos + 1}-01-01',
+                 'fecha_hasta': f'{ANO_FINAL}-12-31', 'contrato_ids': 'all_contracts_of_owner'}
+        with app.test_request_context('/reports/listado-facturacion-pdf', method='POST', data=datos):
+            respuesta = vista()
+            try:
+                assert respuesta.mimetype == 'application/pdf'
+                if leer:
+                    return b''.join(respuesta.response)
+                return sum(len(trozo) for trozo in respuesta.response)
+            finally:
+                respuesta.close()
+
+    return _generar
+
+
+@pytest.fixture
+def partes_pequenas(monkeypatch):
+    """Partes de 2 páginas, tablas de 10 filas y lotes de 20 facturas, para que pocos datos den muchas partes."""
+    monkeypatch.setattr(reports, 'REPORT_PDF_PAGES_PER_PART', 2)
+    monkeypatch.setattr(reports, 'REPORT_PDF_TABLE_ROWS', 10)
+    monkeypatch.setattr(reports, 'REPORT_PDF_YIELD_PER', 20)
+
+
+def test_listado_por_partes_igual_que_entero(listado, monkeypatch):
+    """Unir las partes da un PDF válido con las mismas páginas que maquetarlo de una vez."""
+    monkeypatch.setattr(reports, 'REPORT_PDF_PAGES_PER_PART', 1000)
+    entero = listado(10)
+    assert _paginas(entero) > 6
+
+    monkeypatch.setattr(reports, 'REPORT_PDF_PAGES_PER_PART', 2)
+    por_partes = listado(10)
+    assert _comprobar_pdf(por_partes) == _paginas(entero)
+
+
+def test_pico_de_memoria_no_crece_con_el_periodo(listado, partes_pequenas):
+    """El pico de memoria depende del tamaño de las partes y de los lotes, no de los años del listado."""
+    picos = {}
+    for anos in (3, 10):
+        assert _comprobar_pdf(listado(anos)) > reports.REPORT_PDF_PAGES_PER_PART # Varias partes unidas
+        tracemalloc.start()
+        try:
+            listado(anos, leer=False)
+            picos[anos] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    assert picos[10] < picos[3] * 1.25, f"pico de {picos[3] / 2**20:.2f} MiB a 3 años y {picos[10] / 2**20:.2f} MiB a 10"